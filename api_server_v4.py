@@ -3,46 +3,99 @@ Gemini Reverse API v4.2
 功能: Provider优先 + Cookie备用 + 智能重试 + 动态延迟 + 去水印 + TTS语音 + PDF分析 + UI设计理解
 关键词: gemini, api, provider, cookie, hybrid, retry, rate-limit, watermark-removal, tts, pdf, ui-design
 """
-from fastapi import FastAPI, HTTPException, BackgroundTasks, UploadFile, File, Form
-from fastapi.responses import FileResponse, Response
+from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Request
+from fastapi.responses import FileResponse, RedirectResponse, Response, StreamingResponse
 from pydantic import BaseModel
 from gemini_webapi import GeminiClient
 import os
 import asyncio
 import re
 import hashlib
-import sqlite3
-import random
 import time
 import io
+import json
 import wave
 import base64 as b64
 from datetime import datetime
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, AsyncGenerator, Tuple, Union
 from pathlib import Path
 import uuid
 from contextlib import asynccontextmanager
-from tenacity import (
-    retry,
-    wait_exponential,
-    stop_after_attempt,
-    retry_if_exception_type,
-    before_sleep_log,
-    RetryError
-)
+from tenacity import RetryError
 import logging
 import httpx
+from http_pool import PooledHTTPClient
+from image_downloader import DownloadError, ImageDownloader
+from image_pipeline import ImageJob, ImagePipeline
+from image_workers import ProcessImageBackend, ThreadImageBackend
+from batch_events import BatchEventBus
+from batch_queue import BatchQueueWorker
+from blob_store import BlobRef, BlobStore
+from circuit_breaker import CircuitBreaker
+from cookie_pool import CookieClientPool, NoAvailableAccountError
+from hedging import HedgeFailedError, Hedger
+from r2_uploader import R2Uploader
+from request_coalescer import RequestCoalescer
+from response_cache import ResponseCache
+from retry_engine import DeadlineExceededError, RetryBudget, RetryEngine, RetryPolicy
+from task_state import TaskStateManager, decode_task_input, encode_task_input
+from webhook_dispatcher import CallbackURLError, WebhookDispatcher
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # ============ 配置 ============
 WEB_DIR = Path(__file__).parent / "web"
-DB_PATH = Path(__file__).parent / "task_state.db"
+DB_PATH = Path(os.getenv("TASK_DB_PATH", str(Path(__file__).parent / "task_state.db")))  # 多进程worker需共享同一文件
 
 # 并发配置
-MAX_CONCURRENCY = 2  # 最大并发数
-REQUEST_SEMAPHORE = None  # 全局信号量，启动时初始化
+MAX_CONCURRENCY = int(os.getenv("MAX_CONCURRENCY", "2"))  # 每个Cookie账号的默认并发数
+
+# 批量任务队列 (持久化在任务表中，重启后自动恢复)
+BATCH_QUEUE_CONFIG = {
+    "concurrency": int(os.getenv("BATCH_CONCURRENCY", "0")),              # 0表示跟随Cookie账号总槽位数
+    "lease_seconds": float(os.getenv("BATCH_LEASE_SECONDS", "300")),      # 租约(可见性超时)，需大于单个任务耗时上限
+    "heartbeat_interval": float(os.getenv("BATCH_HEARTBEAT_INTERVAL", "30")),
+    "max_attempts": int(os.getenv("BATCH_MAX_ATTEMPTS", "3")),
+    "retry_base_delay": float(os.getenv("BATCH_RETRY_BASE_DELAY", "10")),
+    # embedded: API进程内消费队列; external: 仅入队，由独立进程 python -m batch_worker 消费
+    "mode": os.getenv("BATCH_WORKER_MODE", "embedded").lower(),
+    "resync_interval": float(os.getenv("BATCH_COUNTS_RESYNC_INTERVAL", "15")),  # external模式下重新统计任务计数的间隔
+}
+
+# 批量任务base64结果的blob存储目录（多个worker进程需共享）
+BLOB_STORE_DIR = Path(os.getenv("BLOB_STORE_DIR", str(Path(__file__).parent / "data" / "blobs")))
+
+# 已完成任务的保留期；过期任务及不再被引用的blob由API进程定期清理
+TASK_RETENTION_CONFIG = {
+    "days": int(os.getenv("TASK_RETENTION_DAYS", "7")),
+    "interval": float(os.getenv("TASK_CLEANUP_INTERVAL", "3600")),
+    "blob_min_age": float(os.getenv("BLOB_GC_MIN_AGE", "3600")),  # 写入后多久才允许回收(秒)
+}
+
+# 批量状态查询分页
+BATCH_STATUS_PAGE_SIZE = int(os.getenv("BATCH_STATUS_PAGE_SIZE", "100"))
+BATCH_STATUS_MAX_PAGE_SIZE = int(os.getenv("BATCH_STATUS_MAX_PAGE_SIZE", "1000"))
+
+# 批量进度SSE: 本进程完成的任务立即推送，独立worker完成的任务按间隔从数据库读取
+BATCH_EVENTS_POLL_INTERVAL = float(os.getenv("BATCH_EVENTS_POLL_INTERVAL", "2"))
+BATCH_EVENTS_KEEPALIVE = float(os.getenv("BATCH_EVENTS_KEEPALIVE", "15"))
+
+# 批量任务webhook (请求带callback_url时，任务/批次结束后POST结果)
+WEBHOOK_CONFIG = {
+    "secret": os.getenv("WEBHOOK_SECRET", ""),                          # HMAC-SHA256签名密钥，为空则不签名
+    "concurrency": int(os.getenv("WEBHOOK_CONCURRENCY", "8")),
+    "timeout": float(os.getenv("WEBHOOK_TIMEOUT", "10")),
+    "max_attempts": int(os.getenv("WEBHOOK_MAX_ATTEMPTS", "8")),
+    "retry_base_delay": float(os.getenv("WEBHOOK_RETRY_BASE_DELAY", "5")),
+    "public_base_url": os.getenv("PUBLIC_BASE_URL", "").rstrip("/"),    # 把结果下载路径拼成完整URL
+    "allowed_hosts": [h for h in os.getenv("WEBHOOK_ALLOWED_HOSTS", "").split(",") if h.strip()],  # 为空时只允许公网地址
+    "allow_private": os.getenv("WEBHOOK_ALLOW_PRIVATE", "false").lower() == "true",  # 允许内网/回环回调(仅调试)
+}
+
+# 多账号Cookie配置文件 (JSON: [{"name", "cookies", "max_concurrency", "rpm_limit"}])
+COOKIE_ACCOUNTS_PATH = os.getenv("COOKIE_ACCOUNTS_PATH", "")
+DEFAULT_COOKIE_ACCOUNT = "default"
 
 # 智能延迟配置
 RATE_LIMIT_CONFIG = {
@@ -55,11 +108,39 @@ RATE_LIMIT_CONFIG = {
 
 # 重试配置
 RETRY_CONFIG = {
-    "max_attempts": 5,        # 最大重试次数
+    "max_attempts": 5,        # Cookie模式最大尝试次数
     "min_wait": 2,            # 最小等待(秒)
     "max_wait": 60,           # 最大等待(秒)
+    "provider_max_attempts": int(os.getenv("PROVIDER_RETRY_ATTEMPTS", "1")),  # Provider失败后尽快切换Cookie
+    "deadline": float(os.getenv("REQUEST_DEADLINE", "300")),                # 单请求总时长预算(秒)
+    "budget_ratio": float(os.getenv("RETRY_BUDGET_RATIO", "0.2")),          # 窗口内重试占请求数的最大比例
+    "budget_min_retries": int(os.getenv("RETRY_BUDGET_MIN_RETRIES", "10")), # 低流量时至少允许的重试次数
+    "budget_window": 60,      # 重试预算统计窗口(秒)
+}
+
+# 文本响应缓存 (精确匹配，默认关闭)
+RESPONSE_CACHE_CONFIG = {
+    "enabled": os.getenv("RESPONSE_CACHE_ENABLED", "false").lower() == "true",
+    "ttl": float(os.getenv("RESPONSE_CACHE_TTL", "3600")),              # 过期时间(秒)
+    "max_entries": int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "10000")),
+    "max_mb": int(os.getenv("RESPONSE_CACHE_MAX_MB", "64")),             # 内存上限
+    "disk_path": os.getenv("RESPONSE_CACHE_DB_PATH", ""),                # 为空则不使用磁盘缓存
 }
 
+# 对冲请求: Provider超过历史延迟分位数仍未返回时并发请求Cookie，取先返回者 (默认关闭，请求可用hedge参数开启)
+HEDGING_CONFIG = {
+    "enabled": os.getenv("HEDGING_ENABLED", "false").lower() == "true",
+    "percentile": float(os.getenv("HEDGE_PERCENTILE", "0.95")),       # 对冲延迟取Provider延迟的分位数
+    "min_delay": float(os.getenv("HEDGE_MIN_DELAY", "0.5")),
+    "max_delay": float(os.getenv("HEDGE_MAX_DELAY", "10")),
+    "default_delay": float(os.getenv("HEDGE_DEFAULT_DELAY", "2")),    # 样本不足时使用
+    "budget_ratio": float(os.getenv("HEDGE_BUDGET_RATIO", "0.1")),    # 对冲请求占比上限
+    "budget_min": int(os.getenv("HEDGE_BUDGET_MIN", "5")),
+}
+
+# 并发相同请求合并 (single-flight)
+REQUEST_COALESCING_ENABLED = os.getenv("REQUEST_COALESCING_ENABLED", "true").lower() == "true"
+
 # Cookie持久化与告警
 try:
     from cookie_persistence import cookie_persistence, bark_notifier
@@ -92,8 +173,42 @@ PROVIDER_CONFIG = {
     "auth_token": os.getenv("PROVIDER_AUTH_TOKEN", "zxc6545398"),
     "default_model": os.getenv("PROVIDER_DEFAULT_MODEL", "gemini-3-flash-preview"),
     "timeout": int(os.getenv("PROVIDER_TIMEOUT", "10")),  # 快速失败，fallback到Cookie
+    # 连接池配置 (keep-alive复用，避免每次请求重新握手)
+    "pool_max_connections": int(os.getenv("PROVIDER_POOL_MAX_CONNECTIONS", "100")),
+    "pool_max_keepalive": int(os.getenv("PROVIDER_POOL_MAX_KEEPALIVE", "20")),
+    "pool_keepalive_expiry": float(os.getenv("PROVIDER_POOL_KEEPALIVE_EXPIRY", "30")),
+    "http2": os.getenv("PROVIDER_HTTP2", "false").lower() == "true",
+    # 熔断配置 (Provider不健康时直接走Cookie模式)
+    "breaker_window": float(os.getenv("PROVIDER_BREAKER_WINDOW", "60")),              # 统计窗口(秒)
+    "breaker_min_requests": int(os.getenv("PROVIDER_BREAKER_MIN_REQUESTS", "10")),
+    "breaker_error_rate": float(os.getenv("PROVIDER_BREAKER_ERROR_RATE", "0.5")),
+    "breaker_slow_call": float(os.getenv("PROVIDER_BREAKER_SLOW_CALL", "5")),         # 慢调用阈值(秒)
+    "breaker_slow_rate": float(os.getenv("PROVIDER_BREAKER_SLOW_RATE", "0.8")),
+    "breaker_open_duration": float(os.getenv("PROVIDER_BREAKER_OPEN_DURATION", "30")),
+    "breaker_probe_interval": float(os.getenv("PROVIDER_BREAKER_PROBE_INTERVAL", "10")),
 }
 
+# Provider共享连接池，lifespan中启动/关闭
+provider_http = PooledHTTPClient(
+    "provider",
+    timeout=PROVIDER_CONFIG["timeout"],
+    max_connections=PROVIDER_CONFIG["pool_max_connections"],
+    max_keepalive_connections=PROVIDER_CONFIG["pool_max_keepalive"],
+    keepalive_expiry=PROVIDER_CONFIG["pool_keepalive_expiry"],
+    http2=PROVIDER_CONFIG["http2"],
+)
+
+# Provider熔断器
+provider_breaker = CircuitBreaker(
+    "provider",
+    window=PROVIDER_CONFIG["breaker_window"],
+    min_requests=PROVIDER_CONFIG["breaker_min_requests"],
+    error_rate_threshold=PROVIDER_CONFIG["breaker_error_rate"],
+    slow_call_threshold=PROVIDER_CONFIG["breaker_slow_call"],
+    slow_rate_threshold=PROVIDER_CONFIG["breaker_slow_rate"],
+    open_duration=PROVIDER_CONFIG["breaker_open_duration"],
+)
+
 # Provider模型映射
 PROVIDER_MODEL_MAP = {
     # 文本模型
@@ -114,19 +229,94 @@ IMAGE_MODELS = [
     "gemini-3-pro-image-preview-4k",
 ]
 
+# 图片后处理流水线: 每阶段worker数与阶段间队列长度
+IMAGE_PIPELINE_CONFIG = {
+    "workers": {
+        "download": int(os.getenv("IMAGE_PIPELINE_DOWNLOAD_WORKERS", "8")),
+        "decode": int(os.getenv("IMAGE_PIPELINE_DECODE_WORKERS", "2")),
+        "watermark": int(os.getenv("IMAGE_PIPELINE_WATERMARK_WORKERS", "2")),
+        "encode": int(os.getenv("IMAGE_PIPELINE_ENCODE_WORKERS", "2")),
+        "deliver": int(os.getenv("IMAGE_PIPELINE_DELIVER_WORKERS", "4")),
+    },
+    "queue_size": int(os.getenv("IMAGE_PIPELINE_QUEUE_SIZE", "8")),
+}
+
+# 去水印后的重新编码: PNG快速压缩级别；可选JPEG/WebP源图保持原格式（体积小、编码快）
+WATERMARK_ENCODE_CONFIG = {
+    "png_compress_level": int(os.getenv("WATERMARK_PNG_COMPRESS_LEVEL", "1")),
+    "keep_source_format": os.getenv("WATERMARK_KEEP_SOURCE_FORMAT", "false").lower() == "true",
+    "quality": int(os.getenv("WATERMARK_QUALITY", "95")),
+}
+
+# 图片CPU计算(解码/去水印/编码)的进程数；0表示在服务进程的线程池中执行
+IMAGE_WORKER_PROCESSES = int(os.getenv("IMAGE_WORKER_PROCESSES", "0"))
+
+# 单次请求最多生成的图片数 (count>1 时并发发起多次生成)
+MAX_IMAGE_COUNT = int(os.getenv("MAX_IMAGE_COUNT", "4"))
+
+# 生成图片下载分辨率 (googleusercontent的 =sNNN 后缀，取最长边像素)
+DEFAULT_IMAGE_SIZE = int(os.getenv("DEFAULT_IMAGE_SIZE", "4096"))
+MAX_IMAGE_SIZE = 4096
+IMAGE_SIZE_PRESETS = {"1k": 1024, "2k": 2048, "4k": 4096}
+IMAGE_QUALITY_SIZES = {
+    "low": 1024,
+    "medium": 2048,
+    "standard": 2048,
+    "high": 4096,
+    "hd": 4096,
+}
+
+# 生成图片输出格式 (output_format / compression)；AVIF编码器不可用时回退WebP
+IMAGE_OUTPUT_FORMATS = {"png": "PNG", "jpeg": "JPEG", "jpg": "JPEG", "webp": "WEBP", "avif": "AVIF"}
+
 R2_CONFIG = {
-    "endpoint": "https://79e5a95d36e6e4084ae15fcc4220b127.r2.cloudflarestorage.com",
-    "access_key": "35f9ace41767c9ba5d4c60d804d0063a",
-    "secret_key": "cfff46ae5a409785f5dd87e5fe47d95a3d5682c661887b91c375b4a23edda8cb",
-    "bucket": "gemini",
-    "public_url": "https://pub-87cd59069cf0444aad048f7bddec99af.r2.dev",
-    "folder": "gemini-images"
+    "endpoint": os.getenv("R2_ENDPOINT", "https://79e5a95d36e6e4084ae15fcc4220b127.r2.cloudflarestorage.com"),
+    "access_key": os.getenv("R2_ACCESS_KEY", "35f9ace41767c9ba5d4c60d804d0063a"),
+    "secret_key": os.getenv("R2_SECRET_KEY", "cfff46ae5a409785f5dd87e5fe47d95a3d5682c661887b91c375b4a23edda8cb"),
+    "bucket": os.getenv("R2_BUCKET", "gemini"),
+    "public_url": os.getenv("R2_PUBLIC_URL", "https://pub-87cd59069cf0444aad048f7bddec99af.r2.dev"),
+    "folder": os.getenv("R2_FOLDER", "gemini-images"),
+    "max_concurrency": int(os.getenv("R2_UPLOAD_CONCURRENCY", "4")),     # 同时上传数
+    "multipart_threshold_mb": int(os.getenv("R2_MULTIPART_THRESHOLD_MB", "8")),  # 超过则分片上传
 }
 
-gemini_client = None
+# R2上传器，lifespan中创建客户端，上传在线程池中执行
+r2_uploader = R2Uploader(
+    endpoint=R2_CONFIG["endpoint"],
+    access_key=R2_CONFIG["access_key"],
+    secret_key=R2_CONFIG["secret_key"],
+    bucket=R2_CONFIG["bucket"],
+    public_url=R2_CONFIG["public_url"],
+    folder=R2_CONFIG["folder"],
+    max_concurrency=R2_CONFIG["max_concurrency"],
+    multipart_threshold=R2_CONFIG["multipart_threshold_mb"] * 1024 * 1024,
+)
+
+# 生成图片下载配置
+IMAGE_DOWNLOAD_CONFIG = {
+    "timeout": float(os.getenv("IMAGE_DOWNLOAD_TIMEOUT", "60")),
+    "connect_timeout": float(os.getenv("IMAGE_DOWNLOAD_CONNECT_TIMEOUT", "10")),
+    "max_connections": int(os.getenv("IMAGE_DOWNLOAD_MAX_CONNECTIONS", "32")),
+    "per_host_limit": int(os.getenv("IMAGE_DOWNLOAD_PER_HOST", "4")),       # 单主机并发下载数
+    "max_mb": int(os.getenv("IMAGE_DOWNLOAD_MAX_MB", "64")),                # 单张图片大小上限
+    "max_attempts": int(os.getenv("IMAGE_DOWNLOAD_ATTEMPTS", "3")),
+}
+
+# 图片下载器，所有端点共享连接池，lifespan中启动/关闭
+image_downloader = ImageDownloader(
+    timeout=IMAGE_DOWNLOAD_CONFIG["timeout"],
+    connect_timeout=IMAGE_DOWNLOAD_CONFIG["connect_timeout"],
+    max_connections=IMAGE_DOWNLOAD_CONFIG["max_connections"],
+    per_host_limit=IMAGE_DOWNLOAD_CONFIG["per_host_limit"],
+    max_bytes=IMAGE_DOWNLOAD_CONFIG["max_mb"] * 1024 * 1024,
+    max_attempts=IMAGE_DOWNLOAD_CONFIG["max_attempts"],
+)
+
+gemini_client = None  # 第一个可用账号的客户端，兼容单客户端代码 (claude_compat等)
 
 # ============ 水印去除器 ============
 watermark_remover = None
+image_backend = None  # ThreadImageBackend / ProcessImageBackend，init_image_processing中创建
 
 # ============ TTS 配置 ============
 TTS_CONFIG = {
@@ -165,173 +355,60 @@ class ClientError(GeminiAPIError):
     """4xx客户端错误 - 不重试"""
     pass
 
-# ============ 智能速率控制器 ============
-class SmartRateLimiter:
-    """带抖动的智能速率限制器"""
-
-    def __init__(self, rpm_limit: int = 60):
-        self.rpm_limit = rpm_limit
-        self.request_times: List[float] = []
-        self.consecutive_429s = 0
-        self.current_delay = RATE_LIMIT_CONFIG["base_delay"]
-        self._lock = asyncio.Lock()
-
-    async def acquire(self) -> float:
-        """获取请求许可，返回实际等待时间"""
-        async with self._lock:
-            now = time.time()
-            self.request_times = [t for t in self.request_times if now - t < 60]
-            if len(self.request_times) >= self.rpm_limit:
-                oldest = self.request_times[0]
-                wait_time = 60 - (now - oldest) + self._add_jitter()
-                if wait_time > 0:
-                    logger.info(f"RPM限制触发，等待 {wait_time:.1f}s")
-                    await asyncio.sleep(wait_time)
-            delay = self.current_delay + self._add_jitter()
-            if delay > 0:
-                await asyncio.sleep(delay)
-            self.request_times.append(time.time())
-            return delay
-
-    def _add_jitter(self) -> float:
-        return random.uniform(0, RATE_LIMIT_CONFIG["jitter_range"])
-
-    def report_success(self):
-        self.consecutive_429s = 0
-        self.current_delay = max(
-            RATE_LIMIT_CONFIG["base_delay"],
-            self.current_delay * 0.9
-        )
-
-    def report_rate_limit(self):
-        self.consecutive_429s += 1
-        self.current_delay = min(
-            RATE_LIMIT_CONFIG["max_delay"],
-            self.current_delay * RATE_LIMIT_CONFIG["backoff_multiplier"]
-        )
-        logger.warning(f"429错误，延迟调整为 {self.current_delay:.1f}s")
-
-    def get_stats(self) -> dict:
-        return {
-            "current_delay": round(self.current_delay, 2),
-            "requests_last_minute": len(self.request_times),
-            "consecutive_429s": self.consecutive_429s,
-            "rpm_limit": self.rpm_limit
-        }
-
-rate_limiter = SmartRateLimiter(rpm_limit=RATE_LIMIT_CONFIG["rpm_limit"])
+# ============ 多账号Cookie客户端池 (每个账号独立速率控制与并发槽位) ============
+cookie_pool = CookieClientPool(
+    default_max_concurrency=MAX_CONCURRENCY,
+    client_factory=GeminiClient,
+    rate_limit_config={
+        "rpm_limit": RATE_LIMIT_CONFIG["rpm_limit"],
+        "base_delay": RATE_LIMIT_CONFIG["base_delay"],
+        "max_delay": RATE_LIMIT_CONFIG["max_delay"],
+        "jitter_range": RATE_LIMIT_CONFIG["jitter_range"],
+        "backoff_multiplier": RATE_LIMIT_CONFIG["backoff_multiplier"],
+    },
+)
 
 # ============ 断点续传：SQLite任务状态管理 ============
-class TaskStateManager:
-    """SQLite任务状态管理器"""
-
-    def __init__(self, db_path: Path):
-        self.db_path = db_path
-        self._init_db()
-
-    def _init_db(self):
-        conn = sqlite3.connect(self.db_path)
-        conn.execute("""
-            CREATE TABLE IF NOT EXISTS tasks (
-                task_id TEXT PRIMARY KEY,
-                task_type TEXT NOT NULL,
-                status TEXT DEFAULT 'pending',
-                input_data TEXT,
-                output_data TEXT,
-                error_message TEXT,
-                retry_count INTEGER DEFAULT 0,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        conn.execute("CREATE INDEX IF NOT EXISTS idx_status ON tasks(status)")
-        conn.commit()
-        conn.close()
+task_manager = TaskStateManager(DB_PATH)
 
-    def create_task(self, task_id: str, task_type: str, input_data: str) -> bool:
-        conn = sqlite3.connect(self.db_path)
-        try:
-            conn.execute(
-                "INSERT INTO tasks (task_id, task_type, input_data) VALUES (?, ?, ?)",
-                (task_id, task_type, input_data)
-            )
-            conn.commit()
-            return True
-        except sqlite3.IntegrityError:
-            return False
-        finally:
-            conn.close()
-
-    def get_task(self, task_id: str) -> Optional[dict]:
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.execute("SELECT * FROM tasks WHERE task_id = ?", (task_id,))
-        row = cursor.fetchone()
-        conn.close()
-        return dict(row) if row else None
-
-    def update_task(self, task_id: str, status: str, output_data: str = None, error: str = None):
-        conn = sqlite3.connect(self.db_path)
-        if status == "completed":
-            conn.execute(
-                "UPDATE tasks SET status = ?, output_data = ?, updated_at = CURRENT_TIMESTAMP WHERE task_id = ?",
-                (status, output_data, task_id)
-            )
-        elif status == "failed":
-            conn.execute(
-                "UPDATE tasks SET status = ?, error_message = ?, retry_count = retry_count + 1, updated_at = CURRENT_TIMESTAMP WHERE task_id = ?",
-                (status, error, task_id)
-            )
-        else:
-            conn.execute(
-                "UPDATE tasks SET status = ?, updated_at = CURRENT_TIMESTAMP WHERE task_id = ?",
-                (status, task_id)
-            )
-        conn.commit()
-        conn.close()
-
-    def get_pending_tasks(self, task_type: str = None, limit: int = 100) -> List[dict]:
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        if task_type:
-            cursor = conn.execute(
-                "SELECT * FROM tasks WHERE status IN ('pending', 'processing') AND task_type = ? ORDER BY created_at LIMIT ?",
-                (task_type, limit)
-            )
-        else:
-            cursor = conn.execute(
-                "SELECT * FROM tasks WHERE status IN ('pending', 'processing') ORDER BY created_at LIMIT ?",
-                (limit,)
-            )
-        rows = cursor.fetchall()
-        conn.close()
-        return [dict(row) for row in rows]
-
-    def get_stats(self) -> dict:
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.execute("SELECT status, COUNT(*) as count FROM tasks GROUP BY status")
-        stats = {row[0]: row[1] for row in cursor.fetchall()}
-        conn.close()
-        return {
-            "pending": stats.get("pending", 0),
-            "processing": stats.get("processing", 0),
-            "completed": stats.get("completed", 0),
-            "failed": stats.get("failed", 0),
-            "total": sum(stats.values())
-        }
+# ============ 分层重试引擎 ============
+retry_engine = RetryEngine(RetryBudget(
+    ratio=RETRY_CONFIG["budget_ratio"],
+    min_retries=RETRY_CONFIG["budget_min_retries"],
+    window=RETRY_CONFIG["budget_window"],
+))
+retry_engine.add_policy("provider", RetryPolicy(
+    max_attempts=RETRY_CONFIG["provider_max_attempts"],
+    min_wait=1,
+    max_wait=5,
+    retry_on=(RateLimitError, ServerError),
+))
+retry_engine.add_policy("cookie", RetryPolicy(
+    max_attempts=RETRY_CONFIG["max_attempts"],
+    min_wait=RETRY_CONFIG["min_wait"],
+    max_wait=RETRY_CONFIG["max_wait"],
+    retry_on=(RateLimitError, ServerError),
+))
+
+# ============ 对冲请求 ============
+hedger = Hedger(
+    percentile=HEDGING_CONFIG["percentile"],
+    min_delay=HEDGING_CONFIG["min_delay"],
+    max_delay=HEDGING_CONFIG["max_delay"],
+    default_delay=HEDGING_CONFIG["default_delay"],
+    budget=RetryBudget(ratio=HEDGING_CONFIG["budget_ratio"], min_retries=HEDGING_CONFIG["budget_min"]),
+)
 
-    def cleanup_old_tasks(self, days: int = 7):
-        conn = sqlite3.connect(self.db_path)
-        conn.execute(
-            "DELETE FROM tasks WHERE status = 'completed' AND updated_at < datetime('now', ?)",
-            (f'-{days} days',)
-        )
-        deleted = conn.total_changes
-        conn.commit()
-        conn.close()
-        return deleted
+# ============ 并发请求合并 ============
+request_coalescer = RequestCoalescer()
 
-task_manager = TaskStateManager(DB_PATH)
+# ============ 文本响应缓存 ============
+response_cache = ResponseCache(
+    ttl=RESPONSE_CACHE_CONFIG["ttl"],
+    max_entries=RESPONSE_CACHE_CONFIG["max_entries"],
+    max_bytes=RESPONSE_CACHE_CONFIG["max_mb"] * 1024 * 1024,
+    disk_path=Path(RESPONSE_CACHE_CONFIG["disk_path"]) if RESPONSE_CACHE_CONFIG["disk_path"] else None,
+) if RESPONSE_CACHE_CONFIG["enabled"] else None
 
 # ============ TTS 工具函数 ============
 def convert_pcm_to_wav(pcm_data: bytes, sample_rate: int = 24000, channels: int = 1, sample_width: int = 2) -> bytes:
@@ -413,27 +490,96 @@ def generate_image_filename(prompt: str, index: int = 0) -> str:
     return f"{timestamp}_{keywords}_{short_hash}.png"
 
 
-async def upload_to_r2(image_bytes: bytes, filename: str) -> str:
-    import boto3
-    from botocore.config import Config
+async def upload_to_r2(image_bytes: bytes, filename: str, content_type: str = "image/png") -> str:
+    return await r2_uploader.upload(image_bytes, filename, content_type=content_type)
 
-    s3 = boto3.client(
-        's3',
-        endpoint_url=R2_CONFIG["endpoint"],
-        aws_access_key_id=R2_CONFIG["access_key"],
-        aws_secret_access_key=R2_CONFIG["secret_key"],
-        config=Config(signature_version='s3v4'),
-        region_name='auto'
-    )
 
-    key = f"{R2_CONFIG['folder']}/{filename}"
-    s3.put_object(
-        Bucket=R2_CONFIG["bucket"],
-        Key=key,
-        Body=image_bytes,
-        ContentType='image/png'
-    )
-    return f"{R2_CONFIG['public_url']}/{key}"
+def resolve_image_size(size: Optional[str] = None, quality: Optional[str] = None, model: Optional[str] = None) -> int:
+    """把 size/quality/模型变体 解析为下载分辨率(最长边像素)
+
+    优先级: size > quality > 模型 -2k/-4k 后缀 > DEFAULT_IMAGE_SIZE
+    size 支持 "1k"/"2k"/"4k"、"1024" 或 OpenAI 风格的 "1024x1024"；非法值抛出ValueError
+    """
+    if size and size.lower() != "auto":
+        value = size.strip().lower()
+        if value in IMAGE_SIZE_PRESETS:
+            return IMAGE_SIZE_PRESETS[value]
+        try:
+            pixels = max(int(v) for v in value.split("x"))
+        except ValueError:
+            raise ValueError(f"无效的size: {size}")
+        if pixels <= 0:
+            raise ValueError(f"无效的size: {size}")
+        return min(pixels, MAX_IMAGE_SIZE)
+
+    if quality and quality.lower() != "auto":
+        if quality.lower() not in IMAGE_QUALITY_SIZES:
+            raise ValueError(f"无效的quality: {quality}，可选: {', '.join(IMAGE_QUALITY_SIZES)}")
+        return IMAGE_QUALITY_SIZES[quality.lower()]
+
+    if model:
+        suffix = model.rsplit("-", 1)[-1].lower()
+        if suffix in IMAGE_SIZE_PRESETS:
+            return IMAGE_SIZE_PRESETS[suffix]
+
+    return DEFAULT_IMAGE_SIZE
+
+
+def resolve_output_encoding(output_format: Optional[str] = None,
+                            compression: Optional[int] = None) -> Tuple[Optional[str], Optional[int]]:
+    """把 output_format/compression 解析为(编码格式, 压缩参数)
+
+    output_format 支持 png/jpeg/webp/avif 或对应MIME(image/jpeg)；None表示服务默认(WATERMARK_*配置)
+    compression: PNG为压缩级别0-9(越大越小越慢)，JPEG/WebP/AVIF为质量1-100，必须与output_format同时指定
+    （未指定格式时实际格式取决于源图，含义不确定）；非法值抛出ValueError
+    """
+    fmt = None
+    if output_format:
+        value = output_format.strip().lower().removeprefix("image/")
+        if value not in IMAGE_OUTPUT_FORMATS:
+            raise ValueError(f"无效的output_format: {output_format}，可选: png, jpeg, webp, avif")
+        fmt = IMAGE_OUTPUT_FORMATS[value]
+
+    if compression is not None:
+        if fmt is None:
+            raise ValueError("指定compression时必须同时指定output_format")
+        try:
+            compression = int(compression)
+        except (TypeError, ValueError):
+            raise ValueError(f"无效的compression: {compression}")
+        low, high = (0, 9) if fmt == "PNG" else (1, 100)
+        if not low <= compression <= high:
+            raise ValueError(f"无效的compression: {compression}，{fmt} 取值范围 {low}-{high}")
+    return fmt, compression
+
+
+def sized_image_url(url: str, size: int) -> str:
+    """替换/追加 =sNNN 分辨率后缀"""
+    base = re.sub(r"=[swh]\d+[\w-]*$", "", url)
+    return f"{base}=s{size}"
+
+
+def image_mime_type(content_type: str) -> str:
+    if "jpeg" in content_type or "jpg" in content_type:
+        return "image/jpeg"
+    if "webp" in content_type:
+        return "image/webp"
+    return "image/png"
+
+
+async def download_generated_image(img, size: int = DEFAULT_IMAGE_SIZE) -> Optional[Tuple[bytes, str]]:
+    """下载生成的图片(按size分辨率)，返回(图片字节, MIME类型)；非URL图片或下载失败时返回None"""
+    if not (hasattr(img, "url") and img.url):
+        return None
+    download_url = sized_image_url(img.url, size)
+    try:
+        image_bytes, content_type = await image_downloader.download(
+            download_url, cookies=getattr(img, "cookies", {}) or {}
+        )
+    except DownloadError as e:
+        logger.warning(f"⚠️ 图片下载失败: {e}")
+        return None
+    return image_bytes, image_mime_type(content_type)
 
 
 # ============ Provider API调用 ============
@@ -460,108 +606,290 @@ async def call_provider_api(prompt: str, model: str = None, image_mode: bool = F
     if image_mode:
         data["generationConfig"] = {"responseModalities": ["IMAGE", "TEXT"]}
 
-    async with httpx.AsyncClient(timeout=PROVIDER_CONFIG["timeout"]) as client:
-        response = await client.post(url, headers=headers, json=data)
+    response = await provider_http.post(url, headers=headers, json=data)
+
+    if response.status_code == 429:
+        raise RateLimitError(f"Provider rate limit: {response.text}")
+    elif response.status_code >= 500:
+        raise ServerError(f"Provider server error: {response.text}")
+    elif response.status_code != 200:
+        raise ClientError(f"Provider error ({response.status_code}): {response.text}")
+
+    return response.json()
+
+
+class ProviderResponse:
+    """Provider响应的兼容对象 (与Cookie模式的text/images一致)"""
+
+    def __init__(self, parts: List[dict]):
+        self.text = ""
+        self.images = []
+        for p in parts:
+            if "text" in p:
+                self.text += p["text"]
+            if "inlineData" in p:
+                self.images.append(p["inlineData"])
+
+
+def parse_provider_response(result: dict) -> ProviderResponse:
+    candidates = result.get("candidates")
+    if candidates and "content" in candidates[0]:
+        return ProviderResponse(candidates[0]["content"]["parts"])
+    raise ClientError(f"Provider返回格式异常: {result}")
 
-        if response.status_code == 429:
-            raise RateLimitError(f"Provider rate limit: {response.text}")
-        elif response.status_code >= 500:
-            raise ServerError(f"Provider server error: {response.text}")
-        elif response.status_code != 200:
-            raise ClientError(f"Provider error ({response.status_code}): {response.text}")
 
-        return response.json()
+async def probe_provider() -> bool:
+    """熔断期间的轻量探活：查询默认模型信息，不消耗生成配额"""
+    provider_model = PROVIDER_MODEL_MAP.get(PROVIDER_CONFIG["default_model"], PROVIDER_CONFIG["default_model"])
+    response = await provider_http.get(
+        f"{PROVIDER_CONFIG['base_url']}/models/{provider_model}",
+        headers={"Authorization": f"Bearer {PROVIDER_CONFIG['auth_token']}"},
+    )
+    return response.status_code < 500 and response.status_code != 429
+
+
+async def stream_provider_api(prompt: str, model: str = None) -> AsyncGenerator[dict, None]:
+    """流式调用Provider API (streamGenerateContent?alt=sse)，逐块产出响应JSON"""
+    if not PROVIDER_CONFIG["enabled"]:
+        raise Exception("Provider模式未启用")
+
+    model = model or PROVIDER_CONFIG["default_model"]
+    provider_model = PROVIDER_MODEL_MAP.get(model, model)
+
+    url = f"{PROVIDER_CONFIG['base_url']}/models/{provider_model}:streamGenerateContent"
+    headers = {
+        "Authorization": f"Bearer {PROVIDER_CONFIG['auth_token']}",
+        "Content-Type": "application/json"
+    }
+    data = {
+        "contents": [{"parts": [{"text": prompt}]}]
+    }
+
+    async with provider_http.stream("POST", url, params={"alt": "sse"}, headers=headers, json=data) as response:
+        if response.status_code != 200:
+            error_text = (await response.aread()).decode("utf-8", errors="replace")
+            if response.status_code == 429:
+                raise RateLimitError(f"Provider rate limit: {error_text}")
+            elif response.status_code >= 500:
+                raise ServerError(f"Provider server error: {error_text}")
+            raise ClientError(f"Provider error ({response.status_code}): {error_text}")
+
+        async for line in response.aiter_lines():
+            if not line.startswith("data:"):
+                continue
+            payload = line[5:].strip()
+            if payload:
+                yield json.loads(payload)
 
 
 # ============ 带重试的Gemini调用 (双模式) ============
-@retry(
-    retry=retry_if_exception_type((RateLimitError, ServerError)),
-    wait=wait_exponential(
-        multiplier=1,
-        min=RETRY_CONFIG["min_wait"],
-        max=RETRY_CONFIG["max_wait"]
-    ),
-    stop=stop_after_attempt(RETRY_CONFIG["max_attempts"]),
-    before_sleep=before_sleep_log(logger, logging.WARNING)
-)
-async def call_gemini_with_retry(prompt: str, files: List[str] = None, model=None, image_mode: bool = False):
-    """带智能重试的Gemini API调用 - Provider优先，Cookie备用"""
-    global gemini_client, rate_limiter
+async def call_provider_once(prompt: str, model: str) -> ProviderResponse:
+    """单次Provider调用，结果计入熔断统计"""
+    started = time.monotonic()
+    try:
+        logger.info(f"[Provider] 调用模型: {model}")
+        response = parse_provider_response(await call_provider_api(prompt, model=model))
+    except asyncio.CancelledError:
+        provider_breaker.release()
+        # 对冲落败被取消: 真实耗时未知，按已耗时记为删失样本，避免对冲延迟只由快请求决定
+        hedger.record_latency(time.monotonic() - started, censored=True)
+        raise
+    except ClientError:
+        # 4xx说明Provider可达，不计入熔断错误率
+        provider_breaker.record_success(time.monotonic() - started)
+        raise
+    except Exception:
+        # 429/5xx/超时/连接错误计入熔断统计
+        provider_breaker.record_failure(time.monotonic() - started)
+        raise
+    latency = time.monotonic() - started
+    provider_breaker.record_success(latency)
+    hedger.record_latency(latency)
+    return response
+
+
+async def call_cookie_once(prompt: str, files: List[str] = None, model=None):
+    """单次Cookie模式调用：选择账号、占用槽位并遵守账号速率限制"""
+    try:
+        async with cookie_pool.acquire() as account:
+            await account.rate_limiter.acquire()
+
+            try:
+                from gemini_webapi.constants import Model
+                cookie_model = model or Model.G_2_5_FLASH
+
+                logger.info(f"[Cookie:{account.name}] 调用模型: {cookie_model}")
 
+                if files:
+                    response = await account.client.generate_content(prompt, files=files, model=cookie_model)
+                else:
+                    response = await account.client.generate_content(prompt, model=cookie_model)
+
+                account.report_success()
+                return response
+
+            except Exception as e:
+                raise classify_cookie_error(account, e)
+    except NoAvailableAccountError as e:
+        raise ClientError(str(e))
+
+
+async def _call_gemini_with_retry(
+    prompt: str,
+    files: List[str] = None,
+    model=None,
+    image_mode: bool = False,
+    hedge: bool = False,
+):
+    """带智能重试的Gemini API调用 - Provider优先，Cookie备用
+
+    Provider和Cookie各自按策略重试，共用同一个请求截止时间；Cookie重试不会再次调用Provider。
+    重试次数/截止时间/重试预算耗尽时抛出 RetryError。
+    hedge=True 时Provider超过对冲延迟未返回即并发请求Cookie，取先成功者。
+    """
+    deadline = time.monotonic() + RETRY_CONFIG["deadline"]
     model_str = str(model) if model else "gemini-2.5-flash"
 
+    def call_provider():
+        return retry_engine.call("provider", lambda: call_provider_once(prompt, model_str), deadline=deadline)
+
+    def call_cookie():
+        return retry_engine.call("cookie", lambda: call_cookie_once(prompt, files=files, model=model), deadline=deadline)
+
     # ========== 文本模型: Provider优先 ==========
     # 图片/视频模型只用Cookie，文本模型用Provider优先
+    # Provider熔断时直接走Cookie，不再等待超时
     if PROVIDER_CONFIG["enabled"] and not files and not image_mode:
-        try:
-            logger.info(f"[Provider] 调用模型: {model_str}")
-            result = await call_provider_api(prompt, model=model_str, image_mode=image_mode)
-
-            # 解析Provider响应
-            if "candidates" in result:
-                candidates = result["candidates"]
-                if candidates and "content" in candidates[0]:
-                    parts = candidates[0]["content"]["parts"]
-                    # 构造兼容的响应对象
-                    class ProviderResponse:
-                        def __init__(self, parts):
-                            self.text = ""
-                            self.images = []
-                            for p in parts:
-                                if "text" in p:
-                                    self.text += p["text"]
-                                if "inlineData" in p:
-                                    self.images.append(p["inlineData"])
-                    return ProviderResponse(parts)
-
-            raise ClientError(f"Provider返回格式异常: {result}")
-
-        except Exception as e:
-            error_str = str(e).lower()
-            # 429/500错误时fallback到Cookie模式
-            if "429" in error_str or "500" in error_str or "503" in error_str:
-                logger.warning(f"[Provider] 错误，尝试Cookie模式: {e}")
-            else:
-                # 其他错误也尝试fallback
+        if not provider_breaker.allow_request():
+            logger.info(f"[Provider] 熔断中({provider_breaker.state})，直接使用Cookie模式")
+        else:
+            try:
+                if hedge and cookie_pool.ready:
+                    return await hedger.run(call_provider, call_cookie)
+                return await call_provider()
+            except HedgeFailedError as e:
+                # 对冲的Cookie请求也已失败，不再重复走Cookie
+                raise e.error
+            except Exception as e:
                 logger.warning(f"[Provider] 失败，fallback到Cookie: {e}")
 
     # ========== Cookie模式 (备用) ==========
-    if not gemini_client:
+    if not cookie_pool.ready:
         raise ClientError("Gemini客户端未初始化，且Provider模式不可用")
 
-    async with REQUEST_SEMAPHORE:
-        await rate_limiter.acquire()
+    return await call_cookie()
 
-        try:
-            from gemini_webapi.constants import Model
-            cookie_model = model or Model.G_2_5_FLASH
 
-            logger.info(f"[Cookie] 调用模型: {cookie_model}")
+async def generate_text_cached(
+    prompt: str,
+    model: str,
+    config: Optional[dict] = None,
+    http_request: Optional[Request] = None,
+    hedge: Optional[bool] = None,
+) -> str:
+    """文本生成，启用响应缓存时先查缓存
 
-            if files:
-                response = await gemini_client.generate_content(prompt, files=files, model=cookie_model)
-            else:
-                response = await gemini_client.generate_content(prompt, model=cookie_model)
+    请求头 Cache-Control: no-cache 跳过读取缓存(结果仍写入)，no-store 既不读也不写
+    """
+    if response_cache is None:
+        response = await call_gemini_with_retry(prompt, model=model, hedge=hedge)
+        return response.text
 
-            rate_limiter.report_success()
-            return response
+    cache_control = http_request.headers.get("cache-control", "").lower() if http_request else ""
+    no_store = "no-store" in cache_control
+    key = response_cache.make_key(prompt, model, config)
 
-        except Exception as e:
-            error_str = str(e).lower()
+    if no_store or "no-cache" in cache_control:
+        response_cache.bypasses += 1
+    else:
+        cached = await response_cache.get(key)
+        if cached is not None:
+            return cached
+
+    response = await call_gemini_with_retry(prompt, model=model, hedge=hedge)
+    if response.text and not no_store:
+        await response_cache.set(key, response.text)
+    return response.text
+
+
+async def call_gemini_with_retry(
+    prompt: str,
+    files: List[str] = None,
+    model=None,
+    image_mode: bool = False,
+    coalesce: Optional[bool] = None,
+    hedge: Optional[bool] = None,
+):
+    """Gemini调用入口：相同的并发文本请求合并为一次上游调用
+
+    coalesce 为None时只合并文本请求：图片生成每次调用都应得到不同的图片
+    （批量中重复的prompt、count>1 等），合并会让它们共享同一张图
+    hedge 为None时使用 HEDGING_ENABLED 配置
+    """
+    coalesce = not image_mode if coalesce is None else coalesce
+    hedge = HEDGING_CONFIG["enabled"] if hedge is None else hedge
+
+    def call():
+        return _call_gemini_with_retry(prompt, files=files, model=model, image_mode=image_mode, hedge=hedge)
+
+    if not (coalesce and REQUEST_COALESCING_ENABLED):
+        return await call()
+
+    if files:
+        # 键包含文件内容摘要，读盘与哈希放到线程中执行，不阻塞事件循环
+        key = await asyncio.to_thread(request_coalescer.make_key, prompt, model, files, image_mode)
+    else:
+        key = request_coalescer.make_key(prompt, model, None, image_mode)
+    return await request_coalescer.run(key, call)
+
+
+def classify_cookie_error(account, error: Exception) -> GeminiAPIError:
+    """记录账号失败并把Cookie模式异常转换为可重试/不可重试异常"""
+    error_str = str(error).lower()
 
-            if "429" in error_str or "rate" in error_str or "quota" in error_str:
-                rate_limiter.report_rate_limit()
-                raise RateLimitError(f"Rate limit: {e}")
-            elif "500" in error_str or "503" in error_str or "server" in error_str:
-                raise ServerError(f"Server error: {e}")
+    if "429" in error_str or "rate" in error_str or "quota" in error_str:
+        account.report_failure(error, rate_limited=True)
+        return RateLimitError(f"Rate limit: {error}")
+    account.report_failure(error)
+    if "500" in error_str or "503" in error_str or "server" in error_str:
+        return ServerError(f"Server error: {error}")
+    return ClientError(f"Client error: {error}")
+
+
+async def stream_cookie_api(prompt: str, model=None) -> AsyncGenerator[str, None]:
+    """Cookie模式流式生成，逐块产出新增文本；客户端不支持流式时一次性产出全文"""
+    if not cookie_pool.ready:
+        raise ClientError("Gemini客户端未初始化，且Provider模式不可用")
+
+    async with cookie_pool.acquire() as account:
+        await account.rate_limiter.acquire()
+
+        from gemini_webapi.constants import Model
+        cookie_model = model or Model.G_2_5_FLASH
+        logger.info(f"[Cookie:{account.name}] 流式调用模型: {cookie_model}")
+
+        try:
+            if hasattr(account.client, "generate_content_stream"):
+                async for output in account.client.generate_content_stream(prompt, model=cookie_model):
+                    delta = getattr(output, "text_delta", None)
+                    if delta:
+                        yield delta
             else:
-                raise ClientError(f"Client error: {e}")
+                response = await account.client.generate_content(prompt, model=cookie_model)
+                if response.text:
+                    yield response.text
+            account.report_success()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            raise classify_cookie_error(account, e)
 
 
 # ============ Pydantic Models ============
 class GenerateRequest(BaseModel):
     prompt: str
     model: str = "gemini-2.5-flash"
+    hedge: Optional[bool] = None  # 对冲请求，默认跟随 HEDGING_ENABLED
 
 class GenerateResponse(BaseModel):
     text: str
@@ -572,15 +900,23 @@ class ImageGenerateRequest(BaseModel):
     count: int = 1
     response_type: str = "base64"
     image: Optional[str] = None
+    size: Optional[str] = None      # "1k"/"2k"/"4k"、"1024" 或 "1024x1024"，默认4096
+    quality: Optional[str] = None   # low/medium/standard/high/hd，未指定size时生效
+    output_format: Optional[str] = None  # png/jpeg/webp/avif，默认PNG
+    compression: Optional[int] = None    # PNG: 压缩级别0-9；JPEG/WebP/AVIF: 质量1-100
 
 class ImageGenerateResponse(BaseModel):
     images: List[str]
     model: str = "gemini-2.5-flash"
+    errors: List[Dict[str, Any]] = []  # count>1 时部分失败的生成: [{"index", "error"}]
 
 class BatchImageRequest(BaseModel):
     prompts: List[str]
     response_type: str = "url"
-    concurrency: int = 2
+    concurrency: int = 2  # 兼容字段，批量并发由 BATCH_CONCURRENCY / 账号槽位统一控制
+    callback_url: Optional[str] = None  # 每个任务及整个批次结束后POST结果
+    output_format: Optional[str] = None  # 同 /v1/generate-images
+    compression: Optional[int] = None
 
 class BatchImageResponse(BaseModel):
     batch_id: str
@@ -653,31 +989,90 @@ class GeminiRequest(BaseModel):
 
 class CookieRequest(BaseModel):
     cookies: Dict[str, str]
+    account: str = DEFAULT_COOKIE_ACCOUNT
+    max_concurrency: Optional[int] = None
+    rpm_limit: Optional[int] = None
 
 
 # ============ 客户端初始化 ============
-async def init_gemini_client():
+def _sync_primary_client():
     global gemini_client
-    if gemini_client:
-        try:
-            await gemini_client.close()
-        except:
-            pass
-    gemini_client = GeminiClient()
-    gemini_client.cookies = {
-        "__Secure-1PSID": cookie_store.get("__Secure-1PSID"),
-        "__Secure-1PSIDCC": cookie_store.get("__Secure-1PSIDCC"),
-        "__Secure-1PSIDTS": cookie_store.get("__Secure-1PSIDTS")
-    }
-    await gemini_client.init()
+    gemini_client = cookie_pool.primary_client()
+
+
+async def init_gemini_client(account: str = DEFAULT_COOKIE_ACCOUNT, cookies: Dict[str, str] = None,
+                             max_concurrency: int = None, rpm_limit: int = None):
+    """初始化(或替换)一个Cookie账号的客户端，默认账号使用cookie_store"""
+    try:
+        await cookie_pool.add_account(
+            account,
+            cookies if cookies is not None else cookie_store,
+            max_concurrency=max_concurrency,
+            rpm_limit=rpm_limit,
+        )
+    finally:
+        _sync_primary_client()
     return True
 
 
+async def init_cookie_accounts():
+    """从账号配置文件初始化额外的Cookie账号（API进程与独立batch worker共用）"""
+    if not COOKIE_ACCOUNTS_PATH:
+        return
+    for entry in CookieClientPool.load_accounts_file(Path(COOKIE_ACCOUNTS_PATH)):
+        try:
+            await init_gemini_client(
+                entry["name"],
+                entry["cookies"],
+                max_concurrency=entry.get("max_concurrency"),
+                rpm_limit=entry.get("rpm_limit"),
+            )
+            print(f"✅ Cookie账号 {entry['name']} 初始化成功!")
+        except Exception as e:
+            print(f"⚠️ Cookie账号 {entry['name']} 初始化失败: {e}")
+
+
+async def init_image_processing():
+    """初始化水印去除器、图片计算后端并启动图片流水线（API进程与独立batch worker共用）"""
+    global watermark_remover, image_backend
+    try:
+        from watermark_remover import WatermarkRemover
+        watermark_remover = WatermarkRemover(**WATERMARK_ENCODE_CONFIG)
+        print("✅ 水印去除器初始化成功!")
+        if IMAGE_WORKER_PROCESSES > 0:
+            image_backend = ProcessImageBackend(IMAGE_WORKER_PROCESSES, watermark_remover)
+            image_backend.start()
+            print(f"✅ 图片计算进程池已启动 ({IMAGE_WORKER_PROCESSES}进程)")
+        else:
+            image_backend = ThreadImageBackend(watermark_remover)
+    except Exception as e:
+        print(f"⚠️ 水印去除器初始化失败: {e}")
+
+    await image_pipeline.start()
+    print(f"✅ 图片处理流水线已启动 (workers={IMAGE_PIPELINE_CONFIG['workers']})")
+
+
+async def close_image_processing():
+    """停止图片流水线并关闭计算后端（先停流水线，进行中的共享内存由后端统一释放）"""
+    global image_backend
+    await image_pipeline.stop()
+    if image_backend:
+        image_backend.close()
+        image_backend = None
+
+
+def save_cookie_accounts():
+    """把默认账号以外的账号写回账号配置文件（热添加/移除后持久化）"""
+    if COOKIE_ACCOUNTS_PATH:
+        cookie_pool.save_accounts_file(Path(COOKIE_ACCOUNTS_PATH), exclude=(DEFAULT_COOKIE_ACCOUNT,))
+
+
 # ============ Cookie获取回调 ============
 def get_current_cookies() -> dict:
-    """获取当前gemini_client的Cookie（用于持久化）"""
-    if gemini_client and hasattr(gemini_client, 'cookies'):
-        return gemini_client.cookies
+    """获取默认账号客户端的Cookie（用于持久化）"""
+    account = cookie_pool.get(DEFAULT_COOKIE_ACCOUNT)
+    if account and account.client and hasattr(account.client, 'cookies'):
+        return account.client.cookies
     return cookie_store
 
 
@@ -685,15 +1080,19 @@ def get_current_cookies() -> dict:
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """应用生命周期管理"""
-    global REQUEST_SEMAPHORE, watermark_remover
-
     cookie_save_task = None
 
     print("=" * 50)
     print("Gemini Reverse API v4.1 启动中...")
     print("=" * 50)
 
-    REQUEST_SEMAPHORE = asyncio.Semaphore(MAX_CONCURRENCY)
+    provider_probe_task = None
+    if PROVIDER_CONFIG["enabled"]:
+        await provider_http.start()
+        provider_probe_task = asyncio.create_task(
+            provider_breaker.probe_loop(probe_provider, PROVIDER_CONFIG["breaker_probe_interval"])
+        )
+        print(f"✅ Provider连接池已启动 (max={PROVIDER_CONFIG['pool_max_connections']}, http2={PROVIDER_CONFIG['http2']})")
 
     if cookie_store.get("__Secure-1PSID"):
         try:
@@ -715,6 +1114,9 @@ async def lifespan(app: FastAPI):
     else:
         print("⚠️ 未配置Cookie，请通过Web界面配置")
 
+    # 额外的Cookie账号
+    await init_cookie_accounts()
+
     # TTS状态
     if GOOGLE_AI_API_KEY:
         print(f"✅ TTS功能已启用 (API Key: {GOOGLE_AI_API_KEY[:15]}...)")
@@ -728,21 +1130,42 @@ async def lifespan(app: FastAPI):
     except Exception as e:
         print(f"⚠️ Claude 兼容层加载失败: {e}")
 
-    print(f"✅ 并发限制: {MAX_CONCURRENCY}")
+    print(f"✅ 并发限制: 每账号{MAX_CONCURRENCY}，共{len(cookie_pool.accounts)}个账号/{cookie_pool.total_slots}槽位")
     print(f"✅ 断点续传数据库: {DB_PATH}")
 
+    counts_resync_task = None
+    retention_task = asyncio.create_task(task_retention_loop(TASK_RETENTION_CONFIG["interval"]))
+    print(f"✅ 任务保留期: {TASK_RETENTION_CONFIG['days']}天 (过期任务与无引用blob每{TASK_RETENTION_CONFIG['interval']:.0f}s清理)")
+    if BATCH_QUEUE_CONFIG["mode"] == "external":
+        # 任务由其他进程完成，内存计数需定期与数据库对齐
+        counts_resync_task = asyncio.create_task(resync_counts_loop(BATCH_QUEUE_CONFIG["resync_interval"]))
+        print("✅ 批量任务由独立worker进程处理 (python -m batch_worker)")
+    else:
+        await batch_queue.start()
+        print(f"✅ 批量任务队列已启动 (worker={batch_queue.worker_id})")
+
+    await webhook_dispatcher.start()
+    print(f"✅ Webhook投递器已启动 (并发={WEBHOOK_CONFIG['concurrency']}, 签名={bool(WEBHOOK_CONFIG['secret'])})")
+
     # Bark通知状态
     if bark_notifier and bark_notifier.enabled:
         print("✅ Bark通知已启用!")
     else:
         print("⚠️ Bark通知未配置")
 
+    await image_downloader.start()
+    print(f"✅ 图片下载连接池已启动 (单主机并发={IMAGE_DOWNLOAD_CONFIG['per_host_limit']})")
+
     try:
-        from watermark_remover import WatermarkRemover
-        watermark_remover = WatermarkRemover()
-        print("✅ 水印去除器初始化成功!")
+        r2_uploader.start()
+        print(f"✅ R2上传器已启动 (并发={R2_CONFIG['max_concurrency']})")
     except Exception as e:
-        print(f"⚠️ 水印去除器初始化失败: {e}")
+        print(f"⚠️ R2上传器初始化失败: {e}")
+
+    if response_cache:
+        print(f"✅ 文本响应缓存已启用 (TTL={RESPONSE_CACHE_CONFIG['ttl']:.0f}s, 磁盘={bool(RESPONSE_CACHE_CONFIG['disk_path'])})")
+
+    await init_image_processing()
 
     print("=" * 50)
     print("API 端点:")
@@ -755,6 +1178,14 @@ async def lifespan(app: FastAPI):
 
     yield
 
+    # 先停止批量队列并归还租约，再关闭它依赖的客户端
+    retention_task.cancel()
+    if counts_resync_task:
+        counts_resync_task.cancel()
+    else:
+        await batch_queue.stop()
+    await webhook_dispatcher.stop()
+
     # 关闭时保存最新Cookie
     if COOKIE_PERSISTENCE_ENABLED and cookie_persistence:
         cookies = get_current_cookies()
@@ -764,8 +1195,18 @@ async def lifespan(app: FastAPI):
         if cookie_save_task:
             cookie_save_task.cancel()
 
-    if gemini_client:
-        await gemini_client.close()
+    await cookie_pool.close()
+    _sync_primary_client()
+
+    if provider_probe_task:
+        provider_probe_task.cancel()
+    await provider_http.close()
+    await close_image_processing()
+    await image_downloader.close()
+    r2_uploader.close()
+    task_manager.close()
+    if response_cache:
+        response_cache.close()
 
 app = FastAPI(title="Gemini Reverse API v4.2 (Hybrid)", lifespan=lifespan)
 
@@ -780,21 +1221,38 @@ async def health():
         "provider": {
             "enabled": PROVIDER_CONFIG["enabled"],
             "model": PROVIDER_CONFIG["default_model"] if PROVIDER_CONFIG["enabled"] else None,
-            "usage": "文本模型优先"
+            "usage": "文本模型优先",
+            "pool": provider_http.get_stats(),
+            "breaker": provider_breaker.get_stats()
         },
         "cookie": {
-            "ready": gemini_client is not None,
-            "usage": "图片/视频模型 + Provider备用"
+            "ready": cookie_pool.ready,
+            "usage": "图片/视频模型 + Provider备用",
+            "pool": cookie_pool.get_stats()
         },
         "tts_ready": bool(GOOGLE_AI_API_KEY),
         "watermark_removal": watermark_remover is not None,
         "cookie_persistence": COOKIE_PERSISTENCE_ENABLED,
         "bark_notification": bark_notifier.enabled if bark_notifier else False,
-        "rate_limiter": rate_limiter.get_stats(),
+        "image_download": image_downloader.get_stats(),
+        "image_pipeline": {**image_pipeline.get_stats(), "backend": image_backend.get_stats() if image_backend else None},
+        "r2": r2_uploader.get_stats(),
+        "response_cache": response_cache.get_stats() if response_cache else {"enabled": False},
+        "retry": retry_engine.get_stats(),
+        "hedging": {"enabled": HEDGING_CONFIG["enabled"], **hedger.get_stats()},
+        "coalescing": {"enabled": REQUEST_COALESCING_ENABLED, **request_coalescer.get_stats()},
         "task_stats": task_manager.get_stats(),
+        "batch_queue": {**batch_queue.get_stats(), "mode": BATCH_QUEUE_CONFIG["mode"]},
+        "blob_store": blob_store.get_stats(),
+        "batch_events": batch_event_bus.get_stats(),
+        "webhooks": webhook_dispatcher.get_stats(),
         "concurrency": {
-            "max": MAX_CONCURRENCY,
-            "available": REQUEST_SEMAPHORE._value if REQUEST_SEMAPHORE else 0
+            "max": cookie_pool.total_slots,
+            "per_account": MAX_CONCURRENCY,
+            "available": sum(
+                max(0, a.max_concurrency - a.in_flight)
+                for a in cookie_pool.accounts.values() if a.client is not None
+            )
         }
     }
 
@@ -820,7 +1278,7 @@ async def api_info():
             "retry": "指数退避重试 (最多5次)",
             "rate_limit": "智能速率控制 + 抖动",
             "checkpoint": "SQLite断点续传",
-            "concurrency": f"支持{MAX_CONCURRENCY}并发",
+            "concurrency": f"多账号Cookie池，每账号{MAX_CONCURRENCY}并发",
             "watermark_removal": "反向Alpha混合去水印",
             "tts": "TTS语音合成 (需要API Key)",
             "pdf_analysis": "PDF文档分析",
@@ -874,16 +1332,21 @@ async def get_models_openai():
 
 @app.get("/api/cookies/status")
 async def get_cookie_status():
-    has_cookie = bool(cookie_store.get("__Secure-1PSID"))
-    client_ready = gemini_client is not None
+    has_cookie = bool(cookie_store.get("__Secure-1PSID")) or bool(cookie_pool.accounts)
+    client_ready = cookie_pool.ready
+    accounts = [
+        {"name": a.name, "ready": a.client is not None, "healthy": a.is_healthy()}
+        for a in cookie_pool.accounts.values()
+    ]
     if not has_cookie:
-        return {"valid": False, "message": "未配置Cookie"}
+        return {"valid": False, "message": "未配置Cookie", "accounts": accounts}
     if not client_ready:
-        return {"valid": False, "message": "Cookie已配置但客户端未初始化"}
-    return {"valid": True, "message": "Cookie有效，客户端已就绪"}
+        return {"valid": False, "message": "Cookie已配置但客户端未初始化", "accounts": accounts}
+    return {"valid": True, "message": "Cookie有效，客户端已就绪", "accounts": accounts}
 
 @app.post("/api/cookies")
 async def save_cookies(request: CookieRequest):
+    """保存Cookie并(重新)初始化账号；account不存在时热添加新账号"""
     global cookie_store
     cookies = request.cookies
     psid = cookies.get("__Secure-1PSID") or cookies.get("SECURE_1PSID") or cookies.get("1PSID")
@@ -891,27 +1354,49 @@ async def save_cookies(request: CookieRequest):
     psidts = cookies.get("__Secure-1PSIDTS") or cookies.get("SECURE_1PSIDTS") or cookies.get("1PSIDTS")
     if not psid:
         raise HTTPException(status_code=400, detail="__Secure-1PSID 是必填项")
-    cookie_store["__Secure-1PSID"] = psid
-    cookie_store["__Secure-1PSIDCC"] = psidcc
-    cookie_store["__Secure-1PSIDTS"] = psidts
+    account_cookies = {
+        "__Secure-1PSID": psid,
+        "__Secure-1PSIDCC": psidcc,
+        "__Secure-1PSIDTS": psidts
+    }
+    if request.account == DEFAULT_COOKIE_ACCOUNT:
+        cookie_store.update(account_cookies)
     try:
-        await init_gemini_client()
-        return {"success": True, "message": "Cookie保存成功，客户端已重新初始化"}
+        await init_gemini_client(
+            request.account,
+            account_cookies,
+            max_concurrency=request.max_concurrency,
+            rpm_limit=request.rpm_limit,
+        )
+        save_cookie_accounts()
+        return {"success": True, "account": request.account, "message": "Cookie保存成功，客户端已重新初始化"}
     except Exception as e:
-        return {"success": False, "message": f"Cookie已保存，但初始化失败: {str(e)}"}
+        return {"success": False, "account": request.account, "message": f"Cookie已保存，但初始化失败: {str(e)}"}
+
+@app.delete("/api/cookies/{account}")
+async def delete_cookie_account(account: str):
+    """热移除Cookie账号"""
+    removed = await cookie_pool.remove_account(account)
+    _sync_primary_client()
+    if not removed:
+        raise HTTPException(status_code=404, detail=f"账号不存在: {account}")
+    save_cookie_accounts()
+    return {"success": True, "account": account, "message": "账号已移除"}
 
 
 # ============ 文本生成 ============
 @app.post("/v1/generate", response_model=GenerateResponse)
-async def generate(request: GenerateRequest):
+async def generate(request: GenerateRequest, http_request: Request):
     # v4.2: Provider模式不需要gemini_client
     if not gemini_client and not PROVIDER_CONFIG["enabled"]:
         raise HTTPException(status_code=503, detail="Gemini客户端未初始化且Provider未启用")
     try:
-        response = await call_gemini_with_retry(request.prompt, model=request.model)
-        return GenerateResponse(text=response.text, model=request.model)
+        text = await generate_text_cached(request.prompt, request.model, http_request=http_request, hedge=request.hedge)
+        return GenerateResponse(text=text, model=request.model)
     except RetryError as e:
         raise HTTPException(status_code=429, detail=f"重试{RETRY_CONFIG['max_attempts']}次后仍失败: {e}")
+    except DeadlineExceededError as e:
+        raise HTTPException(status_code=504, detail=str(e))
     except ClientError as e:
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
@@ -919,14 +1404,62 @@ async def generate(request: GenerateRequest):
 
 
 # ============ 图片生成 ============
+# 下载/去水印/编码/上传分阶段并行，多张图片之间IO与CPU重叠；函数延迟绑定，便于lifespan中替换组件
+image_pipeline = ImagePipeline(
+    download=lambda img, size: download_generated_image(img, size),
+    upload=lambda data, filename, mime: upload_to_r2(data, filename, mime),
+    store_blob=lambda data, mime: blob_store.put_async(data, mime),
+    get_backend=lambda: image_backend,
+    workers=IMAGE_PIPELINE_CONFIG["workers"],
+    queue_size=IMAGE_PIPELINE_CONFIG["queue_size"],
+)
+
+
+async def process_generated_image(img, idx: int, request: ImageGenerateRequest, image_size: int) -> Optional[str]:
+    """经流水线处理一张图片，返回URL或data URI；下载失败时返回None"""
+    output_format, compression = resolve_output_encoding(request.output_format, request.compression)
+    job = await image_pipeline.process(ImageJob(
+        img,
+        image_size,
+        output="url" if request.response_type == "url" else "base64",
+        filename=generate_image_filename(request.prompt, idx),
+        output_format=output_format,
+        compression=compression,
+    ))
+    if job is None:
+        return None
+    return job.url or job.data_uri
+
+
+async def generate_image_variant(variant: int, prompt: str, files: Optional[List[str]],
+                                 request: ImageGenerateRequest, image_size: int) -> Tuple[List[str], str]:
+    """一次上游生成及其全部图片的并行后处理，返回(图片列表, 响应文本)"""
+    response = await call_gemini_with_retry(prompt, files=files, image_mode=True)
+    images = response.images or []
+    # 文件名序号按 变体*10+图片 编号，避免多个变体重名
+    processed = await asyncio.gather(*(
+        process_generated_image(img, variant * 10 + idx, request, image_size)
+        for idx, img in enumerate(images)
+    ))
+    return [image for image in processed if image], response.text or ""
+
+
 @app.post("/v1/generate-images", response_model=ImageGenerateResponse)
 async def generate_images(request: ImageGenerateRequest):
     if not gemini_client:
         raise HTTPException(status_code=503, detail="Gemini客户端未初始化")
 
+    if not 1 <= request.count <= MAX_IMAGE_COUNT:
+        raise HTTPException(status_code=400, detail=f"count 必须在 1-{MAX_IMAGE_COUNT} 之间")
+
     try:
-        temp_file = None
+        image_size = resolve_image_size(request.size, request.quality)
+        resolve_output_encoding(request.output_format, request.compression)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
+    temp_file = None
+    try:
         if request.image:
             image_data = request.image
             if image_data.startswith("data:"):
@@ -938,73 +1471,56 @@ async def generate_images(request: ImageGenerateRequest):
                 f.write(image_bytes)
 
             enhanced_prompt = f"Based on the reference image provided, {request.prompt}. Generate a new image."
-            response = await call_gemini_with_retry(enhanced_prompt, files=[temp_file], image_mode=True)
+            files = [temp_file]
         else:
             enhanced_prompt = create_image_prompt(request.prompt)
-            response = await call_gemini_with_retry(enhanced_prompt, image_mode=True)
+            files = None
 
-        if temp_file and os.path.exists(temp_file):
-            os.remove(temp_file)
+        # count>1: 并发发起count次独立生成，由账号池/Provider分摊
+        results = await asyncio.gather(*(
+            generate_image_variant(i, enhanced_prompt, files, request, image_size)
+            for i in range(request.count)
+        ), return_exceptions=True)
 
         image_data_list = []
-        if response.images:
-            for idx, img in enumerate(response.images):
-                if hasattr(img, "url") and img.url:
-                    cookies = getattr(img, "cookies", {}) or {}
-                    download_url = img.url
-                    if "=s" not in download_url:
-                        download_url = f"{img.url}=s4096"
-
-                    async with httpx.AsyncClient(follow_redirects=True, cookies=cookies, timeout=60.0) as http_client:
-                        resp = await http_client.get(download_url)
-                        if resp.status_code == 200:
-                            image_bytes = resp.content
-
-                            # 去除水印
-                            if watermark_remover:
-                                from fastapi.concurrency import run_in_threadpool
-                                try:
-                                    image_bytes = await run_in_threadpool(
-                                        watermark_remover.remove_from_bytes,
-                                        image_bytes
-                                    )
-                                    logger.info(f"✅ 水印已去除: 图片{idx+1}")
-                                except Exception as e:
-                                    logger.warning(f"⚠️ 去水印失败，返回原图: {e}")
-
-                            if request.response_type == "url":
-                                filename = generate_image_filename(request.prompt, idx)
-                                try:
-                                    url = await upload_to_r2(image_bytes, filename)
-                                    image_data_list.append(url)
-                                    logger.info(f"✅ 图片已上传: {filename}")
-                                except Exception as e:
-                                    logger.error(f"❌ R2上传失败: {e}")
-                                    image_base64 = b64.b64encode(image_bytes).decode("utf-8")
-                                    image_data_list.append(f"data:image/png;base64,{image_base64}")
-                            else:
-                                content_type = resp.headers.get("content-type", "image/png")
-                                mime_type = "image/png"
-                                if "jpeg" in content_type or "jpg" in content_type:
-                                    mime_type = "image/jpeg"
-                                elif "webp" in content_type:
-                                    mime_type = "image/webp"
-                                image_base64 = b64.b64encode(image_bytes).decode("utf-8")
-                                image_data_list.append(f"data:{mime_type};base64,{image_base64}")
+        errors = []
+        response_text = ""
+        for i, result in enumerate(results):
+            if isinstance(result, BaseException):
+                logger.warning(f"⚠️ 第{i+1}/{request.count}次生成失败: {result}")
+                errors.append({"index": i, "error": str(result) or type(result).__name__})
+                continue
+            images, text = result
+            response_text = response_text or text
+            if images:
+                image_data_list.extend(images)
+            else:
+                errors.append({"index": i, "error": f"未能生成图片: {text[:200] if text else '无响应'}"})
 
         if not image_data_list:
-            raise HTTPException(status_code=400, detail=f"未能生成图片: {response.text[:200] if response.text else '无响应'}")
+            # 全部失败: 沿用单次生成的错误语义
+            failure = next((r for r in results if isinstance(r, BaseException)), None)
+            if failure is not None:
+                raise failure
+            raise HTTPException(status_code=400, detail=f"未能生成图片: {response_text[:200] if response_text else '无响应'}")
 
-        return ImageGenerateResponse(images=image_data_list)
+        if request.count > 1:
+            image_data_list = image_data_list[:request.count]
+        return ImageGenerateResponse(images=image_data_list, errors=errors)
 
     except RetryError as e:
         raise HTTPException(status_code=429, detail=f"重试失败: {e}")
+    except DeadlineExceededError as e:
+        raise HTTPException(status_code=504, detail=str(e))
     except HTTPException:
         raise
     except Exception as e:
         import traceback
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        if temp_file and os.path.exists(temp_file):
+            os.remove(temp_file)
 
 
 @app.post("/v1/images/generations", response_model=ImageGenerateResponse)
@@ -1137,6 +1653,8 @@ async def analyze_document(
 
     except RetryError as e:
         raise HTTPException(status_code=429, detail=f"重试失败: {e}")
+    except DeadlineExceededError as e:
+        raise HTTPException(status_code=504, detail=str(e))
     except HTTPException:
         raise
     except Exception as e:
@@ -1339,135 +1857,433 @@ async def ui_to_code(
 
 
 # ============ 批量图片生成（并发+断点续传） ============
-async def process_batch_image(task_id: str, prompt: str, response_type: str):
-    """处理单个批量任务"""
-    task_manager.update_task(task_id, "processing")
+blob_store = BlobStore(BLOB_STORE_DIR)
 
-    try:
-        enhanced_prompt = create_image_prompt(prompt)
-        response = await call_gemini_with_retry(enhanced_prompt, image_mode=True)
-
-        if response.images:
-            img = response.images[0]
-            if hasattr(img, "url") and img.url:
-                cookies = getattr(img, "cookies", {}) or {}
-                download_url = f"{img.url}=s4096" if "=s" not in img.url else img.url
-
-                async with httpx.AsyncClient(follow_redirects=True, cookies=cookies, timeout=60.0) as client:
-                    resp = await client.get(download_url)
-                    if resp.status_code == 200:
-                        if response_type == "url":
-                            filename = generate_image_filename(prompt, 0)
-                            url = await upload_to_r2(resp.content, filename)
-                            task_manager.update_task(task_id, "completed", url)
-                            return url
-                        else:
-                            b64_data = b64.b64encode(resp.content).decode()
-                            task_manager.update_task(task_id, "completed", f"data:image/png;base64,{b64_data}")
-                            return b64_data
-
-        task_manager.update_task(task_id, "failed", error="No image generated")
-        return None
 
-    except Exception as e:
-        task_manager.update_task(task_id, "failed", error=str(e))
-        logger.error(f"Task {task_id} failed: {e}")
-        return None
+async def process_batch_image(task: dict) -> Union[str, BlobRef]:
+    """处理单个批量任务（由任务队列调用），返回R2 URL或blob引用；失败时抛出异常"""
+    params = decode_task_input(task["input_data"])
+    prompt = params["prompt"]
+    response_type = params.get("response_type", "url")
+    output_format, compression = resolve_output_encoding(params.get("output_format"), params.get("compression"))
+
+    enhanced_prompt = create_image_prompt(prompt)
+    response = await call_gemini_with_retry(enhanced_prompt, image_mode=True)
+
+    # url: 上传R2; base64: 图片本体存blob，任务表只保存引用，通过 /v1/batch/{batch_id}/tasks/{task_id}/result 下载
+    job = None
+    if response.images:
+        job = await image_pipeline.process(ImageJob(
+            response.images[0],
+            DEFAULT_IMAGE_SIZE,
+            output="url" if response_type == "url" else "blob",
+            filename=generate_image_filename(prompt, 0),
+            output_format=output_format,
+            compression=compression,
+        ))
+    if job is None:
+        raise ClientError("No image generated")
 
+    if response_type == "url":
+        if not job.url:
+            raise ServerError("R2上传失败")
+        return job.url
+    return job.blob
 
-async def batch_worker(queue: asyncio.Queue, results: dict):
-    """批量任务Worker"""
+
+def batch_concurrency() -> int:
+    return BATCH_QUEUE_CONFIG["concurrency"] or cookie_pool.total_slots or MAX_CONCURRENCY
+
+
+async def resync_counts_loop(interval: float):
     while True:
+        await asyncio.sleep(interval)
         try:
-            task = await asyncio.wait_for(queue.get(), timeout=1.0)
-        except asyncio.TimeoutError:
-            if queue.empty():
-                break
-            continue
+            await task_manager.resync_counts()
+        except Exception as e:
+            logger.warning(f"[BatchQueue] 重新统计任务计数失败: {e}")
 
-        task_id, prompt, response_type = task
 
-        existing = task_manager.get_task(task_id)
-        if existing and existing["status"] == "completed":
-            results[task_id] = existing["output_data"]
-            queue.task_done()
-            continue
+async def cleanup_expired_tasks() -> dict:
+    """删除过期任务，回收它们独占的blob，并清扫没有任务引用的孤立blob"""
+    min_age = TASK_RETENTION_CONFIG["blob_min_age"]
+    deleted, refs = await task_manager.cleanup_old_tasks(TASK_RETENTION_CONFIG["days"])
+    freed = await asyncio.to_thread(blob_store.delete_unreferenced, refs, min_age)
+    referenced = await task_manager.referenced_blob_hashes()
+    swept = await asyncio.to_thread(blob_store.sweep, referenced, min_age)
+    if deleted or freed or swept:
+        logger.info(f"[Retention] 删除过期任务 {deleted} 个，回收blob {freed} 个，清扫孤立blob {swept} 个")
+    return {"tasks": deleted, "blobs": freed, "orphans": swept}
 
-        result = await process_batch_image(task_id, prompt, response_type)
-        results[task_id] = result
-        queue.task_done()
 
+async def task_retention_loop(interval: float):
+    while True:
+        try:
+            await cleanup_expired_tasks()
+        except Exception as e:
+            logger.warning(f"[Retention] 清理过期任务失败: {e}")
+        await asyncio.sleep(interval)
 
-@app.post("/v1/batch/images", response_model=BatchImageResponse)
-async def batch_generate_images(request: BatchImageRequest, background_tasks: BackgroundTasks):
-    """批量图片生成（后台任务，支持断点续传）"""
-    if not gemini_client:
-        raise HTTPException(status_code=503, detail="Gemini客户端未初始化")
 
-    batch_id = f"batch_{uuid.uuid4().hex[:8]}"
-    concurrency = min(request.concurrency, MAX_CONCURRENCY)
+batch_event_bus = BatchEventBus()
+
+
+def publish_batch_event(task: dict):
+    if task.get("batch_id"):
+        batch_event_bus.publish(task["batch_id"])
+        webhook_dispatcher.wake()
 
-    for i, prompt in enumerate(request.prompts):
-        task_id = f"{batch_id}_task_{i}"
-        task_manager.create_task(task_id, "batch_image", prompt)
 
-    async def run_batch():
-        queue = asyncio.Queue()
-        results = {}
+async def build_webhook_payload(row: dict) -> Optional[dict]:
+    """根据发件箱记录生成webhook请求体；任务/批次已被清理时返回None"""
+    batch_id = row["batch_id"]
+    if not row["task_id"]:
+        batch = await task_manager.get_batch(batch_id)
+        return _batch_progress(batch) if batch else None
+
+    task = await task_manager.get_task(row["task_id"])
+    if not task:
+        return None
+    payload = {"batch_id": batch_id, "task_id": task["task_id"], "status": task["status"]}
+    if task["status"] == "completed":
+        result = batch_task_result(batch_id, task)
+        if result["url"].startswith("/"):
+            result["url"] = WEBHOOK_CONFIG["public_base_url"] + result["url"]
+        payload.update(result)
+    else:
+        payload["error"] = task["error_message"]
+    return payload
+
+
+webhook_dispatcher = WebhookDispatcher(
+    task_manager,
+    build_webhook_payload,
+    secret=WEBHOOK_CONFIG["secret"],
+    concurrency=WEBHOOK_CONFIG["concurrency"],
+    timeout=WEBHOOK_CONFIG["timeout"],
+    max_attempts=WEBHOOK_CONFIG["max_attempts"],
+    retry_base_delay=WEBHOOK_CONFIG["retry_base_delay"],
+    allowed_hosts=WEBHOOK_CONFIG["allowed_hosts"],
+    allow_private=WEBHOOK_CONFIG["allow_private"],
+)
+
 
-        for i, prompt in enumerate(request.prompts):
-            task_id = f"{batch_id}_task_{i}"
-            queue.put_nowait((task_id, prompt, request.response_type))
+# 批量任务队列Worker，embedded模式下在lifespan中启动/停止
+batch_queue = BatchQueueWorker(
+    task_manager,
+    process_batch_image,
+    task_type="batch_image",
+    concurrency=batch_concurrency,
+    lease_seconds=BATCH_QUEUE_CONFIG["lease_seconds"],
+    heartbeat_interval=BATCH_QUEUE_CONFIG["heartbeat_interval"],
+    max_attempts=BATCH_QUEUE_CONFIG["max_attempts"],
+    retry_base_delay=BATCH_QUEUE_CONFIG["retry_base_delay"],
+    on_finished=publish_batch_event,
+)
+
+
+@app.post("/v1/batch/images", response_model=BatchImageResponse)
+async def batch_generate_images(request: BatchImageRequest):
+    """批量图片生成（写入持久化任务队列，服务重启后自动继续）"""
+    if not gemini_client:
+        raise HTTPException(status_code=503, detail="Gemini客户端未初始化")
+
+    if request.callback_url:
+        try:
+            await webhook_dispatcher.check_url(request.callback_url)
+        except CallbackURLError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    try:
+        resolve_output_encoding(request.output_format, request.compression)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
-        workers = [asyncio.create_task(batch_worker(queue, results)) for _ in range(concurrency)]
-        await asyncio.gather(*workers)
-        logger.info(f"Batch {batch_id} completed: {len(results)} tasks")
+    batch_id = f"batch_{uuid.uuid4().hex[:8]}"
 
-    background_tasks.add_task(run_batch)
+    await task_manager.create_batch(
+        batch_id,
+        "batch_image",
+        [
+            encode_task_input(
+                prompt=prompt,
+                response_type=request.response_type,
+                output_format=request.output_format,
+                compression=request.compression,
+            )
+            for prompt in request.prompts
+        ],
+        callback_url=request.callback_url,
+    )
+    batch_queue.wake()
 
     return BatchImageResponse(
         batch_id=batch_id,
         total=len(request.prompts),
         status="processing",
-        message=f"批量任务已创建，{concurrency}并发处理中"
+        message=f"批量任务已入队，{batch_concurrency()}并发处理中"
     )
 
 
-@app.get("/v1/batch/{batch_id}/status")
-async def get_batch_status(batch_id: str):
-    """获取批量任务状态"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.execute(
-        "SELECT task_id, status, output_data, error_message FROM tasks WHERE task_id LIKE ?",
-        (f"{batch_id}%",)
-    )
-    tasks = [dict(row) for row in cursor.fetchall()]
-    conn.close()
+@app.get("/v1/batch/workers")
+async def list_batch_workers():
+    """列出最近有心跳的批量worker（API内嵌及独立进程）及其吞吐"""
+    now = time.time()
+    stale_after = BATCH_QUEUE_CONFIG["heartbeat_interval"] * 3
+    workers = []
+    for w in await task_manager.list_workers(active_within=BATCH_QUEUE_CONFIG["lease_seconds"]):
+        elapsed = max(1.0, w["heartbeat_at"] - w["started_at"])
+        workers.append({
+            **w,
+            "alive": w["status"] == "running" and now - w["heartbeat_at"] <= stale_after,
+            "throughput_per_min": round(w["completed"] / elapsed * 60, 2),
+        })
+    alive = [w for w in workers if w["alive"]]
+    return {
+        "mode": BATCH_QUEUE_CONFIG["mode"],
+        "alive": len(alive),
+        "total_concurrency": sum(w["concurrency"] for w in alive),
+        "in_flight": sum(w["in_flight"] for w in alive),
+        "workers": workers,
+    }
+
 
-    if not tasks:
+def batch_task_result(batch_id: str, task: dict) -> dict:
+    if not task.get("output_ref"):
+        return {"task_id": task["task_id"], "url": task["output_data"]}
+    return {
+        "task_id": task["task_id"],
+        "url": f"/v1/batch/{batch_id}/tasks/{task['task_id']}/result",
+        "size": task["output_size"],
+        "sha256": task["output_hash"],
+        "mime_type": task["output_mime"],
+    }
+
+
+@app.get("/v1/batch/{batch_id}/status")
+async def get_batch_status(batch_id: str, cursor: int = 0, limit: int = BATCH_STATUS_PAGE_SIZE):
+    """获取批量任务状态（计数来自批次表，结果按cursor分页）"""
+    batch = await task_manager.get_batch(batch_id)
+    if not batch:
         raise HTTPException(status_code=404, detail="批次不存在")
 
-    completed = [t for t in tasks if t["status"] == "completed"]
-    failed = [t for t in tasks if t["status"] == "failed"]
-    pending = [t for t in tasks if t["status"] in ("pending", "processing")]
+    limit = max(1, min(limit, BATCH_STATUS_MAX_PAGE_SIZE))
+    tasks = await task_manager.get_batch_tasks(batch_id, cursor=cursor, limit=limit)
+    pending = batch["pending"] + batch["processing"]
 
     return {
         "batch_id": batch_id,
-        "total": len(tasks),
-        "completed": len(completed),
-        "failed": len(failed),
-        "pending": len(pending),
-        "progress": f"{len(completed)}/{len(tasks)}",
+        "total": batch["total"],
+        "completed": batch["completed"],
+        "failed": batch["failed"],
+        "pending": pending,
+        "progress": f"{batch['completed']}/{batch['total']}",
+        "status": "completed" if not pending else "processing",
+        "results": [batch_task_result(batch_id, t) for t in tasks if t["status"] == "completed"],
+        "errors": [{"task_id": t["task_id"], "error": t["error_message"]} for t in tasks if t["status"] == "failed"],
+        "next_cursor": tasks[-1]["seq"] if len(tasks) == limit else None,
+    }
+
+
+def _batch_progress(batch: dict) -> dict:
+    pending = batch["pending"] + batch["processing"]
+    return {
+        "batch_id": batch["batch_id"],
+        "total": batch["total"],
+        "completed": batch["completed"],
+        "failed": batch["failed"],
+        "pending": pending,
         "status": "completed" if not pending else "processing",
-        "results": [{"task_id": t["task_id"], "url": t["output_data"]} for t in completed],
-        "errors": [{"task_id": t["task_id"], "error": t["error_message"]} for t in failed]
     }
 
 
+async def batch_event_stream(batch_id: str, last_event_id: int) -> AsyncGenerator[str, None]:
+    """推送 event_id > last_event_id 的任务事件，批次结束后发送done事件并关闭"""
+    last_sent = time.monotonic()
+    with batch_event_bus.subscribe(batch_id) as signal:
+        while True:
+            signal.clear()
+            batch, events = await task_manager.get_batch_events(batch_id, last_event_id, BATCH_STATUS_PAGE_SIZE)
+            if batch is None:
+                yield f"event: error\ndata: {json.dumps({'error': '批次不存在'}, ensure_ascii=False)}\n\n"
+                return
+
+            for event in events:
+                last_event_id = event["event_id"]
+                if event["event"] == "completed":
+                    data = batch_task_result(batch_id, event)
+                else:
+                    data = {"task_id": event["task_id"], "error": event["error_message"]}
+                yield f"id: {last_event_id}\nevent: {event['event']}\n{_sse(data)}"
+            if events:
+                last_sent = time.monotonic()
+                yield f"event: progress\n{_sse(_batch_progress(batch))}"
+            if len(events) == BATCH_STATUS_PAGE_SIZE:
+                continue
+
+            if not batch["pending"] and not batch["processing"]:
+                yield f"event: done\n{_sse(_batch_progress(batch))}"
+                return
+
+            try:
+                await asyncio.wait_for(signal.wait(), timeout=BATCH_EVENTS_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                if time.monotonic() - last_sent >= BATCH_EVENTS_KEEPALIVE:
+                    last_sent = time.monotonic()
+                    yield ": keepalive\n\n"
+
+
+@app.get("/v1/batch/{batch_id}/events")
+async def batch_events(batch_id: str, http_request: Request, last_event_id: Optional[int] = None):
+    """批量任务进度SSE：每个任务完成/失败时推送，断线后用Last-Event-ID续传"""
+    if not await task_manager.get_batch(batch_id):
+        raise HTTPException(status_code=404, detail="批次不存在")
+
+    header = http_request.headers.get("last-event-id")
+    if last_event_id is None:
+        try:
+            last_event_id = int(header) if header else 0
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Last-Event-ID 无效")
+
+    return StreamingResponse(
+        batch_event_stream(batch_id, last_event_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@app.get("/v1/batch/{batch_id}/tasks/{task_id}/result")
+async def get_batch_task_result(batch_id: str, task_id: str):
+    """下载单个批量任务的结果（blob流式返回，R2结果重定向）"""
+    task = await task_manager.get_task(task_id)
+    if not task or task.get("batch_id") != batch_id:
+        raise HTTPException(status_code=404, detail="任务不存在")
+    if task["status"] != "completed":
+        raise HTTPException(status_code=409, detail=f"任务尚未完成: {task['status']}")
+
+    if task.get("output_ref"):
+        path = blob_store.open_path(task["output_ref"])
+        if path is None:
+            raise HTTPException(status_code=410, detail="结果文件已被清理")
+        mime = task["output_mime"] or "application/octet-stream"
+        ext = mime.split("/")[-1] if mime.startswith("image/") else "bin"
+        return FileResponse(
+            path,
+            media_type=mime,
+            filename=f"{task_id}.{ext}",
+            headers={"ETag": f'"{task["output_hash"]}"', "Cache-Control": "private, max-age=31536000, immutable"},
+        )
+
+    output = task.get("output_data") or ""
+    if output.startswith("data:"):
+        # 旧版本直接存储的data URI
+        header, _, data = output.partition(",")
+        mime = header[5:].split(";")[0] or "application/octet-stream"
+        return Response(content=b64.b64decode(data), media_type=mime)
+    if output.startswith(("http://", "https://")):
+        return RedirectResponse(output)
+    raise HTTPException(status_code=404, detail="任务没有可下载的结果")
+
+
 # ============ Chat Completions ============
+def _sse(data: Any) -> str:
+    payload = data if isinstance(data, str) else json.dumps(data, ensure_ascii=False)
+    return f"data: {payload}\n\n"
+
+
+async def stream_chat_completion(prompt: str, model: str, http_request: Request) -> AsyncGenerator[str, None]:
+    """OpenAI兼容的SSE流: Provider流式优先，首个分块前失败时回退Cookie流式"""
+    completion_id = f"chatcmpl-{uuid.uuid4().hex[:24]}"
+    created = int(time.time())
+
+    def chunk(delta: dict, finish_reason: Optional[str] = None, usage: Optional[dict] = None) -> str:
+        body = {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+        }
+        if usage is not None:
+            body["usage"] = usage
+        return _sse(body)
+
+    yield chunk({"role": "assistant", "content": ""})
+
+    output_parts: List[str] = []
+    usage_metadata: Dict[str, Any] = {}
+
+    async def provider_deltas() -> AsyncGenerator[str, None]:
+        # 熔断统计按首包耗时计算；首包之后的错误不再计入
+        started = time.monotonic()
+        recorded = False
+        try:
+            async for data in stream_provider_api(prompt, model=model):
+                if not recorded:
+                    provider_breaker.record_success(time.monotonic() - started)
+                    recorded = True
+                if data.get("usageMetadata"):
+                    usage_metadata.update(data["usageMetadata"])
+                for candidate in data.get("candidates", [])[:1]:
+                    for part in candidate.get("content", {}).get("parts", []):
+                        if part.get("text"):
+                            yield part["text"]
+        except (asyncio.CancelledError, GeneratorExit, ClientError):
+            raise
+        except Exception:
+            if not recorded:
+                provider_breaker.record_failure(time.monotonic() - started)
+                recorded = True
+            raise
+        finally:
+            if not recorded:
+                provider_breaker.release()
+
+    sources = []
+    if PROVIDER_CONFIG["enabled"] and provider_breaker.allow_request():
+        sources.append(("Provider", provider_deltas))
+    if gemini_client:
+        sources.append(("Cookie", lambda: stream_cookie_api(prompt, model=model)))
+
+    try:
+        for name, source in sources:
+            try:
+                async for delta in source():
+                    if await http_request.is_disconnected():
+                        logger.info(f"[{name}] 客户端已断开，取消上游流式请求")
+                        return
+                    output_parts.append(delta)
+                    yield chunk({"content": delta})
+                break
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # 已经输出过内容时无法切换后端
+                if output_parts or name == sources[-1][0]:
+                    raise
+                logger.warning(f"[{name}] 流式失败，fallback到下一个后端: {e}")
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.error(f"流式生成错误: {e}")
+        yield _sse({"error": {"message": str(e), "type": "server_error"}})
+        yield _sse("[DONE]")
+        return
+
+    completion_text = "".join(output_parts)
+    prompt_tokens = usage_metadata.get("promptTokenCount", len(prompt.split()))
+    completion_tokens = usage_metadata.get("candidatesTokenCount", len(completion_text.split()))
+    usage = {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": usage_metadata.get("totalTokenCount", prompt_tokens + completion_tokens)
+    }
+    yield chunk({}, finish_reason="stop", usage=usage)
+    yield _sse("[DONE]")
+
+
 @app.post("/v1/chat/completions")
-async def chat_completions(request: dict):
+async def chat_completions(request: dict, http_request: Request):
     # v4.2: Provider模式不需要gemini_client
     if not gemini_client and not PROVIDER_CONFIG["enabled"]:
         raise HTTPException(status_code=503, detail="Gemini客户端未初始化且Provider未启用")
@@ -1478,7 +2294,15 @@ async def chat_completions(request: dict):
         prompt = messages[-1].get("content", "")
         model = request.get("model", "gemini-2.5-flash")
 
-        response = await call_gemini_with_retry(prompt, model=model)
+        if request.get("stream"):
+            return StreamingResponse(
+                stream_chat_completion(prompt, model, http_request),
+                media_type="text/event-stream",
+                headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+            )
+
+        config = {k: request[k] for k in ("temperature", "top_p", "max_tokens") if k in request}
+        text = await generate_text_cached(prompt, model, config, http_request, hedge=request.get("hedge"))
 
         return {
             "id": "chatcmpl-gemini-reverse",
@@ -1486,19 +2310,23 @@ async def chat_completions(request: dict):
             "model": model,
             "choices": [{
                 "index": 0,
-                "message": {"role": "assistant", "content": response.text},
+                "message": {"role": "assistant", "content": text},
                 "finish_reason": "stop"
             }]
         }
     except RetryError as e:
         raise HTTPException(status_code=429, detail=f"重试失败: {e}")
+    except DeadlineExceededError as e:
+        raise HTTPException(status_code=504, detail=str(e))
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
 # ============ Gemini Native Format ============
 @app.post("/gemini/v1beta/models/{model}:generateContent")
-async def gemini_generate_content(model: str, request: GeminiRequest):
+async def gemini_generate_content(model: str, request: GeminiRequest, http_request: Request = None):
     # v4.2: Provider模式不需要gemini_client
     if not gemini_client and not PROVIDER_CONFIG["enabled"]:
         raise HTTPException(status_code=503, detail="Gemini客户端未初始化且Provider未启用")
@@ -1516,52 +2344,35 @@ async def gemini_generate_content(model: str, request: GeminiRequest):
         is_image_model = model in IMAGE_MODELS
 
         if is_image_model:
+            # 分辨率: generationConfig.imageConfig.imageSize ("1K"/"2K"/"4K") 或模型 -2k/-4k 变体
+            # 输出格式: imageConfig.imageOutputOptions {mimeType, compressionQuality}
+            image_config = (request.generationConfig or {}).get("imageConfig") or {}
+            output_options = image_config.get("imageOutputOptions") or {}
+            mime_type = output_options.get("mimeType")
+            # 与Gemini API一致: compressionQuality只作用于有损格式，PNG或未指定mimeType时忽略
+            quality = output_options.get("compressionQuality")
+            if not mime_type or str(mime_type).lower().endswith("png"):
+                quality = None
+            try:
+                image_size = resolve_image_size(image_config.get("imageSize"), model=model)
+                output_format, compression = resolve_output_encoding(mime_type, quality)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+
             # 图片模型: 增强提示词并使用image_mode
             enhanced_prompt = create_image_prompt(prompt)
             response = await call_gemini_with_retry(enhanced_prompt, image_mode=True)
 
-            # 处理图片响应
-            parts = []
-            if response.images:
-                for img in response.images:
-                    if hasattr(img, "url") and img.url:
-                        cookies = getattr(img, "cookies", {}) or {}
-                        download_url = img.url
-                        if "=s" not in download_url:
-                            download_url = f"{img.url}=s4096"
-
-                        async with httpx.AsyncClient(follow_redirects=True, cookies=cookies, timeout=60.0) as http_client:
-                            resp = await http_client.get(download_url)
-                            if resp.status_code == 200:
-                                image_bytes = resp.content
-
-                                # 去除水印
-                                if watermark_remover:
-                                    from fastapi.concurrency import run_in_threadpool
-                                    try:
-                                        image_bytes = await run_in_threadpool(
-                                            watermark_remover.remove_from_bytes,
-                                            image_bytes
-                                        )
-                                        logger.info(f"✅ 水印已去除 (Gemini原生格式)")
-                                    except Exception as e:
-                                        logger.warning(f"⚠️ 去水印失败，返回原图: {e}")
-
-                                # 编码为base64
-                                content_type = resp.headers.get("content-type", "image/png")
-                                mime_type = "image/png"
-                                if "jpeg" in content_type or "jpg" in content_type:
-                                    mime_type = "image/jpeg"
-                                elif "webp" in content_type:
-                                    mime_type = "image/webp"
-
-                                image_base64 = b64.b64encode(image_bytes).decode("utf-8")
-                                parts.append({
-                                    "inlineData": {
-                                        "mimeType": mime_type,
-                                        "data": image_base64
-                                    }
-                                })
+            # 处理图片响应（下载/去水印/编码经流水线并行）
+            jobs = await asyncio.gather(*(
+                image_pipeline.process(ImageJob(img, image_size, output="base64",
+                                                output_format=output_format, compression=compression))
+                for img in response.images or []
+            ))
+            parts = [
+                {"inlineData": {"mimeType": job.mime, "data": job.b64}}
+                for job in jobs if job is not None
+            ]
 
             # 如果也有文本，添加文本部分
             if response.text:
@@ -1584,31 +2395,35 @@ async def gemini_generate_content(model: str, request: GeminiRequest):
                 "modelVersion": model
             }
         else:
-            # 文本模型: 原有逻辑
-            response = await call_gemini_with_retry(prompt, model=model)
+            # 文本模型
+            text = await generate_text_cached(prompt, model, request.generationConfig, http_request)
 
             return {
                 "candidates": [{
-                    "content": {"parts": [{"text": response.text}], "role": "model"},
+                    "content": {"parts": [{"text": text}], "role": "model"},
                     "finishReason": "STOP",
                     "index": 0
                 }],
                 "usageMetadata": {
                     "promptTokenCount": len(prompt.split()),
-                    "candidatesTokenCount": len(response.text.split()),
-                    "totalTokenCount": len(prompt.split()) + len(response.text.split())
+                    "candidatesTokenCount": len(text.split()),
+                    "totalTokenCount": len(prompt.split()) + len(text.split())
                 },
                 "modelVersion": model
             }
     except RetryError as e:
         raise HTTPException(status_code=429, detail=f"重试失败: {e}")
+    except DeadlineExceededError as e:
+        raise HTTPException(status_code=504, detail=str(e))
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/v1beta/models/{model}:generateContent")
 @app.post("/v1/models/{model}:generateContent")
-async def nexusai_gemini_generate_content(model: str, request: GeminiRequest):
-    return await gemini_generate_content(model, request)
+async def nexusai_gemini_generate_content(model: str, request: GeminiRequest, http_request: Request):
+    return await gemini_generate_content(model, request, http_request)
 
 
 # ============ Gemini 模型列表 (用于第三方客户端) ============
@@ -0,0 +1,47 @@
+"""
+批量任务事件通知
+功能: 进程内按batch_id的发布/订阅，任务完成时立即唤醒对应的SSE连接；事件本身持久化在任务库(batch_events表)，支持Last-Event-ID续传
+关键词: pub-sub, sse, batch, notify, last-event-id
+"""
+import asyncio
+import logging
+from contextlib import contextmanager
+from typing import Dict, Iterator, Set
+
+logger = logging.getLogger(__name__)
+
+
+class BatchEventBus:
+    """只负责唤醒订阅者，不携带事件数据（事件从数据库按ID读取，保证顺序与续传）"""
+
+    def __init__(self):
+        self._subscribers: Dict[str, Set[asyncio.Event]] = {}
+        self.published = 0
+
+    @contextmanager
+    def subscribe(self, batch_id: str) -> Iterator[asyncio.Event]:
+        signal = asyncio.Event()
+        self._subscribers.setdefault(batch_id, set()).add(signal)
+        try:
+            yield signal
+        finally:
+            subscribers = self._subscribers.get(batch_id)
+            if subscribers is not None:
+                subscribers.discard(signal)
+                if not subscribers:
+                    del self._subscribers[batch_id]
+
+    def publish(self, batch_id: str):
+        subscribers = self._subscribers.get(batch_id)
+        if not subscribers:
+            return
+        self.published += 1
+        for signal in subscribers:
+            signal.set()
+
+    def get_stats(self) -> dict:
+        return {
+            "batches": len(self._subscribers),
+            "subscribers": sum(len(s) for s in self._subscribers.values()),
+            "published": self.published,
+        }
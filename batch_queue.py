@@ -0,0 +1,248 @@
+"""
+持久化批量任务队列Worker
+功能: 从SQLite任务表领取任务(租约+心跳+可见性超时)，失败按指数退避重试，启动时恢复中断的任务，停机时归还租约，定期上报worker吞吐
+关键词: batch, queue, lease, heartbeat, visibility-timeout, retry, resume
+"""
+import asyncio
+import logging
+import os
+import socket
+import time
+import uuid
+from typing import Awaitable, Callable, Dict, Optional, Union
+
+from blob_store import BlobRef
+from task_state import TaskStateManager
+
+logger = logging.getLogger(__name__)
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:4]}"
+
+
+class BatchQueueWorker:
+    """租约式任务队列消费者"""
+
+    def __init__(
+        self,
+        task_manager: TaskStateManager,
+        handler: Callable[[dict], Awaitable[Union[str, BlobRef]]],
+        task_type: str = "batch_image",
+        concurrency: Callable[[], int] = lambda: 2,
+        lease_seconds: float = 120.0,
+        heartbeat_interval: float = 30.0,
+        poll_interval: float = 2.0,
+        max_attempts: int = 3,
+        retry_base_delay: float = 5.0,
+        retry_max_delay: float = 300.0,
+        worker_id: Optional[str] = None,
+        mode: str = "embedded",
+        on_finished: Optional[Callable[[dict], None]] = None,
+    ):
+        """
+        Args:
+            task_manager: 任务状态管理器
+            handler: 处理单个任务(数据库行)，返回output_data或BlobRef(大结果存blob)；抛出异常表示失败
+            task_type: 消费的任务类型
+            concurrency: 返回当前并发上限的函数（账号热添加后自动生效）
+            lease_seconds: 租约时长(可见性超时)，worker崩溃后任务在租约过期后被重新领取
+            heartbeat_interval: 续租间隔(秒)，需小于lease_seconds
+            poll_interval: 队列为空时的轮询间隔(秒)
+            max_attempts: 单个任务最大尝试次数
+            retry_base_delay / retry_max_delay: 失败重试的指数退避(秒)
+            worker_id: 租约持有者标识
+            mode: embedded(API进程内) / external(独立worker进程)，仅用于状态上报
+            on_finished: 任务完成或最终失败后的回调(参数为任务行)，用于推送进度
+        """
+        self.task_manager = task_manager
+        self.handler = handler
+        self.task_type = task_type
+        self.concurrency = concurrency
+        self.lease_seconds = lease_seconds
+        self.heartbeat_interval = heartbeat_interval
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self.worker_id = worker_id or default_worker_id()
+        self.mode = mode
+        self.on_finished = on_finished
+        self.started_at = time.time()
+
+        self._in_flight: Dict[str, asyncio.Task] = {}
+        self._wakeup = asyncio.Event()
+        self._loops = []
+
+        self.claimed = 0
+        self.completed = 0
+        self.failed = 0
+        self.retried = 0
+        self.lost_leases = 0
+
+    # ============ 生命周期 ============
+    async def start(self):
+        self.started_at = time.time()
+        requeued = await self.task_manager.requeue_orphans(self.task_type)
+        if requeued:
+            logger.info(f"[BatchQueue] 恢复了 {requeued} 个中断的任务")
+        self._loops = [
+            asyncio.create_task(self._dispatch_loop()),
+            asyncio.create_task(self._heartbeat_loop()),
+        ]
+        logger.info(f"[BatchQueue] Worker {self.worker_id} 已启动")
+
+    async def stop(self):
+        """停止领取新任务，取消进行中的任务并归还租约"""
+        for loop_task in self._loops:
+            loop_task.cancel()
+        tasks = list(self._in_flight.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*self._loops, *tasks, return_exceptions=True)
+        self._loops = []
+        released = await self.task_manager.release_owner(self.worker_id)
+        if released:
+            logger.info(f"[BatchQueue] 已归还 {released} 个任务租约")
+        await self._report("stopped")
+
+    def wake(self):
+        """有新任务入队时立即领取，不必等待轮询"""
+        self._wakeup.set()
+
+    # ============ 领取与执行 ============
+    async def _dispatch_loop(self):
+        while True:
+            free = self.concurrency() - len(self._in_flight)
+            claimed = []
+            if free > 0:
+                try:
+                    claimed = await self.task_manager.claim_tasks(
+                        self.worker_id, self.task_type, free, self.lease_seconds
+                    )
+                except Exception as e:
+                    logger.error(f"[BatchQueue] 领取任务失败: {e}")
+
+            for row in claimed:
+                self.claimed += 1
+                task = asyncio.create_task(self._run(row))
+                self._in_flight[row["task_id"]] = task
+                task.add_done_callback(lambda _, task_id=row["task_id"]: self._on_task_done(task_id))
+
+            # 领满时等任务完成，队列为空时等待新任务或轮询
+            if claimed and len(claimed) == free:
+                continue
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def _on_task_done(self, task_id: str):
+        self._in_flight.pop(task_id, None)
+        self._wakeup.set()
+
+    def retry_delay(self, attempts: int) -> float:
+        return min(self.retry_max_delay, self.retry_base_delay * 2 ** max(0, attempts - 1))
+
+    async def _run(self, row: dict):
+        task_id = row["task_id"]
+        attempts = row.get("attempts") or 1
+        try:
+            output = await self.handler(row)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            error = str(e)[:500]
+            if attempts < self.max_attempts:
+                delay = self.retry_delay(attempts)
+                ok = await self.task_manager.fail_leased(task_id, self.worker_id, error, retry_at=time.time() + delay)
+                if ok:
+                    self.retried += 1
+                    logger.warning(f"[BatchQueue] 任务 {task_id} 第{attempts}次失败，{delay:.0f}s后重试: {error}")
+            else:
+                ok = await self.task_manager.fail_leased(task_id, self.worker_id, error)
+                if ok:
+                    self.failed += 1
+                    logger.error(f"[BatchQueue] 任务 {task_id} 已失败({attempts}次): {error}")
+                    self._notify(row)
+            if not ok:
+                self.lost_leases += 1
+            return
+
+        if isinstance(output, BlobRef):
+            completed = await self.task_manager.complete_leased(task_id, self.worker_id, None, blob=output)
+        else:
+            completed = await self.task_manager.complete_leased(task_id, self.worker_id, output)
+        if completed:
+            self.completed += 1
+            self._notify(row)
+        else:
+            self.lost_leases += 1
+            logger.warning(f"[BatchQueue] 任务 {task_id} 租约已失效，结果未写入")
+
+    def _notify(self, row: dict):
+        if self.on_finished is None:
+            return
+        try:
+            self.on_finished(row)
+        except Exception as e:
+            logger.warning(f"[BatchQueue] 完成回调失败: {e}")
+
+    # ============ 心跳 ============
+    async def _report(self, status: str = "running"):
+        try:
+            await self.task_manager.report_worker({
+                "worker_id": self.worker_id,
+                "hostname": socket.gethostname(),
+                "pid": os.getpid(),
+                "mode": self.mode,
+                "status": status,
+                "started_at": self.started_at,
+                "heartbeat_at": time.time(),
+                "concurrency": self.concurrency(),
+                "in_flight": len(self._in_flight),
+                "claimed": self.claimed,
+                "completed": self.completed,
+                "failed": self.failed,
+                "retried": self.retried,
+            })
+        except Exception as e:
+            logger.warning(f"[BatchQueue] 上报worker状态失败: {e}")
+
+    async def _heartbeat_loop(self):
+        await self._report()
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            await self._report()
+            task_ids = list(self._in_flight)
+            if not task_ids:
+                continue
+            try:
+                lost = await self.task_manager.heartbeat(self.worker_id, task_ids, self.lease_seconds)
+            except Exception as e:
+                logger.error(f"[BatchQueue] 续租失败: {e}")
+                continue
+            for task_id in lost:
+                # 租约已被接管：停止本地执行，避免重复处理
+                task = self._in_flight.get(task_id)
+                if task:
+                    self.lost_leases += 1
+                    task.cancel()
+                    logger.warning(f"[BatchQueue] 任务 {task_id} 租约丢失，已取消本地执行")
+
+    def get_stats(self) -> dict:
+        elapsed = max(1e-6, time.time() - self.started_at)
+        return {
+            "worker_id": self.worker_id,
+            "mode": self.mode,
+            "running": bool(self._loops),
+            "concurrency": self.concurrency(),
+            "in_flight": len(self._in_flight),
+            "claimed": self.claimed,
+            "completed": self.completed,
+            "failed": self.failed,
+            "retried": self.retried,
+            "lost_leases": self.lost_leases,
+            "throughput_per_min": round(self.completed / elapsed * 60, 2),
+        }
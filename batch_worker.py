@@ -0,0 +1,87 @@
+"""
+独立批量任务Worker进程
+功能: 与API进程共享任务数据库(TASK_DB_PATH)，在独立进程中消费批量图片队列，同一主机可启动多个实例横向扩展
+      (SQLite WAL依赖本机共享内存，数据库不能放在网络文件系统上，不支持跨主机)
+关键词: batch, worker, multi-process, scale-out, lease
+用法: BATCH_WORKER_MODE=external 启动API后，运行 python -m batch_worker [--concurrency N] [--worker-id ID]
+"""
+import argparse
+import asyncio
+import logging
+import signal
+
+try:
+    import api_server as api  # Docker镜像中的文件名
+except ImportError:
+    import api_server_v4 as api
+
+from batch_queue import BatchQueueWorker
+
+logger = logging.getLogger(__name__)
+
+
+async def run_worker(concurrency: int = 0, worker_id: str = None):
+    if api.cookie_store.get("__Secure-1PSID"):
+        try:
+            await api.init_gemini_client()
+            print("✅ Gemini客户端初始化成功!")
+        except Exception as e:
+            print(f"⚠️ Gemini客户端初始化失败: {e}")
+    await api.init_cookie_accounts()
+    if not api.cookie_pool.total_slots:
+        print("⚠️ 没有可用的Cookie账号，图片任务将失败重试直到账号可用")
+
+    if api.PROVIDER_CONFIG["enabled"]:
+        await api.provider_http.start()
+    await api.image_downloader.start()
+    try:
+        api.r2_uploader.start()
+    except Exception as e:
+        print(f"⚠️ R2上传器初始化失败: {e}")
+    # 去水印/进程池/输出格式与API进程一致
+    await api.init_image_processing()
+
+    worker = BatchQueueWorker(
+        api.task_manager,
+        api.process_batch_image,
+        task_type="batch_image",
+        concurrency=(lambda: concurrency) if concurrency > 0 else api.batch_concurrency,
+        lease_seconds=api.BATCH_QUEUE_CONFIG["lease_seconds"],
+        heartbeat_interval=api.BATCH_QUEUE_CONFIG["heartbeat_interval"],
+        max_attempts=api.BATCH_QUEUE_CONFIG["max_attempts"],
+        retry_base_delay=api.BATCH_QUEUE_CONFIG["retry_base_delay"],
+        worker_id=worker_id,
+        mode="external",
+    )
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    await worker.start()
+    print(f"✅ 批量Worker已启动 (worker={worker.worker_id}, 并发={worker.concurrency()}, 数据库={api.DB_PATH})")
+    try:
+        await stop_event.wait()
+    finally:
+        print("正在停止批量Worker，归还未完成任务的租约...")
+        await worker.stop()
+        await api.cookie_pool.close()
+        await api.provider_http.close()
+        await api.close_image_processing()
+        await api.image_downloader.close()
+        api.r2_uploader.close()
+        api.task_manager.close()
+        print(f"✅ 批量Worker已停止 (完成={worker.completed}, 失败={worker.failed})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Gemini Reverse API 批量任务Worker")
+    parser.add_argument("--concurrency", type=int, default=0, help="并发数，0表示跟随BATCH_CONCURRENCY/Cookie账号槽位")
+    parser.add_argument("--worker-id", default=None, help="worker标识，默认 主机名-pid-随机串")
+    args = parser.parse_args()
+    asyncio.run(run_worker(args.concurrency, args.worker_id))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+SmartRateLimiter 微基准
+对比旧实现(持锁sleep)与新实现(预约时间槽、锁外sleep)在 1/10/100 并发下的实际RPM与相邻请求的最小间隔；
+两者都应受 base_delay+抖动 的请求间隔约束（并发不应放大突发）
+
+时间按 --window 压缩: 60秒窗口缩短为 window 秒，延迟/抖动按相同比例缩放，
+结果换算回"每分钟"以便与配置的RPM对比。
+
+用法:
+    python benchmarks/bench_rate_limiter.py --rpm 60 --window 3 --windows 3
+"""
+import argparse
+import asyncio
+import random
+import sys
+import time
+from pathlib import Path
+from typing import List
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from smart_rate_limiter import SmartRateLimiter  # noqa: E402
+
+
+class LegacyRateLimiter:
+    """旧实现: 在 asyncio.Lock 内 sleep（用于对比）"""
+
+    def __init__(self, rpm_limit, base_delay, jitter_range, window):
+        self.rpm_limit = rpm_limit
+        self.current_delay = base_delay
+        self.jitter_range = jitter_range
+        self.window = window
+        self.request_times: List[float] = []
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> float:
+        async with self._lock:
+            now = time.time()
+            self.request_times = [t for t in self.request_times if now - t < self.window]
+            if len(self.request_times) >= self.rpm_limit:
+                wait_time = self.window - (now - self.request_times[0]) + random.uniform(0, self.jitter_range)
+                if wait_time > 0:
+                    await asyncio.sleep(wait_time)
+            delay = self.current_delay + random.uniform(0, self.jitter_range)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self.request_times.append(time.time())
+            return delay
+
+
+async def run_case(limiter, concurrency: int, duration: float) -> List[float]:
+    """返回窗口内各请求的发出时间"""
+    sent: List[float] = []
+    deadline = time.monotonic() + duration
+
+    async def caller():
+        while True:
+            await limiter.acquire()
+            now = time.monotonic()
+            if now > deadline:
+                return
+            sent.append(now)
+
+    tasks = [asyncio.create_task(caller()) for _ in range(concurrency)]
+    await asyncio.sleep(duration)
+    for t in tasks:
+        t.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return sorted(sent)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="SmartRateLimiter 微基准")
+    parser.add_argument("--rpm", type=int, default=60, help="配置的RPM限制")
+    parser.add_argument("--window", type=float, default=3.0, help="压缩后的窗口长度(秒)，真实为60")
+    parser.add_argument("--windows", type=int, default=3, help="每个场景运行的窗口数")
+    parser.add_argument("--base-delay", type=float, default=2.0, help="基础延迟(真实秒)")
+    parser.add_argument("--jitter", type=float, default=1.0, help="抖动范围(真实秒)")
+    args = parser.parse_args()
+
+    scale = args.window / 60.0
+    duration = args.window * args.windows
+
+    print(f"配置RPM={args.rpm}, 延迟={args.base_delay}s+抖动{args.jitter}s, 时间压缩比={1 / scale:.0f}x")
+    print(f"{'并发':>6} {'实现':>8} {'实际RPM':>10} {'占配置比例':>10} {'最小间隔(真实秒)':>16}")
+    for concurrency in (1, 10, 100):
+        for name in ("legacy", "new"):
+            if name == "legacy":
+                limiter = LegacyRateLimiter(args.rpm, args.base_delay * scale, args.jitter * scale, args.window)
+            else:
+                limiter = SmartRateLimiter(
+                    rpm_limit=args.rpm,
+                    base_delay=args.base_delay * scale,
+                    jitter_range=args.jitter * scale,
+                    window=args.window,
+                )
+            sent = await run_case(limiter, concurrency, duration)
+            achieved_rpm = len(sent) / args.windows
+            min_gap = min((b - a for a, b in zip(sent, sent[1:])), default=0.0) / scale
+            print(f"{concurrency:>6} {name:>8} {achieved_rpm:>10.1f} {achieved_rpm / args.rpm:>10.0%} {min_gap:>16.2f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+WatermarkRemover 基准
+对比旧实现(逐像素逐通道Python循环)与新实现(NumPy向量化)的耗时，并校验输出逐位一致
+
+未找到 bg_48.png / bg_96.png 时，使用覆盖全部256个Alpha等级的合成Alpha资产。
+
+用法:
+    python benchmarks/bench_watermark.py --repeat 5
+"""
+import argparse
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from watermark_remover import (  # noqa: E402
+    ALPHA_THRESHOLD,
+    LOGO_VALUE,
+    MAX_ALPHA,
+    WatermarkRemover,
+)
+
+
+def legacy_load_alpha_map(bg_path: Path, size: int) -> np.ndarray:
+    bg_array = np.array(Image.open(bg_path).convert("RGBA"))
+    alpha_map = np.zeros((size, size), dtype=np.float32)
+    for i in range(size):
+        for j in range(size):
+            r, g, b, _ = bg_array[i, j]
+            alpha_map[i, j] = max(r, g, b) / 255.0
+    return alpha_map
+
+
+def legacy_remove_watermark(remover: WatermarkRemover, image_array: np.ndarray, alpha_map: np.ndarray) -> np.ndarray:
+    height, width = image_array.shape[:2]
+    config = remover.detect_watermark_config(width, height)
+    position = remover.calculate_watermark_position(width, height, config)
+    x, y, wm_width, wm_height = position["x"], position["y"], position["width"], position["height"]
+
+    for row in range(wm_height):
+        for col in range(wm_width):
+            img_y, img_x = y + row, x + col
+            if img_y >= height or img_x >= width:
+                continue
+            alpha = alpha_map[row, col]
+            if alpha < ALPHA_THRESHOLD:
+                continue
+            alpha = min(alpha, MAX_ALPHA)
+            one_minus_alpha = 1.0 - alpha
+            for c in range(3):
+                watermarked = image_array[img_y, img_x, c]
+                original = (watermarked - alpha * LOGO_VALUE) / one_minus_alpha
+                image_array[img_y, img_x, c] = np.clip(np.round(original), 0, 255)
+    return image_array
+
+
+def write_synthetic_assets(asset_dir: Path):
+    rng = np.random.default_rng(0)
+    for size in (48, 96):
+        levels = np.resize(np.arange(256, dtype=np.uint8), size * size)
+        rng.shuffle(levels)
+        rgb = np.stack([levels.reshape(size, size)] * 3, axis=-1)
+        alpha = np.full((size, size, 1), 255, dtype=np.uint8)
+        Image.fromarray(np.concatenate([rgb, alpha], axis=-1), "RGBA").save(asset_dir / f"bg_{size}.png")
+
+
+def best_of(repeat: int, func, setup=None) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        arg = setup() if setup else None
+        start = time.perf_counter()
+        func(arg) if setup else func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="WatermarkRemover 基准")
+    parser.add_argument("--repeat", type=int, default=5, help="每项重复次数（取最好成绩）")
+    args = parser.parse_args()
+
+    asset_dir = Path(__file__).resolve().parent.parent
+    tmp = None
+    if not (asset_dir / "bg_48.png").exists() or not (asset_dir / "bg_96.png").exists():
+        tmp = tempfile.TemporaryDirectory()
+        asset_dir = Path(tmp.name)
+        write_synthetic_assets(asset_dir)
+        print(f"使用合成Alpha资产: {asset_dir}")
+
+    remover = WatermarkRemover(asset_dir=asset_dir)
+    rng = np.random.default_rng(42)
+
+    for size in (48, 96):
+        legacy_map = legacy_load_alpha_map(asset_dir / f"bg_{size}.png", size)
+        remover._alpha_maps.pop(size, None)
+        assert np.array_equal(legacy_map, remover.load_alpha_map(size)), "Alpha映射不一致"
+        t_old = best_of(args.repeat, lambda: legacy_load_alpha_map(asset_dir / f"bg_{size}.png", size))
+        t_new = best_of(args.repeat, lambda: (remover._alpha_maps.pop(size, None), remover.load_alpha_map(size)))
+        print(f"load_alpha_map({size}): 旧 {t_old * 1000:8.2f}ms  新 {t_new * 1000:8.2f}ms  加速 {t_old / t_new:6.1f}x")
+
+    for side in (1024, 4096):
+        for channels in (3, 4):
+            image = rng.integers(0, 256, size=(side, side, channels), dtype=np.uint8)
+            config = remover.detect_watermark_config(side, side)
+            alpha_map = remover.load_alpha_map(config["logoSize"])
+
+            expected = legacy_remove_watermark(remover, image.copy(), alpha_map)
+            actual = remover.remove_watermark(image.copy())
+            assert np.array_equal(expected, actual), f"{side}² 输出不一致"
+
+            t_old = best_of(args.repeat, lambda img: legacy_remove_watermark(remover, img, alpha_map), image.copy)
+            t_new = best_of(args.repeat, remover.remove_watermark, image.copy)
+            print(f"remove_watermark {side}²x{channels}: 旧 {t_old * 1000:8.2f}ms  新 {t_new * 1000:8.3f}ms  "
+                  f"加速 {t_old / t_new:7.1f}x  (逐位一致)")
+
+    if tmp:
+        tmp.cleanup()
+
+
+if __name__ == "__main__":
+    main()
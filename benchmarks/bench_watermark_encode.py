@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+去水印端到端基准（字节流 -> 字节流）
+对比旧路径(整图转数组 + 默认级别PNG)与新路径(只处理水印区域 + 快速PNG / 保持源格式)的耗时与输出体积，
+PNG输出校验像素逐位一致
+
+测试图为合成的照片类内容（渐变 + 噪声 + 轻度模糊）；未找到 bg_48.png / bg_96.png 时使用合成Alpha资产。
+
+用法:
+    python benchmarks/bench_watermark_encode.py --repeat 3
+"""
+import argparse
+import io
+import sys
+import tempfile
+from pathlib import Path
+
+import numpy as np
+from PIL import Image, ImageFilter
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from bench_watermark import best_of, write_synthetic_assets  # noqa: E402
+from watermark_remover import WatermarkRemover  # noqa: E402
+
+
+def synthetic_photo(side: int, seed: int = 0) -> Image.Image:
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:side, 0:side].astype(np.float32) / side
+    base = np.stack([np.sin(x * 7 + y * 3) * 0.5 + 0.5, np.cos(x * 5 - y * 4) * 0.5 + 0.5, x * y], axis=-1) * 200 + 20
+    base += rng.normal(0, 6, base.shape)
+    return Image.fromarray(np.clip(base, 0, 255).astype(np.uint8)).filter(ImageFilter.GaussianBlur(1.5))
+
+
+def legacy_remove_from_bytes(remover: WatermarkRemover, image_bytes: bytes) -> bytes:
+    image_array = np.array(Image.open(io.BytesIO(image_bytes)))
+    remover.remove_watermark(image_array)
+    output = io.BytesIO()
+    Image.fromarray(image_array).save(output, format="PNG")
+    return output.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="去水印端到端基准")
+    parser.add_argument("--repeat", type=int, default=3, help="每项重复次数（取最好成绩）")
+    args = parser.parse_args()
+
+    asset_dir = Path(__file__).resolve().parent.parent
+    tmp = None
+    if not (asset_dir / "bg_48.png").exists() or not (asset_dir / "bg_96.png").exists():
+        tmp = tempfile.TemporaryDirectory()
+        asset_dir = Path(tmp.name)
+        write_synthetic_assets(asset_dir)
+        print(f"使用合成Alpha资产: {asset_dir}")
+
+    legacy = WatermarkRemover(asset_dir=asset_dir)
+    fast = WatermarkRemover(asset_dir=asset_dir)
+    keep = WatermarkRemover(asset_dir=asset_dir, keep_source_format=True)
+
+    for side, label in ((2048, "2K"), (4096, "4K")):
+        photo = synthetic_photo(side)
+        sources = {}
+        for fmt in ("PNG", "JPEG"):
+            buffer = io.BytesIO()
+            photo.save(buffer, format=fmt, **({"quality": 95} if fmt == "JPEG" else {}))
+            sources[fmt] = buffer.getvalue()
+
+        for source_fmt, data in sources.items():
+            expected = np.array(Image.open(io.BytesIO(legacy_remove_from_bytes(legacy, data))))
+            actual = np.array(Image.open(io.BytesIO(fast.remove_from_bytes(data))))
+            assert np.array_equal(expected, actual), f"{label} {source_fmt} 像素不一致"
+
+            cases = [("旧: 整图数组+PNG默认", lambda: legacy_remove_from_bytes(legacy, data)),
+                     ("新: 水印区域+快速PNG", lambda: fast.remove_from_bytes(data))]
+            if source_fmt != "PNG":
+                cases.append(("新: 保持源格式", lambda: keep.remove_from_bytes(data)))
+
+            print(f"{label} {source_fmt}源图 ({len(data) / 1e6:.2f}MB):")
+            baseline = None
+            for name, func in cases:
+                elapsed = best_of(args.repeat, func)
+                size = len(func())
+                baseline = baseline or elapsed
+                print(f"  {name:<20} {elapsed * 1000:8.1f}ms  {size / 1e6:6.2f}MB  加速 {baseline / elapsed:5.1f}x")
+
+    if tmp:
+        tmp.cleanup()
+
+
+if __name__ == "__main__":
+    main()
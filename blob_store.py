@@ -0,0 +1,146 @@
+"""
+内容寻址Blob存储
+功能: 批量任务的输出按SHA-256存放在本地分片目录(ab/cd/<hash>)，任务表只保存引用/大小/哈希；相同内容只存一份，写入原子化；
+      任务过期后删除不再被引用的blob，并定期清扫没有任务引用的孤立blob
+关键词: blob, content-addressed, sha256, sharding, atomic-write, gc, sweep
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import tempfile
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterable, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+REF_PREFIX = "sha256:"
+
+
+@dataclass
+class BlobRef:
+    """已写入的blob；ref写入tasks.output_ref"""
+    hash: str
+    size: int
+    mime: str
+
+    @property
+    def ref(self) -> str:
+        return f"{REF_PREFIX}{self.hash}"
+
+
+def parse_ref(ref: Optional[str]) -> Optional[str]:
+    """从引用中取出哈希；不是blob引用时返回None"""
+    if not ref or not ref.startswith(REF_PREFIX):
+        return None
+    digest = ref[len(REF_PREFIX):]
+    if len(digest) != 64 or any(c not in "0123456789abcdef" for c in digest):
+        return None
+    return digest
+
+
+class BlobStore:
+    """本地目录上的内容寻址存储（多个worker进程共享同一目录时也安全）"""
+
+    def __init__(self, root: Path):
+        self.root = Path(root)
+        self.writes = 0
+        self.dedup_hits = 0
+        self.bytes_written = 0
+        self.deleted = 0
+
+    def path_for(self, digest: str) -> Path:
+        return self.root / digest[:2] / digest[2:4] / digest
+
+    def put(self, data: bytes, mime: str = "application/octet-stream") -> BlobRef:
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path_for(digest)
+        if path.exists():
+            # 刷新修改时间：新任务即将引用它，清理时不会被当作过期blob删除
+            try:
+                os.utime(path)
+                self.dedup_hits += 1
+                return BlobRef(digest, len(data), mime)
+            except FileNotFoundError:
+                pass  # 恰好被清理删除，重新写入
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # 先写临时文件再rename，读取方不会看到写了一半的文件
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.writes += 1
+        self.bytes_written += len(data)
+        return BlobRef(digest, len(data), mime)
+
+    async def put_async(self, data: bytes, mime: str = "application/octet-stream") -> BlobRef:
+        return await asyncio.to_thread(self.put, data, mime)
+
+    def open_path(self, ref: str) -> Optional[Path]:
+        """引用对应的文件路径，不存在时返回None"""
+        digest = parse_ref(ref)
+        if digest is None:
+            return None
+        path = self.path_for(digest)
+        return path if path.exists() else None
+
+    def delete(self, ref: str) -> bool:
+        path = self.open_path(ref)
+        if path is None:
+            return False
+        path.unlink(missing_ok=True)
+        return True
+
+    # ============ 清理 ============
+    def _remove_if_older(self, path: Path, cutoff: float) -> bool:
+        try:
+            if path.stat().st_mtime >= cutoff:
+                return False
+            path.unlink()
+        except FileNotFoundError:
+            return False
+        self.deleted += 1
+        return True
+
+    def delete_unreferenced(self, refs: Iterable[str], min_age: float = 3600.0) -> int:
+        """删除已无任务引用的blob；min_age内写入/重新引用过的跳过（可能有并发任务正要引用）"""
+        cutoff = time.time() - min_age
+        removed = 0
+        for ref in refs:
+            digest = parse_ref(ref)
+            if digest is not None and self._remove_if_older(self.path_for(digest), cutoff):
+                removed += 1
+        return removed
+
+    def sweep(self, referenced: Set[str], min_age: float = 3600.0) -> int:
+        """删除目录中不在referenced(哈希集合)里的blob及残留的临时文件，返回删除数
+
+        覆盖blob写入后任务未能保存引用(进程崩溃、租约丢失)等情况；min_age保护正在写入/即将引用的文件。
+        """
+        cutoff = time.time() - min_age
+        removed = 0
+        if not self.root.exists():
+            return 0
+        for path in self.root.glob("*/*/*"):
+            if path.name in referenced or not path.is_file():
+                continue
+            if self._remove_if_older(path, cutoff):
+                removed += 1
+        return removed
+
+    def get_stats(self) -> dict:
+        return {
+            "root": str(self.root),
+            "writes": self.writes,
+            "dedup_hits": self.dedup_hits,
+            "bytes_written": self.bytes_written,
+            "deleted": self.deleted,
+        }
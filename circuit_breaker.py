@@ -0,0 +1,199 @@
+"""
+熔断器
+功能: 按滚动时间窗口内的错误率/慢调用率在 closed/open/half-open 间切换，open期间直接跳过后端，定期探活恢复，并记录状态变迁历史
+关键词: circuit-breaker, half-open, error-rate, slow-call, probe, health-score
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+from datetime import datetime
+from typing import Awaitable, Callable, Deque, Tuple
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """滚动窗口熔断器（单事件循环内使用，无需加锁）"""
+
+    def __init__(
+        self,
+        name: str,
+        window: float = 60.0,
+        min_requests: int = 10,
+        error_rate_threshold: float = 0.5,
+        slow_call_threshold: float = 5.0,
+        slow_rate_threshold: float = 0.8,
+        open_duration: float = 30.0,
+        half_open_max_calls: int = 1,
+        history_size: int = 20,
+    ):
+        """
+        Args:
+            name: 名称（用于日志）
+            window: 统计窗口(秒)
+            min_requests: 窗口内请求数达到该值才会判断是否熔断
+            error_rate_threshold: 错误率阈值
+            slow_call_threshold: 慢调用耗时阈值(秒)
+            slow_rate_threshold: 慢调用率阈值
+            open_duration: 熔断持续时间(秒)，之后进入half-open
+            half_open_max_calls: half-open时允许同时试探的请求数
+            history_size: 保留的状态变迁记录数
+        """
+        self.name = name
+        self.window = window
+        self.min_requests = min_requests
+        self.error_rate_threshold = error_rate_threshold
+        self.slow_call_threshold = slow_call_threshold
+        self.slow_rate_threshold = slow_rate_threshold
+        self.open_duration = open_duration
+        self.half_open_max_calls = half_open_max_calls
+
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self._half_open_in_flight = 0
+        # (时间, 是否成功, 耗时)
+        self._calls: Deque[Tuple[float, bool, float]] = deque()
+        self.history: Deque[dict] = deque(maxlen=history_size)
+
+        self.rejected = 0
+        self.probes = 0
+
+    # ============ 状态 ============
+    def _transition(self, state: str, reason: str):
+        if state == self.state:
+            return
+        self.history.append({
+            "from": self.state,
+            "to": state,
+            "reason": reason,
+            "at": datetime.now().isoformat(timespec="seconds"),
+        })
+        logger.warning(f"[Breaker:{self.name}] {self.state} -> {state} ({reason})")
+        self.state = state
+        self._half_open_in_flight = 0
+        if state == OPEN:
+            self.opened_at = time.monotonic()
+        elif state == CLOSED:
+            self._calls.clear()
+
+    def _prune(self, now: float):
+        while self._calls and self._calls[0][0] < now - self.window:
+            self._calls.popleft()
+
+    def _rates(self) -> Tuple[float, float]:
+        total = len(self._calls)
+        if not total:
+            return 0.0, 0.0
+        errors = sum(1 for _, ok, _ in self._calls if not ok)
+        slow = sum(1 for _, _, latency in self._calls if latency >= self.slow_call_threshold)
+        return errors / total, slow / total
+
+    def _evaluate(self):
+        if len(self._calls) < self.min_requests:
+            return
+        error_rate, slow_rate = self._rates()
+        if error_rate >= self.error_rate_threshold:
+            self._transition(OPEN, f"错误率 {error_rate:.0%}")
+        elif slow_rate >= self.slow_rate_threshold:
+            self._transition(OPEN, f"慢调用率 {slow_rate:.0%}")
+
+    # ============ 调用方接口 ============
+    def _acquire(self) -> bool:
+        if self.state == OPEN:
+            if time.monotonic() - self.opened_at < self.open_duration:
+                return False
+            self._transition(HALF_OPEN, "熔断时间结束")
+
+        if self.state == HALF_OPEN:
+            if self._half_open_in_flight >= self.half_open_max_calls:
+                return False
+            self._half_open_in_flight += 1
+        return True
+
+    def allow_request(self) -> bool:
+        """是否允许调用后端；half-open时占用一个试探名额，调用结束后必须record_*或release"""
+        if self._acquire():
+            return True
+        self.rejected += 1
+        return False
+
+    def record_success(self, latency: float):
+        if self.state == HALF_OPEN:
+            if latency < self.slow_call_threshold:
+                self._transition(CLOSED, "试探请求成功")
+            else:
+                self._transition(OPEN, f"试探请求过慢 {latency:.1f}s")
+            return
+        now = time.monotonic()
+        self._calls.append((now, True, latency))
+        self._prune(now)
+        self._evaluate()
+
+    def record_failure(self, latency: float):
+        if self.state == HALF_OPEN:
+            self._transition(OPEN, "试探请求失败")
+            return
+        now = time.monotonic()
+        self._calls.append((now, False, latency))
+        self._prune(now)
+        self._evaluate()
+
+    def release(self):
+        """调用被取消或结果不计入统计时释放half-open试探名额"""
+        if self.state == HALF_OPEN and self._half_open_in_flight > 0:
+            self._half_open_in_flight -= 1
+
+    # ============ 定期探活 ============
+    async def probe_loop(self, probe: Callable[[], Awaitable[bool]], interval: float):
+        """熔断期间定期探活；探活成功直接关闭熔断，不必等真实请求试探"""
+        while True:
+            await asyncio.sleep(interval)
+            if self.state == CLOSED:
+                continue
+            # 探活不是真实请求，熔断期间跳过的探活不计入rejected
+            if not self._acquire():
+                continue
+            self.probes += 1
+            started = time.monotonic()
+            try:
+                healthy = await probe()
+            except asyncio.CancelledError:
+                self.release()
+                raise
+            except Exception as e:
+                logger.info(f"[Breaker:{self.name}] 探活失败: {e}")
+                healthy = False
+            if healthy:
+                self.record_success(time.monotonic() - started)
+            else:
+                self.record_failure(time.monotonic() - started)
+
+    def get_stats(self) -> dict:
+        now = time.monotonic()
+        self._prune(now)
+        error_rate, slow_rate = self._rates()
+        latencies = sorted(latency for _, _, latency in self._calls)
+
+        def percentile(p: float) -> float:
+            if not latencies:
+                return 0.0
+            return round(latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000, 1)
+
+        health_score = 0.0 if self.state == OPEN else (1 - error_rate) * (1 - 0.5 * slow_rate)
+        return {
+            "state": self.state,
+            "health_score": round(health_score, 3),
+            "window_requests": len(self._calls),
+            "error_rate": round(error_rate, 3),
+            "slow_rate": round(slow_rate, 3),
+            "latency_ms": {"p50": percentile(0.5), "p95": percentile(0.95)},
+            "open_remaining": round(max(0.0, self.open_duration - (now - self.opened_at)), 1) if self.state == OPEN else 0.0,
+            "rejected": self.rejected,
+            "probes": self.probes,
+            "history": list(self.history),
+        }
@@ -0,0 +1,301 @@
+"""
+多账号Cookie客户端池
+功能: 每个账号独立的GeminiClient + 速率控制 + 并发槽位，按负载和健康状态选择账号
+关键词: cookie, multi-account, pool, least-loaded, health, cooldown
+"""
+import asyncio
+import json
+import logging
+import time
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import AsyncIterator, Callable, Dict, List, Optional, Set
+
+from smart_rate_limiter import SmartRateLimiter
+
+logger = logging.getLogger(__name__)
+
+COOKIE_KEYS = ("__Secure-1PSID", "__Secure-1PSIDCC", "__Secure-1PSIDTS")
+
+# 连续失败达到阈值后进入冷却，冷却时间指数增长
+FAILURE_THRESHOLD = 3
+BASE_COOLDOWN = 30.0
+MAX_COOLDOWN = 300.0
+
+# 被替换/移除的账号等待进行中的请求结束后再关闭客户端，超时后强制关闭
+DRAIN_TIMEOUT = 300.0
+
+
+class NoAvailableAccountError(Exception):
+    """没有可用的Cookie账号"""
+    pass
+
+
+def _default_client_factory():
+    from gemini_webapi import GeminiClient
+    return GeminiClient()
+
+
+class CookieAccount:
+    """单个Cookie账号"""
+
+    def __init__(
+        self,
+        name: str,
+        cookies: Dict[str, str],
+        max_concurrency: int,
+        rate_limiter: SmartRateLimiter,
+    ):
+        self.name = name
+        self.cookies = {k: cookies.get(k) for k in COOKIE_KEYS}
+        self.max_concurrency = max_concurrency
+        self.rate_limiter = rate_limiter
+        self.client = None
+
+        self.in_flight = 0
+        self.waiting = 0
+        self.total_requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.cooldown_until = 0.0
+        self.last_error: Optional[str] = None
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    def _update_idle(self):
+        if self.in_flight or self.waiting:
+            self._idle.clear()
+        else:
+            self._idle.set()
+
+    async def init(self, client_factory: Callable):
+        client = client_factory()
+        client.cookies = dict(self.cookies)
+        await client.init()
+        self.client = client
+
+    async def close(self):
+        if self.client:
+            try:
+                await self.client.close()
+            except Exception:
+                pass
+            self.client = None
+
+    async def drain_and_close(self, timeout: float = DRAIN_TIMEOUT):
+        """等待占用中与排队中的请求全部结束后关闭客户端（账号需已退出选择）"""
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"[Cookie:{self.name}] 等待{self.in_flight}个进行中请求超时，强制关闭客户端")
+        await self.close()
+
+    @property
+    def load(self) -> float:
+        return (self.in_flight + self.waiting) / self.max_concurrency
+
+    def is_healthy(self, now: float = None) -> bool:
+        now = now if now is not None else time.monotonic()
+        return self.client is not None and now >= self.cooldown_until
+
+    def report_success(self):
+        self.consecutive_failures = 0
+        self.cooldown_until = 0.0
+        self.rate_limiter.report_success()
+
+    def report_failure(self, error: Exception, rate_limited: bool = False):
+        self.failures += 1
+        self.consecutive_failures += 1
+        self.last_error = str(error)[:200]
+        if rate_limited:
+            self.rate_limiter.report_rate_limit()
+        if self.consecutive_failures >= FAILURE_THRESHOLD:
+            cooldown = min(MAX_COOLDOWN, BASE_COOLDOWN * 2 ** (self.consecutive_failures - FAILURE_THRESHOLD))
+            self.cooldown_until = time.monotonic() + cooldown
+            logger.warning(f"[Cookie:{self.name}] 连续失败{self.consecutive_failures}次，冷却 {cooldown:.0f}s")
+
+    def get_stats(self) -> dict:
+        now = time.monotonic()
+        return {
+            "name": self.name,
+            "ready": self.client is not None,
+            "healthy": self.is_healthy(now),
+            "max_concurrency": self.max_concurrency,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "total_requests": self.total_requests,
+            "failures": self.failures,
+            "consecutive_failures": self.consecutive_failures,
+            "cooldown_remaining": round(max(0.0, self.cooldown_until - now), 1),
+            "last_error": self.last_error,
+            "rate_limiter": self.rate_limiter.get_stats(),
+        }
+
+
+class CookieClientPool:
+    """Cookie账号池"""
+
+    def __init__(
+        self,
+        default_max_concurrency: int = 2,
+        rate_limit_config: Optional[dict] = None,
+        client_factory: Callable = _default_client_factory,
+    ):
+        """
+        Args:
+            default_max_concurrency: 账号默认并发槽位数
+            rate_limit_config: SmartRateLimiter参数 (rpm_limit/base_delay/max_delay/jitter_range/backoff_multiplier)
+            client_factory: 创建GeminiClient的工厂函数
+        """
+        self.default_max_concurrency = default_max_concurrency
+        self.rate_limit_config = dict(rate_limit_config or {})
+        self.client_factory = client_factory
+        self.accounts: Dict[str, CookieAccount] = {}
+        self._retiring: Dict[asyncio.Task, CookieAccount] = {}
+
+    # ============ 账号管理 ============
+    async def add_account(
+        self,
+        name: str,
+        cookies: Dict[str, str],
+        max_concurrency: Optional[int] = None,
+        rpm_limit: Optional[int] = None,
+    ) -> CookieAccount:
+        """添加或替换账号；初始化失败时抛出异常，原账号保持不变"""
+        rate_config = dict(self.rate_limit_config)
+        if rpm_limit:
+            rate_config["rpm_limit"] = rpm_limit
+        account = CookieAccount(
+            name,
+            cookies,
+            max_concurrency or self.default_max_concurrency,
+            SmartRateLimiter(**rate_config),
+        )
+        await account.init(self.client_factory)
+
+        old = self.accounts.get(name)
+        self.accounts[name] = account
+        if old:
+            self._retire(old)
+        logger.info(f"[Cookie:{name}] 账号已加入 (并发={account.max_concurrency})")
+        return account
+
+    async def remove_account(self, name: str) -> bool:
+        account = self.accounts.pop(name, None)
+        if not account:
+            return False
+        self._retire(account)
+        logger.info(f"[Cookie:{name}] 账号已移除")
+        return True
+
+    def _retire(self, account: CookieAccount):
+        """账号已从选择中移除；进行中的请求仍在使用其客户端，排空后在后台关闭"""
+        task = asyncio.create_task(account.drain_and_close())
+        self._retiring[task] = account
+        task.add_done_callback(lambda t: self._retiring.pop(t, None))
+
+    def get(self, name: str) -> Optional[CookieAccount]:
+        return self.accounts.get(name)
+
+    async def close(self):
+        for task, account in list(self._retiring.items()):
+            task.cancel()
+            await account.close()
+        self._retiring.clear()
+        for account in list(self.accounts.values()):
+            await account.close()
+        self.accounts.clear()
+
+    @property
+    def ready(self) -> bool:
+        return any(a.client is not None for a in self.accounts.values())
+
+    def primary_client(self):
+        """第一个可用账号的客户端（兼容只使用单个gemini_client的代码）"""
+        for account in self.accounts.values():
+            if account.client is not None:
+                return account.client
+        return None
+
+    @property
+    def total_slots(self) -> int:
+        return sum(a.max_concurrency for a in self.accounts.values() if a.client is not None)
+
+    # ============ 账号选择 ============
+    def select(self) -> CookieAccount:
+        """选择负载最低的健康账号；全部冷却中时选择最早恢复的账号"""
+        now = time.monotonic()
+        ready = [a for a in self.accounts.values() if a.client is not None]
+        if not ready:
+            raise NoAvailableAccountError("没有可用的Cookie账号")
+
+        healthy = [a for a in ready if a.is_healthy(now)]
+        if not healthy:
+            return min(ready, key=lambda a: a.cooldown_until)
+        return min(healthy, key=lambda a: (a.load, a.rate_limiter.current_delay))
+
+    @asynccontextmanager
+    async def acquire(self) -> AsyncIterator[CookieAccount]:
+        """占用一个账号的并发槽位"""
+        account = self.select()
+        account.waiting += 1
+        account._update_idle()
+        try:
+            await account._semaphore.acquire()
+        except BaseException:
+            account.waiting -= 1
+            account._update_idle()
+            raise
+
+        # 先计入in_flight再减waiting，排空等待方不会看到短暂的空闲
+        account.waiting -= 1
+        account.in_flight += 1
+        account.total_requests += 1
+        try:
+            yield account
+        finally:
+            account.in_flight -= 1
+            account._semaphore.release()
+            account._update_idle()
+
+    # ============ 持久化与统计 ============
+    @staticmethod
+    def load_accounts_file(path: Path) -> List[dict]:
+        """读取账号配置文件: [{"name", "cookies", "max_concurrency", "rpm_limit"}]"""
+        if not path.exists():
+            return []
+        try:
+            with open(path, "r") as f:
+                data = json.load(f)
+            return [a for a in data if a.get("name") and a.get("cookies")]
+        except Exception as e:
+            logger.error(f"读取Cookie账号文件失败: {e}")
+            return []
+
+    def save_accounts_file(self, path: Path, exclude: tuple = ()):
+        data = [
+            {
+                "name": a.name,
+                "cookies": dict(a.client.cookies) if a.client and getattr(a.client, "cookies", None) else a.cookies,
+                "max_concurrency": a.max_concurrency,
+                "rpm_limit": a.rate_limiter.rpm_limit,
+            }
+            for a in self.accounts.values() if a.name not in exclude
+        ]
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with open(path, "w") as f:
+                json.dump(data, f, indent=2)
+        except Exception as e:
+            logger.error(f"保存Cookie账号文件失败: {e}")
+
+    def get_stats(self) -> dict:
+        accounts = [a.get_stats() for a in self.accounts.values()]
+        return {
+            "accounts": accounts,
+            "total_slots": self.total_slots,
+            "in_flight": sum(a["in_flight"] for a in accounts),
+            "healthy": sum(1 for a in accounts if a["healthy"]),
+            "retiring": len(self._retiring),
+        }
@@ -0,0 +1,139 @@
+"""
+对冲请求 (hedged requests)
+功能: 主后端超过历史延迟分位数仍未返回时，向备用后端发起相同请求，取先成功者并取消另一个；对冲次数受预算限制
+关键词: hedging, tail-latency, percentile, budget, race
+"""
+import asyncio
+import logging
+from collections import Counter, deque
+from typing import Any, Awaitable, Callable, Deque, Optional
+
+from retry_engine import RetryBudget
+
+logger = logging.getLogger(__name__)
+
+
+class HedgeFailedError(Exception):
+    """主请求与对冲请求都失败；error为对冲(备用)后端的异常"""
+
+    def __init__(self, error: BaseException):
+        super().__init__(str(error))
+        self.error = error
+
+
+class Hedger:
+    """主/备两个后端之间的对冲执行器"""
+
+    def __init__(
+        self,
+        percentile: float = 0.95,
+        min_delay: float = 0.5,
+        max_delay: float = 10.0,
+        default_delay: float = 2.0,
+        min_samples: int = 20,
+        history_size: int = 500,
+        budget: Optional[RetryBudget] = None,
+        primary_name: str = "provider",
+        hedge_name: str = "cookie",
+    ):
+        """
+        Args:
+            percentile: 对冲延迟取主后端历史延迟的分位数
+            min_delay / max_delay: 对冲延迟上下限(秒)
+            default_delay: 样本不足时的对冲延迟(秒)
+            min_samples: 使用分位数所需的最少样本数
+            history_size: 保留的主后端延迟样本数
+            budget: 对冲预算 (窗口内对冲次数占请求数的上限)
+        """
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.default_delay = default_delay
+        self.min_samples = min_samples
+        self.budget = budget or RetryBudget(ratio=0.1, min_retries=5)
+        self.primary_name = primary_name
+        self.hedge_name = hedge_name
+        self._latencies: Deque[float] = deque(maxlen=history_size)
+
+        self.requests = 0
+        self.hedged = 0
+        self.budget_denied = 0
+        self.censored = 0
+        self.wins: Counter = Counter()
+
+    def record_latency(self, latency: float, censored: bool = False):
+        """记录主后端请求的耗时
+
+        censored=True 表示请求被取消(如对冲中落败)，真实耗时至少为latency。只记录慢请求会让分位数持续偏低，
+        因此不短于当前对冲延迟的取消样本按下限值计入；更短的取消样本信息不足，忽略。
+        """
+        if censored:
+            if latency < self.hedge_delay():
+                return
+            self.censored += 1
+        self._latencies.append(latency)
+
+    def hedge_delay(self) -> float:
+        if len(self._latencies) < self.min_samples:
+            return self.default_delay
+        latencies = sorted(self._latencies)
+        value = latencies[min(len(latencies) - 1, int(self.percentile * len(latencies)))]
+        return min(self.max_delay, max(self.min_delay, value))
+
+    async def run(self, primary: Callable[[], Awaitable], hedge: Callable[[], Awaitable]) -> Any:
+        """执行主请求，超过对冲延迟后并发执行备用请求
+
+        主请求在对冲前失败时直接抛出其异常（由调用方按原逻辑fallback）；
+        对冲后两者都失败时抛出 HedgeFailedError。
+        """
+        self.requests += 1
+        self.budget.record_request()
+
+        primary_task = asyncio.ensure_future(primary())
+        delay = self.hedge_delay()
+        try:
+            done, _ = await asyncio.wait({primary_task}, timeout=delay)
+            if done:
+                result = primary_task.result()
+                self.wins[self.primary_name] += 1
+                return result
+
+            if not self.budget.try_spend():
+                self.budget_denied += 1
+                result = await primary_task
+                self.wins[self.primary_name] += 1
+                return result
+
+            self.hedged += 1
+            logger.info(f"[Hedge] {self.primary_name} 超过 {delay:.2f}s 未返回，对冲请求 {self.hedge_name}")
+            hedge_task = asyncio.ensure_future(hedge())
+            names = {primary_task: self.primary_name, hedge_task: self.hedge_name}
+            try:
+                pending = {primary_task, hedge_task}
+                while pending:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        if not task.cancelled() and task.exception() is None:
+                            self.wins[names[task]] += 1
+                            return task.result()
+                error = hedge_task.exception() if not hedge_task.cancelled() else asyncio.CancelledError()
+                raise HedgeFailedError(error)
+            finally:
+                if not hedge_task.done():
+                    hedge_task.cancel()
+        finally:
+            if not primary_task.done():
+                primary_task.cancel()
+
+    def get_stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "hedged": self.hedged,
+            "hedge_rate": round(self.hedged / self.requests, 3) if self.requests else 0.0,
+            "budget_denied": self.budget_denied,
+            "wins": dict(self.wins),
+            "delay": round(self.hedge_delay(), 3),
+            "samples": len(self._latencies),
+            "censored": self.censored,
+            "budget": self.budget.get_stats(),
+        }
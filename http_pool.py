@@ -0,0 +1,157 @@
+"""
+共享HTTP连接池
+功能: 进程内复用 httpx.AsyncClient (keep-alive / 可选HTTP/2)，并统计连接复用情况
+关键词: httpx, connection-pool, keep-alive, http2, reuse-ratio
+"""
+import logging
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Optional
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# httpcore trace事件: 每建立一条新TCP连接触发一次
+_NEW_CONNECTION_EVENT = "connection.connect_tcp.complete"
+
+
+def http2_available() -> bool:
+    """检测是否安装了HTTP/2依赖(h2)"""
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+class PooledHTTPClient:
+    """长连接复用的共享AsyncClient，由lifespan负责启动与关闭"""
+
+    def __init__(
+        self,
+        name: str,
+        timeout: float = 10.0,
+        max_connections: int = 100,
+        max_keepalive_connections: int = 20,
+        keepalive_expiry: float = 30.0,
+        http2: bool = False,
+        headers: Optional[Dict[str, str]] = None,
+        **client_kwargs,
+    ):
+        """
+        Args:
+            name: 连接池名称（用于日志与统计）
+            timeout: 默认超时(秒)
+            max_connections: 最大连接数
+            max_keepalive_connections: 最大空闲保活连接数
+            keepalive_expiry: 空闲连接保活时间(秒)
+            http2: 是否启用HTTP/2（需要安装h2，否则回退HTTP/1.1）
+            headers: 默认请求头
+            client_kwargs: 其他传给httpx.AsyncClient的参数 (如follow_redirects)
+        """
+        self.name = name
+        self.timeout = timeout
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.http2 = http2
+        self.headers = headers or {}
+        self.client_kwargs = client_kwargs
+        self.client: Optional[httpx.AsyncClient] = None
+
+        self.requests = 0
+        self.new_connections = 0
+        self.errors = 0
+
+    async def start(self):
+        """创建底层AsyncClient（重复调用无副作用）"""
+        if self.client is not None:
+            return
+        use_http2 = self.http2 and http2_available()
+        if self.http2 and not use_http2:
+            logger.warning(f"[{self.name}] 未安装h2，连接池回退到HTTP/1.1")
+        self.client = httpx.AsyncClient(
+            timeout=self.timeout,
+            limits=self.limits,
+            http2=use_http2,
+            headers=self.headers,
+            **self.client_kwargs,
+        )
+        logger.info(
+            f"[{self.name}] 连接池已启动 (max={self.limits.max_connections}, "
+            f"keepalive={self.limits.max_keepalive_connections}, http2={use_http2})"
+        )
+
+    async def close(self):
+        """关闭连接池"""
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    async def _trace(self, event_name: str, info: dict):
+        if event_name == _NEW_CONNECTION_EVENT:
+            self.new_connections += 1
+
+    async def request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        """发送请求；未在lifespan中启动时自动懒加载"""
+        if self.client is None:
+            await self.start()
+
+        extensions = dict(kwargs.pop("extensions", None) or {})
+        extensions["trace"] = self._trace
+
+        self.requests += 1
+        try:
+            return await self.client.request(method, url, extensions=extensions, **kwargs)
+        except httpx.HTTPError:
+            self.errors += 1
+            raise
+
+    @asynccontextmanager
+    async def stream(self, method: str, url: str, **kwargs) -> AsyncIterator[httpx.Response]:
+        """流式请求；退出上下文时关闭响应（客户端断开时即中止上游请求）"""
+        if self.client is None:
+            await self.start()
+
+        extensions = dict(kwargs.pop("extensions", None) or {})
+        extensions["trace"] = self._trace
+
+        self.requests += 1
+        try:
+            async with self.client.stream(method, url, extensions=extensions, **kwargs) as response:
+                yield response
+        except httpx.HTTPError:
+            self.errors += 1
+            raise
+
+    async def get(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request("POST", url, **kwargs)
+
+    def _pool_connections(self) -> list:
+        # httpx未公开连接池状态，这里读取httpcore连接池（失败时返回空列表）
+        try:
+            return list(self.client._transport._pool.connections)
+        except AttributeError:
+            return []
+
+    def get_stats(self) -> dict:
+        connections = self._pool_connections() if self.client else []
+        idle = sum(1 for conn in connections if conn.is_idle())
+        reused = max(0, self.requests - self.new_connections)
+        return {
+            "started": self.client is not None,
+            "http2": bool(self.client and self.http2 and http2_available()),
+            "max_connections": self.limits.max_connections,
+            "max_keepalive_connections": self.limits.max_keepalive_connections,
+            "open_connections": len(connections),
+            "idle_connections": idle,
+            "requests": self.requests,
+            "new_connections": self.new_connections,
+            "errors": self.errors,
+            "reuse_ratio": round(reused / self.requests, 3) if self.requests else 0.0,
+        }
@@ -0,0 +1,164 @@
+"""
+生成图片下载器
+功能: 共享连接池下载googleusercontent图片，流式读取(限制最大字节数)，按主机限制并发，瞬时错误自动重试
+关键词: image, download, httpx, stream, per-host-limit, retry
+"""
+import asyncio
+import logging
+import random
+from http.cookiejar import CookieJar, DefaultCookiePolicy
+from typing import Dict, Optional, Tuple
+from urllib.parse import urlsplit
+
+import httpx
+
+from http_pool import PooledHTTPClient
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+RETRYABLE_STATUS = (408, 429, 500, 502, 503, 504)
+MAX_REDIRECTS = 10
+
+
+class DownloadError(Exception):
+    """图片下载失败"""
+    pass
+
+
+class _RetryableDownloadError(DownloadError):
+    pass
+
+
+class ImageDownloader:
+    """共享的图片下载子系统"""
+
+    def __init__(
+        self,
+        timeout: float = 60.0,
+        connect_timeout: float = 10.0,
+        max_connections: int = 32,
+        per_host_limit: int = 4,
+        max_bytes: int = 64 * MB,
+        max_attempts: int = 3,
+        backoff: float = 0.5,
+        chunk_size: int = 256 * 1024,
+    ):
+        """
+        Args:
+            timeout: 读取超时(秒)
+            connect_timeout: 连接超时(秒)
+            max_connections: 连接池最大连接数
+            per_host_limit: 单个主机的最大并发下载数
+            max_bytes: 单张图片最大字节数，超过即中止
+            max_attempts: 最大尝试次数（仅瞬时错误重试）
+            backoff: 重试基础退避(秒)，指数增长
+            chunk_size: 流式读取块大小
+        """
+        # 图片Cookie随请求头发送(重定向时由_fetch重新附加)；禁止连接池记录响应Cookie，避免不同账号之间串用
+        no_cookies = CookieJar(policy=DefaultCookiePolicy(allowed_domains=[]))
+        self.pool = PooledHTTPClient(
+            "image-download",
+            timeout=httpx.Timeout(timeout, connect=connect_timeout),
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
+            cookies=no_cookies,
+        )
+        self.per_host_limit = per_host_limit
+        self.max_bytes = max_bytes
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.chunk_size = chunk_size
+        self._host_semaphores: Dict[str, asyncio.Semaphore] = {}
+
+        self.downloads = 0
+        self.retries = 0
+        self.failures = 0
+        self.bytes_downloaded = 0
+
+    async def start(self):
+        await self.pool.start()
+
+    async def close(self):
+        await self.pool.close()
+
+    def _host_semaphore(self, url: str) -> asyncio.Semaphore:
+        host = urlsplit(url).hostname or ""
+        if host not in self._host_semaphores:
+            self._host_semaphores[host] = asyncio.Semaphore(self.per_host_limit)
+        return self._host_semaphores[host]
+
+    @staticmethod
+    def _cookie_header(cookies) -> Optional[str]:
+        if not cookies:
+            return None
+        try:
+            items = cookies.items()
+        except Exception:
+            return None
+        return "; ".join(f"{k}={v}" for k, v in items if v is not None) or None
+
+    async def _fetch(self, url: str, headers: Dict[str, str]) -> Tuple[bytes, str]:
+        for _ in range(MAX_REDIRECTS + 1):
+            async with self.pool.stream("GET", url, headers=headers) as response:
+                if response.next_request is not None:
+                    url = str(response.next_request.url)
+                    continue
+                return await self._read_body(response)
+        raise DownloadError(f"重定向次数超过 {MAX_REDIRECTS}")
+
+    async def _read_body(self, response: httpx.Response) -> Tuple[bytes, str]:
+        if response.status_code in RETRYABLE_STATUS:
+            raise _RetryableDownloadError(f"HTTP {response.status_code}")
+        if response.status_code != 200:
+            raise DownloadError(f"HTTP {response.status_code}")
+
+        content_length = int(response.headers.get("content-length") or 0)
+        if content_length > self.max_bytes:
+            raise DownloadError(f"图片过大: {content_length} 字节")
+
+        chunks = []
+        received = 0
+        async for chunk in response.aiter_bytes(self.chunk_size):
+            received += len(chunk)
+            if received > self.max_bytes:
+                raise DownloadError(f"图片超过 {self.max_bytes} 字节上限")
+            chunks.append(chunk)
+
+        return b"".join(chunks), response.headers.get("content-type", "image/png")
+
+    async def download(self, url: str, cookies=None) -> Tuple[bytes, str]:
+        """下载图片，返回(字节, content-type)；失败抛出DownloadError"""
+        headers = {}
+        cookie_header = self._cookie_header(cookies)
+        if cookie_header:
+            headers["Cookie"] = cookie_header
+
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                async with self._host_semaphore(url):
+                    data, content_type = await self._fetch(url, headers)
+                self.downloads += 1
+                self.bytes_downloaded += len(data)
+                return data, content_type
+            except (_RetryableDownloadError, httpx.TransportError) as e:
+                if attempt == self.max_attempts:
+                    self.failures += 1
+                    raise DownloadError(f"下载失败(已重试{attempt - 1}次): {e}") from e
+                self.retries += 1
+                wait = self.backoff * 2 ** (attempt - 1) + random.uniform(0, self.backoff)
+                logger.warning(f"图片下载失败，{wait:.1f}s后重试 ({attempt}/{self.max_attempts}): {e}")
+                await asyncio.sleep(wait)
+            except DownloadError:
+                self.failures += 1
+                raise
+
+    def get_stats(self) -> dict:
+        return {
+            "downloads": self.downloads,
+            "retries": self.retries,
+            "failures": self.failures,
+            "bytes_downloaded": self.bytes_downloaded,
+            "per_host_limit": self.per_host_limit,
+            "pool": self.pool.get_stats(),
+        }
@@ -0,0 +1,288 @@
+"""
+分阶段图片后处理流水线
+功能: download -> decode -> watermark -> encode -> deliver(上传R2/blob/base64) 五个阶段，阶段之间用有界队列连接，每阶段独立的worker数；多图/批量请求的IO与CPU相互重叠，并统计每阶段耗时与队列深度
+关键词: pipeline, stage, bounded-queue, backpressure, watermark, metrics
+"""
+import asyncio
+import base64 as b64
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass
+from pathlib import PurePosixPath
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+MIME_EXTENSIONS = {"image/png": ".png", "image/jpeg": ".jpg", "image/webp": ".webp", "image/avif": ".avif"}
+
+
+class Done:
+    """阶段处理结果: 提前结束，跳过后续阶段"""
+
+    def __init__(self, value: Any):
+        self.value = value
+
+
+class Stage:
+    """流水线中的一个阶段"""
+
+    def __init__(self, name: str, handler: Callable[[Any], Awaitable[Any]], workers: int = 1,
+                 queue_size: int = 16, history_size: int = 256):
+        self.name = name
+        self.handler = handler
+        self.workers = max(1, workers)
+        self.queue_size = queue_size
+        self.queue: Optional[asyncio.Queue] = None
+        self.busy = 0
+        self.processed = 0
+        self.errors = 0
+        self._latencies: Deque[float] = deque(maxlen=history_size)
+
+    def record(self, latency: float):
+        self.processed += 1
+        self._latencies.append(latency)
+
+    def get_stats(self) -> dict:
+        latencies = sorted(self._latencies)
+
+        def percentile(p: float) -> float:
+            if not latencies:
+                return 0.0
+            return round(latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000, 1)
+
+        return {
+            "workers": self.workers,
+            "busy": self.busy,
+            "queue_depth": self.queue.qsize() if self.queue else 0,
+            "queue_size": self.queue_size,
+            "processed": self.processed,
+            "errors": self.errors,
+            "latency_ms": {"p50": percentile(0.5), "p95": percentile(0.95)},
+        }
+
+
+class StagedPipeline:
+    """通用的多阶段异步流水线
+
+    每个阶段有自己的有界队列和worker；下游队列满时上游worker阻塞在put上(背压)。
+    调用方被取消时，尚未处理的条目会被各阶段跳过；被跳过或失败的条目交给discard()释放资源。
+    """
+
+    def __init__(self, stages: List[Stage]):
+        self.stages = stages
+        self._workers: List[asyncio.Task] = []
+        self.submitted = 0
+        self._latencies: Deque[float] = deque(maxlen=256)
+
+    @property
+    def running(self) -> bool:
+        return bool(self._workers)
+
+    async def start(self):
+        if self._workers:
+            return
+        for index, stage in enumerate(self.stages):
+            stage.queue = asyncio.Queue(maxsize=stage.queue_size)
+            for _ in range(stage.workers):
+                self._workers.append(asyncio.create_task(self._worker(index)))
+
+    async def stop(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    async def submit(self, item: Any) -> Any:
+        """提交一个条目并等待它走完流水线（或在某阶段提前结束/失败）"""
+        if not self._workers:
+            await self.start()
+        self.submitted += 1
+        started = time.monotonic()
+        future = asyncio.get_running_loop().create_future()
+        await self.stages[0].queue.put((item, future))
+        try:
+            return await future
+        finally:
+            self._latencies.append(time.monotonic() - started)
+
+    async def _worker(self, index: int):
+        stage = self.stages[index]
+        last = index == len(self.stages) - 1
+        while True:
+            item, future = await stage.queue.get()
+            try:
+                if future.done():
+                    self.discard(item)
+                    continue
+                started = time.monotonic()
+                stage.busy += 1
+                try:
+                    result = await stage.handler(item)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    stage.errors += 1
+                    self.discard(item)
+                    if not future.done():
+                        future.set_exception(e)
+                    continue
+                finally:
+                    stage.busy -= 1
+                    stage.record(time.monotonic() - started)
+
+                if isinstance(result, Done) or last:
+                    if not future.done():
+                        future.set_result(result.value if isinstance(result, Done) else result)
+                else:
+                    await self.stages[index + 1].queue.put((result, future))
+            finally:
+                stage.queue.task_done()
+
+    def discard(self, item: Any):
+        """条目被放弃时的清理钩子"""
+        pass
+
+    def get_stats(self) -> dict:
+        latencies = sorted(self._latencies)
+        p95 = latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))] * 1000 if latencies else 0.0
+        return {
+            "running": self.running,
+            "submitted": self.submitted,
+            "end_to_end_p95_ms": round(p95, 1),
+            "stages": {stage.name: stage.get_stats() for stage in self.stages},
+        }
+
+
+# ============ 图片流水线 ============
+@dataclass
+class ImageJob:
+    """一张生成图片的处理任务；deliver阶段按output写入url/blob/b64"""
+    img: Any
+    size: int
+    output: str = "base64"          # url(上传R2，失败回退base64) / blob / base64
+    filename: str = ""
+    remove_watermark: bool = True
+    output_format: Optional[str] = None  # PNG/JPEG/WEBP/AVIF，None时按去除器默认设置
+    compression: Optional[int] = None    # PNG压缩级别(0-9)或有损格式质量(1-100)
+
+    data: Optional[bytes] = None
+    mime: str = "image/png"
+    array: Any = None               # 解码后的图片（线程模式为PIL图片，进程模式为共享内存句柄）
+    backend: Any = None
+    url: Optional[str] = None
+    blob: Any = None
+    b64: Optional[str] = None
+
+    @property
+    def data_uri(self) -> str:
+        return f"data:{self.mime};base64,{self.b64}"
+
+
+class ImagePipeline(StagedPipeline):
+    """生成图片的后处理流水线；CPU阶段由图片计算后端(线程池/进程池)执行"""
+
+    def __init__(
+        self,
+        download: Callable[[Any, int], Awaitable[Optional[Tuple[bytes, str]]]],
+        upload: Callable[[bytes, str, str], Awaitable[str]],
+        store_blob: Callable[[bytes, str], Awaitable[Any]],
+        get_backend: Callable[[], Any],
+        workers: Optional[Dict[str, int]] = None,
+        queue_size: int = 8,
+    ):
+        """
+        Args:
+            download: 下载生成图片，返回(字节, MIME)或None
+            upload: 上传到R2(字节, 文件名, MIME)，返回URL
+            store_blob: 写入blob存储，返回BlobRef
+            get_backend: 返回当前的图片计算后端(image_workers)，未初始化时为None(跳过去水印)
+            workers: 每阶段worker数 {download, decode, watermark, encode, deliver}
+            queue_size: 每阶段输入队列长度
+        """
+        self.download = download
+        self.upload = upload
+        self.store_blob = store_blob
+        self.get_backend = get_backend
+        workers = workers or {}
+        super().__init__([
+            Stage("download", self._download, workers.get("download", 8), queue_size),
+            Stage("decode", self._decode, workers.get("decode", 2), queue_size),
+            Stage("watermark", self._watermark, workers.get("watermark", 2), queue_size),
+            Stage("encode", self._encode, workers.get("encode", 2), queue_size),
+            Stage("deliver", self._deliver, workers.get("deliver", 4), queue_size),
+        ])
+
+    async def process(self, job: ImageJob) -> Optional[ImageJob]:
+        """处理一张图片；下载失败时返回None"""
+        return await self.submit(job)
+
+    async def _download(self, job: ImageJob):
+        downloaded = await self.download(job.img, job.size)
+        if not downloaded:
+            return Done(None)
+        job.data, job.mime = downloaded
+        return job
+
+    # CPU阶段失败时回退原图（与remove_from_bytes一致），不影响交付
+    def discard(self, job: ImageJob):
+        self._release(job)
+
+    @staticmethod
+    def _release(job: ImageJob):
+        if job.backend is not None and job.array is not None:
+            job.backend.release(job.array)
+        job.array = None
+
+    async def _decode(self, job: ImageJob) -> ImageJob:
+        # 不去水印但指定了输出编码时仍需解码转码
+        backend = self.get_backend() if job.remove_watermark or job.output_format or job.compression is not None else None
+        if backend is None:
+            return job
+        try:
+            job.backend = backend
+            job.array = await backend.decode(job.data)
+        except Exception as e:
+            logger.warning(f"⚠️ 图片解码失败，返回原图: {e}")
+        return job
+
+    async def _watermark(self, job: ImageJob) -> ImageJob:
+        if job.array is None or not job.remove_watermark:
+            return job
+        try:
+            job.array = await job.backend.remove_watermark(job.array)
+        except Exception as e:
+            # 去水印在写回像素前失败，解码结果仍是原图：指定了编码时照常转码，否则直接返回原始字节
+            if job.output_format or job.compression is not None:
+                logger.warning(f"⚠️ 去水印失败，按请求的格式输出原图: {e}")
+            else:
+                logger.warning(f"⚠️ 去水印失败，返回原图: {e}")
+                self._release(job)
+        return job
+
+    async def _encode(self, job: ImageJob) -> ImageJob:
+        if job.array is None:
+            return job
+        try:
+            job.data, job.mime = await job.backend.encode(job.array, job.mime, job.output_format, job.compression)
+        except Exception as e:
+            logger.warning(f"⚠️ 图片编码失败，返回原图: {e}")
+        finally:
+            self._release(job)
+        return job
+
+    async def _deliver(self, job: ImageJob) -> ImageJob:
+        if job.output == "url":
+            try:
+                # 扩展名跟随实际编码格式
+                ext = MIME_EXTENSIONS.get(job.mime)
+                filename = str(PurePosixPath(job.filename).with_suffix(ext)) if ext else job.filename
+                job.url = await self.upload(job.data, filename, job.mime)
+                return job
+            except Exception as e:
+                logger.error(f"❌ R2上传失败: {e}")
+        elif job.output == "blob":
+            job.blob = await self.store_blob(job.data, job.mime)
+            return job
+        job.b64 = await asyncio.to_thread(lambda: b64.b64encode(job.data).decode("utf-8"))
+        return job
@@ -0,0 +1,241 @@
+"""
+图片CPU计算后端
+功能: 图片解码/去水印/编码的执行后端；线程模式在线程池中直接处理PIL图片(只取水印区域转数组)，进程模式使用ProcessPoolExecutor(每个worker预加载Alpha映射)，像素数据放在共享内存中在各阶段间传递，不经过pickle
+关键词: process-pool, shared-memory, gil, watermark, numpy
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+import uuid
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
+from multiprocessing import resource_tracker, shared_memory
+from pathlib import Path
+from typing import Any, Dict, Optional, Set, Tuple
+
+import numpy as np
+
+from PIL import Image
+
+from watermark_remover import FORMAT_MIME, WatermarkRemover
+
+logger = logging.getLogger(__name__)
+
+
+class ThreadImageBackend:
+    """线程池执行（IMAGE_WORKER_PROCESSES=0 时使用）"""
+
+    mode = "thread"
+
+    def __init__(self, remover: WatermarkRemover):
+        self.remover = remover
+
+    async def decode(self, data: bytes) -> Image.Image:
+        return await asyncio.to_thread(self.remover.open_image, data)
+
+    async def remove_watermark(self, img: Image.Image) -> Image.Image:
+        return await asyncio.to_thread(self.remover.remove_watermark_image, img)
+
+    async def encode(self, img: Image.Image, source_mime: str, output_format: Optional[str] = None,
+                     compression: Optional[int] = None) -> Tuple[bytes, str]:
+        """按指定格式(未指定时按去除器的输出设置)编码，返回(字节流, MIME)"""
+        fmt = self.remover.output_format(source_mime, output_format)
+        return await asyncio.to_thread(self.remover.save_image, img, fmt, compression), FORMAT_MIME[fmt]
+
+    def release(self, array: Any):
+        pass
+
+    def close(self):
+        pass
+
+    def get_stats(self) -> dict:
+        return {"mode": self.mode}
+
+
+# ============ 进程池worker (在子进程中执行) ============
+@dataclass(frozen=True)
+class SharedImage:
+    """共享内存中的像素数组句柄（只有句柄在进程间传递）"""
+    name: str
+    shape: Tuple[int, ...]
+    dtype: str
+
+
+_worker_remover: Optional[WatermarkRemover] = None
+
+
+def _init_worker(asset_dir: str, options: Dict[str, Any]):
+    global _worker_remover
+    _worker_remover = WatermarkRemover(Path(asset_dir), **options)
+    loaded = _worker_remover.preload()
+    logger.info(f"[ImageWorker] 进程 {os.getpid()} 已就绪 (Alpha映射={loaded})")
+
+
+def _untrack(shm: shared_memory.SharedMemory):
+    # 共享内存的生命周期由服务进程(ProcessImageBackend.release)负责，worker中不登记到resource_tracker，
+    # 否则tracker会在退出时重复unlink并报告泄漏
+    resource_tracker.unregister(shm._name, "shared_memory")
+
+
+def _attach(handle: SharedImage) -> Tuple[shared_memory.SharedMemory, np.ndarray]:
+    shm = shared_memory.SharedMemory(name=handle.name)
+    _untrack(shm)
+    return shm, np.ndarray(handle.shape, dtype=np.dtype(handle.dtype), buffer=shm.buf)
+
+
+def _decode_to_shared(data: bytes, name: str) -> SharedImage:
+    array = _worker_remover.decode(data)
+    shm = shared_memory.SharedMemory(name=name, create=True, size=max(1, array.nbytes))
+    _untrack(shm)
+    view = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+    view[...] = array
+    handle = SharedImage(shm.name, array.shape, array.dtype.str)
+    del view
+    shm.close()
+    return handle
+
+
+def _remove_in_shared(handle: SharedImage) -> SharedImage:
+    shm, array = _attach(handle)
+    try:
+        _worker_remover.remove_watermark(array)
+    finally:
+        del array
+        shm.close()
+    return handle
+
+
+def _encode_from_shared(handle: SharedImage, fmt: str, compression: Optional[int]) -> bytes:
+    shm, array = _attach(handle)
+    try:
+        return _worker_remover.encode(array, fmt, compression)
+    finally:
+        del array
+        shm.close()
+
+
+class ProcessImageBackend:
+    """进程池执行：CPU计算不占用服务进程的GIL"""
+
+    mode = "process"
+
+    def __init__(self, processes: int, remover: WatermarkRemover):
+        """
+        Args:
+            processes: worker进程数
+            remover: 服务进程中的去除器；worker按其资产目录与编码设置各自创建一份
+        """
+        self.processes = processes
+        self.remover = remover
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._live: Set[str] = set()
+        self.submitted = 0
+        self.in_flight = 0
+        self.restarts = 0
+
+    @staticmethod
+    def _mp_context():
+        # 服务进程中已有线程(任务状态写线程、httpx等)，fork出的子进程可能继承被持有的锁；
+        # 优先使用forkserver(预加载本模块，worker启动快)，不支持时退回spawn
+        # (两种方式下worker都会重新导入入口模块，入口脚本需保留 if __name__ == "__main__" 保护)
+        if "forkserver" in multiprocessing.get_all_start_methods():
+            ctx = multiprocessing.get_context("forkserver")
+            ctx.set_forkserver_preload([__name__])
+            return ctx
+        return multiprocessing.get_context("spawn")
+
+    def start(self):
+        """创建进程池并让每个worker预加载Alpha映射（lifespan中调用一次）"""
+        if self._executor is not None:
+            return
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.processes,
+            mp_context=self._mp_context(),
+            initializer=_init_worker,
+            initargs=(str(self.remover.asset_dir), self.remover.encoder_options),
+        )
+        # 预热: 立即拉起全部worker，避免首个请求承担进程启动开销
+        for _ in range(self.processes):
+            self._executor.submit(os.getpid)
+
+    def _restart(self, broken: ProcessPoolExecutor):
+        """worker进程意外退出后进程池不可再用，丢弃并重建"""
+        if self._executor is not broken:
+            return
+        logger.warning("[ImageWorker] 进程池已损坏(worker异常退出)，重建进程池")
+        self._executor = None
+        broken.shutdown(wait=False, cancel_futures=True)
+        self.restarts += 1
+        self.start()
+
+    def _submit(self, func, *args) -> Future:
+        if self._executor is None:
+            self.start()
+        executor = self._executor
+        try:
+            future = executor.submit(func, *args)
+        except BrokenProcessPool:
+            self._restart(executor)
+            future = self._executor.submit(func, *args)
+        # 提交成功后才计数，提交抛异常时不会残留in_flight
+        self.submitted += 1
+        self.in_flight += 1
+        future.add_done_callback(self._on_done)
+        return future
+
+    def _on_done(self, future: Future):
+        self.in_flight -= 1
+
+    async def _run(self, func, *args):
+        return await asyncio.wrap_future(self._submit(func, *args))
+
+    async def decode(self, data: bytes) -> SharedImage:
+        # 共享内存名由服务进程预先分配，提交成功后登记：解码被取消或进程池异常时也能找到并释放
+        name = f"img{uuid.uuid4().hex[:16]}"
+        future = self._submit(_decode_to_shared, data, name)
+        self._live.add(name)
+        try:
+            return await asyncio.wrap_future(future)
+        except BaseException:
+            # 取消时worker可能仍在执行，等其结束（已结束则立即）再释放
+            future.add_done_callback(lambda _: self.release(SharedImage(name, (), "|u1")))
+            raise
+
+    async def remove_watermark(self, handle: SharedImage) -> SharedImage:
+        return await self._run(_remove_in_shared, handle)
+
+    async def encode(self, handle: SharedImage, source_mime: str, output_format: Optional[str] = None,
+                     compression: Optional[int] = None) -> Tuple[bytes, str]:
+        fmt = self.remover.output_format(source_mime, output_format)
+        return await self._run(_encode_from_shared, handle, fmt, compression), FORMAT_MIME[fmt]
+
+    def release(self, handle: Any):
+        """释放共享内存（图片处理结束或被放弃时调用）"""
+        if not isinstance(handle, SharedImage) or handle.name not in self._live:
+            return
+        self._live.discard(handle.name)
+        try:
+            shm = shared_memory.SharedMemory(name=handle.name)
+            shm.close()
+            shm.unlink()
+        except FileNotFoundError:
+            pass
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+        for name in list(self._live):
+            self.release(SharedImage(name, (), "|u1"))
+
+    def get_stats(self) -> dict:
+        return {
+            "mode": self.mode,
+            "processes": self.processes,
+            "submitted": self.submitted,
+            "in_flight": self.in_flight,
+            "shared_buffers": len(self._live),
+            "restarts": self.restarts,
+        }
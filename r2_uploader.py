@@ -0,0 +1,156 @@
+"""
+R2 (S3兼容) 异步上传器
+功能: lifespan中创建并复用boto3客户端，上传在专用线程池中执行，大文件分片上传，限制并发并统计耗时/字节数
+关键词: r2, s3, boto3, multipart, upload, thread-pool
+"""
+import asyncio
+import io
+import logging
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Deque, Optional
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+
+class R2Uploader:
+    """复用客户端的R2上传器，不在事件循环线程上做阻塞IO"""
+
+    def __init__(
+        self,
+        endpoint: str,
+        access_key: str,
+        secret_key: str,
+        bucket: str,
+        public_url: str,
+        folder: str,
+        max_concurrency: int = 4,
+        multipart_threshold: int = 8 * MB,
+        multipart_chunksize: int = 8 * MB,
+    ):
+        """
+        Args:
+            endpoint: S3兼容服务地址
+            access_key / secret_key: 访问凭证
+            bucket: 存储桶
+            public_url: 公开访问地址前缀
+            folder: 对象键前缀
+            max_concurrency: 同时进行的上传数
+            multipart_threshold: 超过该大小(字节)使用分片上传
+            multipart_chunksize: 分片大小(字节)
+        """
+        self.endpoint = endpoint
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.bucket = bucket
+        self.public_url = public_url.rstrip("/")
+        self.folder = folder
+        self.max_concurrency = max_concurrency
+        self.multipart_threshold = multipart_threshold
+        self.multipart_chunksize = multipart_chunksize
+
+        self._client = None
+        self._transfer_config = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+        self.uploads = 0
+        self.multipart_uploads = 0
+        self.failures = 0
+        self.bytes_uploaded = 0
+        self._latencies: Deque[float] = deque(maxlen=500)
+
+    def start(self):
+        """创建boto3客户端与上传线程池（重复调用无副作用）"""
+        if self._client is not None:
+            return
+        import boto3
+        from boto3.s3.transfer import TransferConfig
+        from botocore.config import Config
+
+        self._client = boto3.client(
+            's3',
+            endpoint_url=self.endpoint,
+            aws_access_key_id=self.access_key,
+            aws_secret_access_key=self.secret_key,
+            config=Config(
+                signature_version='s3v4',
+                max_pool_connections=self.max_concurrency * 4,
+                retries={"max_attempts": 3, "mode": "standard"},
+            ),
+            region_name='auto'
+        )
+        self._transfer_config = TransferConfig(
+            multipart_threshold=self.multipart_threshold,
+            multipart_chunksize=self.multipart_chunksize,
+            max_concurrency=4,
+        )
+        self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix="r2-upload")
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        logger.info(f"R2上传器已启动 (并发={self.max_concurrency}, 分片阈值={self.multipart_threshold // MB}MB)")
+
+    def close(self):
+        """等待进行中的上传完成并释放线程池"""
+        if self._executor:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        self._client = None
+
+    def _put(self, data: bytes, key: str, content_type: str):
+        if len(data) >= self.multipart_threshold:
+            self._client.upload_fileobj(
+                io.BytesIO(data),
+                self.bucket,
+                key,
+                ExtraArgs={"ContentType": content_type},
+                Config=self._transfer_config,
+            )
+            self.multipart_uploads += 1
+        else:
+            self._client.put_object(
+                Bucket=self.bucket,
+                Key=key,
+                Body=data,
+                ContentType=content_type
+            )
+
+    async def upload(self, data: bytes, filename: str, content_type: str = "image/png") -> str:
+        """上传对象并返回公开URL"""
+        if self._client is None:
+            self.start()
+
+        key = f"{self.folder}/{filename}"
+        loop = asyncio.get_running_loop()
+        async with self._semaphore:
+            start = time.perf_counter()
+            try:
+                await loop.run_in_executor(self._executor, self._put, data, key, content_type)
+            except Exception:
+                self.failures += 1
+                raise
+            self._latencies.append(time.perf_counter() - start)
+
+        self.uploads += 1
+        self.bytes_uploaded += len(data)
+        return f"{self.public_url}/{key}"
+
+    def get_stats(self) -> dict:
+        latencies = sorted(self._latencies)
+
+        def percentile(p: float) -> float:
+            if not latencies:
+                return 0.0
+            return round(latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000, 1)
+
+        return {
+            "started": self._client is not None,
+            "max_concurrency": self.max_concurrency,
+            "uploads": self.uploads,
+            "multipart_uploads": self.multipart_uploads,
+            "failures": self.failures,
+            "bytes_uploaded": self.bytes_uploaded,
+            "latency_ms": {"p50": percentile(0.5), "p95": percentile(0.95)},
+        }
@@ -0,0 +1,83 @@
+"""
+并发请求合并 (single-flight)
+功能: 相同(prompt, 模型, 文件内容, image_mode)的并发请求只向上游发起一次调用，所有调用方共享结果
+关键词: single-flight, coalesce, dedup, in-flight
+"""
+import asyncio
+import hashlib
+import json
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def hash_files(files: Optional[List[str]]) -> str:
+    """按文件内容计算摘要（临时文件名每次不同，不能用路径做键）；会读盘，在事件循环中应通过线程调用"""
+    digest = hashlib.sha256()
+    for path in files or []:
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(block)
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class RequestCoalescer:
+    """进行中请求的合并器
+
+    第一个调用方(leader)创建上游任务，后续相同键的调用方直接等待该任务。
+    上游任务独立于调用方运行：某个调用方被取消(如客户端断开)不会影响其他等待者。
+    """
+
+    def __init__(self):
+        self._in_flight: Dict[str, asyncio.Task] = {}
+        self._waiters: Dict[str, int] = {}
+
+        self.leaders = 0
+        self.coalesced = 0
+
+    @staticmethod
+    def make_key(prompt: str, model: Any, files: Optional[List[str]] = None, image_mode: bool = False) -> str:
+        payload = json.dumps(
+            [prompt, str(model) if model else None, hash_files(files) if files else None, image_mode],
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _on_done(self, key: str, task: asyncio.Task):
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+            self._waiters.pop(key, None)
+        # 所有调用方都已取消时，避免 "exception was never retrieved" 警告
+        if not task.cancelled():
+            task.exception()
+
+    async def run(self, key: str, factory: Callable[[], Awaitable]) -> Any:
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self._in_flight[key] = task
+            self._waiters[key] = 0
+            task.add_done_callback(lambda t, k=key: self._on_done(k, t))
+            self.leaders += 1
+        else:
+            self.coalesced += 1
+            logger.info(f"[Coalesce] 合并相同的进行中请求 (等待者={self._waiters[key] + 1})")
+
+        self._waiters[key] += 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            if self._in_flight.get(key) is task:
+                self._waiters[key] -= 1
+
+    def get_stats(self) -> dict:
+        total = self.leaders + self.coalesced
+        return {
+            "in_flight": len(self._in_flight),
+            "waiters": sum(self._waiters.values()),
+            "upstream_calls": self.leaders,
+            "coalesced": self.coalesced,
+            "coalesce_ratio": round(self.coalesced / total, 3) if total else 0.0,
+        }
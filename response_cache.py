@@ -0,0 +1,203 @@
+"""
+文本响应缓存
+功能: 按(规范化prompt, 模型, 生成配置)精确匹配缓存文本结果，TTL过期 + 内存LRU淘汰(条数/字节上限)，可选SQLite磁盘二级缓存
+关键词: cache, lru, ttl, sqlite, exact-match
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+SQL_CREATE = """
+    CREATE TABLE IF NOT EXISTS response_cache (
+        cache_key TEXT PRIMARY KEY,
+        value TEXT NOT NULL,
+        expires_at REAL NOT NULL
+    )
+"""
+SQL_CREATE_INDEX = "CREATE INDEX IF NOT EXISTS idx_response_cache_expires ON response_cache(expires_at)"
+SQL_GET = "SELECT value, expires_at FROM response_cache WHERE cache_key = ?"
+SQL_SET = "INSERT OR REPLACE INTO response_cache (cache_key, value, expires_at) VALUES (?, ?, ?)"
+SQL_DELETE = "DELETE FROM response_cache WHERE cache_key = ?"
+SQL_PURGE = "DELETE FROM response_cache WHERE expires_at < ?"
+
+
+def normalize_prompt(prompt: str) -> str:
+    """统一换行并去掉首尾空白（不改动正文内容）"""
+    return prompt.replace("\r\n", "\n").strip()
+
+
+class ResponseCache:
+    """精确匹配的文本响应缓存"""
+
+    def __init__(
+        self,
+        ttl: float = 3600.0,
+        max_entries: int = 10000,
+        max_bytes: int = 64 * MB,
+        disk_path: Optional[Path] = None,
+        purge_interval: float = 300.0,
+    ):
+        """
+        Args:
+            ttl: 过期时间(秒)
+            max_entries: 内存最多缓存条数
+            max_bytes: 内存缓存总字节上限
+            disk_path: SQLite磁盘缓存路径，为空时只用内存
+            purge_interval: 写入磁盘缓存时顺带清除过期记录的最小间隔(秒)
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.disk_path = disk_path
+        self.purge_interval = purge_interval
+        self._next_purge = 0.0
+
+        # key -> (value, expires_at, size)
+        self._entries: "OrderedDict[str, Tuple[str, float, int]]" = OrderedDict()
+        self._bytes = 0
+
+        self._disk: Optional[sqlite3.Connection] = None
+        self._disk_lock = threading.Lock()
+        if disk_path:
+            self._disk = sqlite3.connect(disk_path, check_same_thread=False)
+            self._disk.execute("PRAGMA journal_mode=WAL")
+            self._disk.execute("PRAGMA synchronous=NORMAL")
+            self._disk.execute(SQL_CREATE)
+            self._disk.execute(SQL_CREATE_INDEX)
+            self._disk.commit()
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.bypasses = 0
+        self.evictions = 0
+        self.disk_purged = 0
+
+    @staticmethod
+    def make_key(prompt: str, model: Any, config: Optional[dict] = None) -> str:
+        payload = json.dumps(
+            {"prompt": normalize_prompt(prompt), "model": str(model), "config": config or {}},
+            sort_keys=True,
+            ensure_ascii=False,
+            default=str,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    # ============ 内存层 ============
+    def _memory_get(self, key: str, now: float) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, expires_at, size = entry
+        if expires_at < now:
+            del self._entries[key]
+            self._bytes -= size
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def _memory_set(self, key: str, value: str, expires_at: float):
+        size = len(value.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        old = self._entries.pop(key, None)
+        if old:
+            self._bytes -= old[2]
+        self._entries[key] = (value, expires_at, size)
+        self._bytes += size
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            _, (_, _, evicted_size) = self._entries.popitem(last=False)
+            self._bytes -= evicted_size
+            self.evictions += 1
+
+    # ============ 磁盘层 ============
+    def _disk_get(self, key: str, now: float) -> Optional[Tuple[str, float]]:
+        with self._disk_lock:
+            row = self._disk.execute(SQL_GET, (key,)).fetchone()
+            if row and row[1] < now:
+                self._disk.execute(SQL_DELETE, (key,))
+                self._disk.commit()
+                return None
+        return row
+
+    def _disk_set(self, key: str, value: str, expires_at: float):
+        now = time.time()
+        with self._disk_lock:
+            self._disk.execute(SQL_SET, (key, value, expires_at))
+            # 过期记录只在读到时才删除，长期运行会不断累积：写入时按间隔批量清除
+            if now >= self._next_purge:
+                self.disk_purged += self._disk.execute(SQL_PURGE, (now,)).rowcount
+                self._next_purge = now + self.purge_interval
+            self._disk.commit()
+
+    # ============ 对外接口 ============
+    async def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        value = self._memory_get(key, now)
+        if value is not None:
+            self.hits += 1
+            return value
+
+        if self._disk is not None:
+            try:
+                row = await asyncio.to_thread(self._disk_get, key, now)
+            except Exception as e:
+                logger.warning(f"读取磁盘缓存失败: {e}")
+                row = None
+            if row:
+                self.hits += 1
+                self.disk_hits += 1
+                self._memory_set(key, row[0], row[1])
+                return row[0]
+
+        self.misses += 1
+        return None
+
+    async def set(self, key: str, value: str):
+        expires_at = time.time() + self.ttl
+        self._memory_set(key, value, expires_at)
+        if self._disk is not None:
+            try:
+                await asyncio.to_thread(self._disk_set, key, value, expires_at)
+            except Exception as e:
+                logger.warning(f"写入磁盘缓存失败: {e}")
+
+    def clear(self):
+        self._entries.clear()
+        self._bytes = 0
+
+    def close(self):
+        if self._disk is not None:
+            with self._disk_lock:
+                self._disk.close()
+            self._disk = None
+
+    def get_stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": True,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "ttl": self.ttl,
+            "disk": self.disk_path is not None,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "bypasses": self.bypasses,
+            "evictions": self.evictions,
+            "disk_purged": self.disk_purged,
+            "hit_ratio": round(self.hits / lookups, 3) if lookups else 0.0,
+        }
@@ -0,0 +1,185 @@
+"""
+分层重试引擎
+功能: 每个后端独立的tenacity重试策略 + 单请求截止时间预算 + 滚动窗口重试预算(限制重试占比，防止故障期间放大负载) + 每请求尝试次数直方图
+关键词: retry, tenacity, deadline, retry-budget, histogram
+"""
+import asyncio
+import logging
+import time
+from collections import Counter, deque
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Deque, Dict, Optional, Tuple, Type
+
+from tenacity import AsyncRetrying, RetryCallState, retry_if_exception_type, wait_exponential
+
+logger = logging.getLogger(__name__)
+
+
+class DeadlineExceededError(Exception):
+    """请求截止时间已到"""
+    pass
+
+
+@dataclass
+class RetryPolicy:
+    """单个后端的重试策略"""
+    max_attempts: int = 3
+    min_wait: float = 1.0
+    max_wait: float = 30.0
+    multiplier: float = 1.0
+    retry_on: Tuple[Type[BaseException], ...] = (Exception,)
+
+
+class RetryBudget:
+    """滚动窗口重试预算: 窗口内重试次数不超过 max(min_retries, ratio * 请求数)"""
+
+    def __init__(self, ratio: float = 0.2, min_retries: int = 10, window: float = 60.0):
+        self.ratio = ratio
+        self.min_retries = min_retries
+        self.window = window
+        self._requests: Deque[float] = deque()
+        self._retries: Deque[float] = deque()
+
+    def _prune(self, now: float):
+        for events in (self._requests, self._retries):
+            while events and events[0] < now - self.window:
+                events.popleft()
+
+    def record_request(self):
+        self._requests.append(time.monotonic())
+
+    def try_spend(self) -> bool:
+        """申请一次重试；预算不足时返回False"""
+        now = time.monotonic()
+        self._prune(now)
+        if len(self._retries) >= max(self.min_retries, self.ratio * len(self._requests)):
+            return False
+        self._retries.append(now)
+        return True
+
+    def get_stats(self) -> dict:
+        self._prune(time.monotonic())
+        allowed = max(self.min_retries, self.ratio * len(self._requests))
+        return {
+            "ratio": self.ratio,
+            "window": self.window,
+            "window_requests": len(self._requests),
+            "window_retries": len(self._retries),
+            "available": max(0, int(allowed - len(self._retries))),
+        }
+
+
+class _BackendStats:
+    def __init__(self):
+        self.requests = 0
+        self.retries = 0
+        self.budget_exhausted = 0
+        self.deadline_exceeded = 0
+        self.attempts: Counter = Counter()
+
+
+class RetryEngine:
+    """按后端分层的重试执行器
+
+    截止时间/重试预算不足时视为重试次数耗尽，仍然抛出 tenacity.RetryError，
+    调用方的异常处理逻辑无需改变。
+    """
+
+    def __init__(self, budget: Optional[RetryBudget] = None):
+        self.budget = budget or RetryBudget()
+        self.policies: Dict[str, RetryPolicy] = {}
+        self._stats: Dict[str, _BackendStats] = {}
+
+    def add_policy(self, backend: str, policy: RetryPolicy):
+        self.policies[backend] = policy
+        self._stats.setdefault(backend, _BackendStats())
+
+    def _stop(self, backend: str, policy: RetryPolicy, deadline: Optional[float]) -> Callable[[RetryCallState], bool]:
+        stats = self._stats[backend]
+
+        def stop(retry_state: RetryCallState) -> bool:
+            if retry_state.attempt_number >= policy.max_attempts:
+                return True
+            if deadline is not None and deadline - time.monotonic() < policy.min_wait:
+                stats.deadline_exceeded += 1
+                logger.warning(f"[Retry:{backend}] 剩余时间不足，停止重试")
+                return True
+            if not self.budget.try_spend():
+                stats.budget_exhausted += 1
+                logger.warning(f"[Retry:{backend}] 重试预算已用尽，停止重试")
+                return True
+            return False
+
+        return stop
+
+    @staticmethod
+    def _wait(policy: RetryPolicy, deadline: Optional[float]) -> Callable[[RetryCallState], float]:
+        base = wait_exponential(multiplier=policy.multiplier, min=policy.min_wait, max=policy.max_wait)
+
+        def wait(retry_state: RetryCallState) -> float:
+            seconds = base(retry_state)
+            if deadline is not None:
+                seconds = min(seconds, max(0.0, deadline - time.monotonic()))
+            return seconds
+
+        return wait
+
+    def _before_sleep(self, backend: str) -> Callable[[RetryCallState], None]:
+        stats = self._stats[backend]
+
+        def before_sleep(retry_state: RetryCallState):
+            stats.retries += 1
+            logger.warning(
+                f"[Retry:{backend}] 第{retry_state.attempt_number}次失败，"
+                f"{retry_state.next_action.sleep:.1f}s后重试: {retry_state.outcome.exception()}"
+            )
+
+        return before_sleep
+
+    async def call(self, backend: str, func: Callable[[], Awaitable], deadline: Optional[float] = None):
+        """按后端策略执行func；deadline为time.monotonic()时间点"""
+        policy = self.policies[backend]
+        stats = self._stats[backend]
+        stats.requests += 1
+        self.budget.record_request()
+
+        retrying = AsyncRetrying(
+            retry=retry_if_exception_type(policy.retry_on),
+            wait=self._wait(policy, deadline),
+            stop=self._stop(backend, policy, deadline),
+            before_sleep=self._before_sleep(backend),
+        )
+        attempts = 0
+        try:
+            async for attempt in retrying:
+                with attempt:
+                    attempts += 1
+                    if deadline is None:
+                        result = await func()
+                    else:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            stats.deadline_exceeded += 1
+                            raise DeadlineExceededError(f"{backend}: 请求截止时间已到")
+                        try:
+                            result = await asyncio.wait_for(func(), remaining)
+                        except asyncio.TimeoutError:
+                            stats.deadline_exceeded += 1
+                            raise DeadlineExceededError(f"{backend}: 请求超过截止时间")
+            return result
+        finally:
+            stats.attempts[attempts] += 1
+
+    def get_stats(self) -> dict:
+        backends = {}
+        for name, stats in self._stats.items():
+            policy = self.policies[name]
+            backends[name] = {
+                "max_attempts": policy.max_attempts,
+                "requests": stats.requests,
+                "retries": stats.retries,
+                "budget_exhausted": stats.budget_exhausted,
+                "deadline_exceeded": stats.deadline_exceeded,
+                "attempts_histogram": {str(k): v for k, v in sorted(stats.attempts.items())},
+            }
+        return {"budget": self.budget.get_stats(), "backends": backends}
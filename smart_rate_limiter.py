@@ -0,0 +1,109 @@
+"""
+智能速率控制器
+功能: 滑动窗口RPM限制 + 动态请求间隔 + 抖动，锁内只预约时间槽，锁外等待
+关键词: rate-limit, sliding-window, reservation, jitter, backoff
+"""
+import asyncio
+import logging
+import random
+import threading
+import time
+from collections import deque
+from typing import Deque
+
+logger = logging.getLogger(__name__)
+
+
+class SmartRateLimiter:
+    """带抖动的智能速率限制器
+
+    每个调用方在锁内计算自己的发出时间(时间槽)并登记到滑动窗口，
+    随后在锁外 sleep 到该时间点，因此等待中的协程不会阻塞其他调用方。
+    """
+
+    def __init__(
+        self,
+        rpm_limit: int = 60,
+        base_delay: float = 2.0,
+        max_delay: float = 60.0,
+        jitter_range: float = 1.0,
+        backoff_multiplier: float = 2,
+        window: float = 60.0,
+    ):
+        """
+        Args:
+            rpm_limit: 窗口内最大请求数
+            base_delay: 基础延迟(秒)
+            max_delay: 最大延迟(秒)
+            jitter_range: 抖动范围(秒)
+            backoff_multiplier: 429时的退避倍数
+            window: 滑动窗口长度(秒)，默认60即RPM
+        """
+        self.rpm_limit = rpm_limit
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter_range = jitter_range
+        self.backoff_multiplier = backoff_multiplier
+        self.window = window
+
+        # 已预约的请求发出时间，单调递增（可能包含未来时间点）
+        self.request_times: Deque[float] = deque()
+        self.consecutive_429s = 0
+        self.current_delay = base_delay
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """预约一个请求时间槽，返回需要等待的秒数（不阻塞）"""
+        with self._lock:
+            now = time.monotonic()
+            cutoff = now - self.window
+            while self.request_times and self.request_times[0] <= cutoff:
+                self.request_times.popleft()
+
+            # 相邻请求至少间隔 current_delay(+抖动)，从上一个预约槽算起：
+            # 并发调用方依次排开，429退避后的延迟不会被同一时刻的突发抵消
+            slot = now
+            if self.request_times:
+                slot = max(now, self.request_times[-1] + self.current_delay + self._add_jitter())
+            if len(self.request_times) >= self.rpm_limit:
+                window_slot = self.request_times[-self.rpm_limit] + self.window
+                if window_slot > slot:
+                    logger.info(f"RPM限制触发，等待 {window_slot - now:.1f}s")
+                    slot = window_slot
+
+            self.request_times.append(slot)
+            return slot - now
+
+    async def acquire(self) -> float:
+        """获取请求许可，返回实际等待时间"""
+        wait_time = self.reserve()
+        if wait_time > 0:
+            await asyncio.sleep(wait_time)
+        return wait_time
+
+    def _add_jitter(self) -> float:
+        return random.uniform(0, self.jitter_range)
+
+    def report_success(self):
+        with self._lock:
+            self.consecutive_429s = 0
+            self.current_delay = max(self.base_delay, self.current_delay * 0.9)
+
+    def report_rate_limit(self):
+        with self._lock:
+            self.consecutive_429s += 1
+            self.current_delay = min(self.max_delay, self.current_delay * self.backoff_multiplier)
+        logger.warning(f"429错误，延迟调整为 {self.current_delay:.1f}s")
+
+    def get_stats(self) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            sent = sum(1 for t in self.request_times if now - self.window < t <= now)
+            reserved = sum(1 for t in self.request_times if t > now)
+        return {
+            "current_delay": round(self.current_delay, 2),
+            "requests_last_minute": sent,
+            "reserved": reserved,
+            "consecutive_429s": self.consecutive_429s,
+            "rpm_limit": self.rpm_limit
+        }
@@ -0,0 +1,713 @@
+"""
+断点续传：SQLite任务状态管理
+功能: 单个长连接(WAL) + 专用写线程串行执行SQL，批量提交，内存状态计数；租约式任务队列(领取/心跳/可见性超时/重试)；批次表+触发器维护的批次计数，批次任务按rowid分页；任务完成/失败事件表(SSE续传)；webhook发件箱(与状态变更同一事务入队)
+关键词: sqlite, wal, writer-thread, group-commit, task-state, lease, queue, batch, keyset-pagination, events, outbox
+"""
+import asyncio
+import json
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future, InvalidStateError
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Sequence, Set, Tuple
+
+from blob_store import BlobRef
+
+logger = logging.getLogger(__name__)
+
+TASK_STATUSES = ("pending", "processing", "completed", "failed")
+
+# 固定SQL文本，由sqlite3连接的语句缓存复用预编译语句
+SQL_INSERT_TASK = "INSERT INTO tasks (task_id, task_type, input_data) VALUES (?, ?, ?)"
+SQL_SELECT_TASK = "SELECT * FROM tasks WHERE task_id = ?"
+SQL_SELECT_STATUS = "SELECT status FROM tasks WHERE task_id = ?"
+SQL_UPDATE_COMPLETED = (
+    "UPDATE tasks SET status = ?, output_data = ?, updated_at = CURRENT_TIMESTAMP WHERE task_id = ?"
+)
+SQL_UPDATE_FAILED = (
+    "UPDATE tasks SET status = ?, error_message = ?, retry_count = retry_count + 1, "
+    "updated_at = CURRENT_TIMESTAMP WHERE task_id = ?"
+)
+SQL_UPDATE_STATUS = "UPDATE tasks SET status = ?, updated_at = CURRENT_TIMESTAMP WHERE task_id = ?"
+SQL_SELECT_PENDING = (
+    "SELECT * FROM tasks WHERE status IN ('pending', 'processing') ORDER BY created_at LIMIT ?"
+)
+SQL_SELECT_PENDING_BY_TYPE = (
+    "SELECT * FROM tasks WHERE status IN ('pending', 'processing') AND task_type = ? "
+    "ORDER BY created_at LIMIT ?"
+)
+SQL_CLEANUP = "DELETE FROM tasks WHERE status = 'completed' AND updated_at < datetime('now', ?)"
+SQL_SELECT_EXPIRED_REFS = (
+    "SELECT DISTINCT output_ref FROM tasks "
+    "WHERE status = 'completed' AND updated_at < datetime('now', ?) AND output_ref IS NOT NULL"
+)
+SQL_REF_IN_USE = "SELECT 1 FROM tasks WHERE output_ref = ? LIMIT 1"
+SQL_SELECT_BLOB_HASHES = "SELECT DISTINCT output_hash FROM tasks WHERE output_ref IS NOT NULL"
+SQL_CLEANUP_BATCHES = "DELETE FROM batches WHERE total <= 0"
+SQL_CLEANUP_BATCH_EVENTS = "DELETE FROM batch_events WHERE task_id NOT IN (SELECT task_id FROM tasks)"
+
+# 批次: batches表保存聚合计数，tasks.batch_id索引支持按批次分页(keyset: rowid > cursor)
+SQL_INSERT_BATCH = (
+    "INSERT INTO batches (batch_id, task_type, callback_url, created_at, updated_at) VALUES (?, ?, ?, ?, ?)"
+)
+SQL_INSERT_BATCH_TASK = "INSERT INTO tasks (task_id, task_type, input_data, batch_id) VALUES (?, ?, ?, ?)"
+SQL_SELECT_BATCH_INFO = "SELECT * FROM batches WHERE batch_id = ?"
+SQL_SELECT_BATCH_PAGE = (
+    "SELECT rowid AS seq, task_id, status, output_data, output_ref, output_size, output_hash, output_mime, "
+    "error_message FROM tasks "
+    "WHERE batch_id = ? AND rowid > ? ORDER BY rowid LIMIT ?"
+)
+# 旧版本没有batch_id列：从task_id ("{batch_id}_task_{i}") 回填并汇总批次计数
+SQL_BACKFILL_BATCH_ID = (
+    "UPDATE tasks SET batch_id = substr(task_id, 1, instr(task_id, '_task_') - 1) "
+    "WHERE batch_id IS NULL AND task_id LIKE 'batch\\_%\\_task\\_%' ESCAPE '\\'"
+)
+SQL_BACKFILL_BATCHES = (
+    "INSERT OR IGNORE INTO batches (batch_id, task_type, total, pending, processing, completed, failed, "
+    "created_at, updated_at) "
+    "SELECT batch_id, MIN(task_type), COUNT(*), SUM(status = 'pending'), SUM(status = 'processing'), "
+    "SUM(status = 'completed'), SUM(status = 'failed'), "
+    "MIN(CAST(strftime('%s', created_at) AS REAL)), MAX(CAST(strftime('%s', updated_at) AS REAL)) "
+    "FROM tasks WHERE batch_id IS NOT NULL GROUP BY batch_id"
+)
+# 任务事件: 完成/失败时由触发器写入，event_id单调递增，作为SSE的Last-Event-ID
+SQL_SELECT_BATCH_EVENTS = (
+    "SELECT e.event_id, e.event, t.task_id, t.output_data, t.output_ref, t.output_size, t.output_hash, "
+    "t.output_mime, t.error_message FROM batch_events e JOIN tasks t ON t.task_id = e.task_id "
+    "WHERE e.batch_id = ? AND e.event_id > ? ORDER BY e.event_id LIMIT ?"
+)
+# Webhook发件箱: 任务/批次结束时由触发器入队；投递时以next_attempt_at作为可见性超时，多进程也不会重复投递
+SQL_CLAIM_WEBHOOKS = (
+    "SELECT * FROM webhook_outbox WHERE status = 'pending' AND next_attempt_at <= ? ORDER BY id LIMIT ?"
+)
+SQL_LEASE_WEBHOOK = (
+    "UPDATE webhook_outbox SET attempts = attempts + 1, next_attempt_at = ? "
+    "WHERE id = ? AND status = 'pending' AND next_attempt_at <= ?"
+)
+SQL_DELIVERED_WEBHOOK = (
+    "UPDATE webhook_outbox SET status = 'delivered', last_error = NULL, delivered_at = ? WHERE id = ?"
+)
+SQL_RETRY_WEBHOOK = "UPDATE webhook_outbox SET last_error = ?, next_attempt_at = ? WHERE id = ?"
+SQL_DEAD_WEBHOOK = "UPDATE webhook_outbox SET status = 'dead', last_error = ? WHERE id = ?"
+SQL_COUNT_WEBHOOKS = "SELECT status, COUNT(*) FROM webhook_outbox GROUP BY status"
+SQL_CLEANUP_WEBHOOKS = "DELETE FROM webhook_outbox WHERE status = 'delivered' AND delivered_at < ?"
+
+# 批次计数由触发器在同一事务内维护，其他进程(独立worker)的状态变更也会计入
+BATCH_TRIGGERS = (
+    """CREATE TRIGGER IF NOT EXISTS trg_batch_task_insert AFTER INSERT ON tasks
+    WHEN NEW.batch_id IS NOT NULL BEGIN
+        UPDATE batches SET total = total + 1,
+            pending = pending + (NEW.status = 'pending'),
+            processing = processing + (NEW.status = 'processing'),
+            completed = completed + (NEW.status = 'completed'),
+            failed = failed + (NEW.status = 'failed'),
+            updated_at = strftime('%s', 'now')
+        WHERE batch_id = NEW.batch_id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS trg_batch_task_status AFTER UPDATE OF status ON tasks
+    WHEN NEW.batch_id IS NOT NULL AND OLD.status IS NOT NEW.status BEGIN
+        UPDATE batches SET
+            pending = pending + (NEW.status = 'pending') - (OLD.status = 'pending'),
+            processing = processing + (NEW.status = 'processing') - (OLD.status = 'processing'),
+            completed = completed + (NEW.status = 'completed') - (OLD.status = 'completed'),
+            failed = failed + (NEW.status = 'failed') - (OLD.status = 'failed'),
+            updated_at = strftime('%s', 'now')
+        WHERE batch_id = NEW.batch_id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS trg_batch_task_event AFTER UPDATE OF status ON tasks
+    WHEN NEW.batch_id IS NOT NULL AND NEW.status IN ('completed', 'failed') AND OLD.status IS NOT NEW.status BEGIN
+        INSERT INTO batch_events (batch_id, task_id, event, created_at)
+        VALUES (NEW.batch_id, NEW.task_id, NEW.status, strftime('%s', 'now'));
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS trg_batch_task_webhook AFTER UPDATE OF status ON tasks
+    WHEN NEW.batch_id IS NOT NULL AND NEW.status IN ('completed', 'failed') AND OLD.status IS NOT NEW.status BEGIN
+        INSERT INTO webhook_outbox (batch_id, task_id, event, url, created_at)
+        SELECT batch_id, NEW.task_id, 'task.' || NEW.status, callback_url, strftime('%s', 'now')
+        FROM batches WHERE batch_id = NEW.batch_id AND callback_url IS NOT NULL;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS trg_batch_done_webhook AFTER UPDATE OF pending, processing ON batches
+    WHEN NEW.callback_url IS NOT NULL AND OLD.pending + OLD.processing > 0
+        AND NEW.pending + NEW.processing = 0 BEGIN
+        INSERT INTO webhook_outbox (batch_id, task_id, event, url, created_at)
+        VALUES (NEW.batch_id, NULL, 'batch.completed', NEW.callback_url, strftime('%s', 'now'));
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS trg_batch_task_delete AFTER DELETE ON tasks
+    WHEN OLD.batch_id IS NOT NULL BEGIN
+        UPDATE batches SET total = total - 1,
+            pending = pending - (OLD.status = 'pending'),
+            processing = processing - (OLD.status = 'processing'),
+            completed = completed - (OLD.status = 'completed'),
+            failed = failed - (OLD.status = 'failed')
+        WHERE batch_id = OLD.batch_id;
+    END""",
+)
+
+# 队列相关列 (旧数据库启动时自动ALTER补齐)
+QUEUE_COLUMNS = (
+    ("lease_owner", "TEXT"),
+    ("lease_expires_at", "REAL"),
+    ("heartbeat_at", "REAL"),
+    ("attempts", "INTEGER DEFAULT 0"),
+    ("available_at", "REAL DEFAULT 0"),
+    # 大结果存放在blob存储，任务表只保存引用
+    ("output_ref", "TEXT"),
+    ("output_size", "INTEGER"),
+    ("output_hash", "TEXT"),
+    ("output_mime", "TEXT"),
+)
+
+# 可领取: 到期的pending任务，或租约已过期(worker崩溃)的processing任务
+SQL_SELECT_CLAIMABLE = (
+    "SELECT task_id, status FROM tasks WHERE task_type = ? AND ("
+    "(status = 'pending' AND available_at <= ?) OR "
+    "(status = 'processing' AND (lease_expires_at IS NULL OR lease_expires_at < ?))"
+    ") ORDER BY rowid LIMIT ?"
+)
+# 带条件的更新(compare-and-set)：多个进程同时领取时只有一个能成功
+SQL_CLAIM = (
+    "UPDATE tasks SET status = 'processing', lease_owner = ?, lease_expires_at = ?, heartbeat_at = ?, "
+    "attempts = attempts + 1, updated_at = CURRENT_TIMESTAMP WHERE task_id = ? AND ("
+    "(status = 'pending' AND available_at <= ?) OR "
+    "(status = 'processing' AND (lease_expires_at IS NULL OR lease_expires_at < ?)))"
+)
+SQL_HEARTBEAT = (
+    "UPDATE tasks SET lease_expires_at = ?, heartbeat_at = ? "
+    "WHERE task_id = ? AND lease_owner = ? AND status = 'processing'"
+)
+SQL_COMPLETE_LEASED = (
+    "UPDATE tasks SET status = 'completed', output_data = ?, output_ref = ?, output_size = ?, "
+    "output_hash = ?, output_mime = ?, error_message = NULL, "
+    "lease_owner = NULL, lease_expires_at = NULL, updated_at = CURRENT_TIMESTAMP "
+    "WHERE task_id = ? AND lease_owner = ? AND status = 'processing'"
+)
+SQL_RETRY_LEASED = (
+    "UPDATE tasks SET status = 'pending', error_message = ?, available_at = ?, "
+    "lease_owner = NULL, lease_expires_at = NULL, updated_at = CURRENT_TIMESTAMP "
+    "WHERE task_id = ? AND lease_owner = ? AND status = 'processing'"
+)
+SQL_FAIL_LEASED = (
+    "UPDATE tasks SET status = 'failed', error_message = ?, retry_count = retry_count + 1, "
+    "lease_owner = NULL, lease_expires_at = NULL, updated_at = CURRENT_TIMESTAMP "
+    "WHERE task_id = ? AND lease_owner = ? AND status = 'processing'"
+)
+# 正常停机时归还租约，被中断的尝试不计入attempts
+SQL_RELEASE_OWNER = (
+    "UPDATE tasks SET status = 'pending', lease_owner = NULL, lease_expires_at = NULL, "
+    "attempts = MAX(attempts - 1, 0), available_at = 0 WHERE lease_owner = ? AND status = 'processing'"
+)
+SQL_REQUEUE_ORPHANS = (
+    "UPDATE tasks SET status = 'pending', lease_owner = NULL, lease_expires_at = NULL "
+    "WHERE task_type = ? AND status = 'processing' AND (lease_expires_at IS NULL OR lease_expires_at < ?)"
+)
+
+
+# Worker状态表 (API进程与独立worker进程共享)
+SQL_UPSERT_WORKER = (
+    "INSERT INTO workers (worker_id, hostname, pid, mode, status, started_at, heartbeat_at, "
+    "concurrency, in_flight, claimed, completed, failed, retried) "
+    "VALUES (:worker_id, :hostname, :pid, :mode, :status, :started_at, :heartbeat_at, "
+    ":concurrency, :in_flight, :claimed, :completed, :failed, :retried) "
+    "ON CONFLICT(worker_id) DO UPDATE SET status = excluded.status, heartbeat_at = excluded.heartbeat_at, "
+    "concurrency = excluded.concurrency, in_flight = excluded.in_flight, claimed = excluded.claimed, "
+    "completed = excluded.completed, failed = excluded.failed, retried = excluded.retried"
+)
+SQL_SELECT_WORKERS = "SELECT * FROM workers WHERE heartbeat_at >= ? ORDER BY started_at"
+SQL_COUNT_BY_STATUS = "SELECT status, COUNT(*) FROM tasks GROUP BY status"
+
+
+def encode_task_input(**fields) -> str:
+    return json.dumps(fields, ensure_ascii=False)
+
+
+def decode_task_input(input_data: Optional[str], default_key: str = "prompt") -> dict:
+    """解析任务输入JSON；旧版本直接存储prompt文本，解析失败时按原文处理"""
+    if input_data:
+        try:
+            data = json.loads(input_data)
+            if isinstance(data, dict):
+                return data
+        except ValueError:
+            pass
+    return {default_key: input_data or ""}
+
+_STOP = object()
+
+
+class TaskStateManager:
+    """SQLite任务状态管理器
+
+    所有SQL都在同一个写线程、同一个连接上执行；线程每次取出队列中积压的
+    全部操作，在一个事务里执行后统一提交(group commit)。异步方法只负责入队
+    并等待结果，不会在事件循环线程上做磁盘IO。
+    """
+
+    def __init__(self, db_path: Path, max_batch: int = 256, busy_timeout: float = 30.0):
+        """
+        Args:
+            db_path: 数据库文件路径
+            max_batch: 单次提交最多合并的操作数
+            busy_timeout: 多进程共享数据库时等待写锁的时间(秒)
+        """
+        self.db_path = db_path
+        self.max_batch = max_batch
+        self._queue: "queue.Queue" = queue.Queue()
+        self._counts: Counter = Counter()
+        self._counts_lock = threading.Lock()
+
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, cached_statements=64, timeout=busy_timeout)
+        self._conn.row_factory = sqlite3.Row
+        self._init_db()
+
+        self._thread = threading.Thread(target=self._run, name="task-state-writer", daemon=True)
+        self._thread.start()
+
+    def _init_db(self):
+        conn = self._conn
+        # WAL依赖同一主机上的共享内存(-shm)，多进程共享数据库仅限单主机本地磁盘，不能放在网络文件系统上
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS tasks (
+                task_id TEXT PRIMARY KEY,
+                task_type TEXT NOT NULL,
+                status TEXT DEFAULT 'pending',
+                input_data TEXT,
+                output_data TEXT,
+                error_message TEXT,
+                retry_count INTEGER DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_status ON tasks(status)")
+        self._migrate()
+        conn.commit()
+
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS workers (
+                worker_id TEXT PRIMARY KEY,
+                hostname TEXT,
+                pid INTEGER,
+                mode TEXT,
+                status TEXT,
+                started_at REAL,
+                heartbeat_at REAL,
+                concurrency INTEGER DEFAULT 0,
+                in_flight INTEGER DEFAULT 0,
+                claimed INTEGER DEFAULT 0,
+                completed INTEGER DEFAULT 0,
+                failed INTEGER DEFAULT 0,
+                retried INTEGER DEFAULT 0
+            )
+        """)
+        conn.commit()
+
+        # 启动时做一次全表统计，之后由内存计数维护
+        cursor = conn.execute(SQL_COUNT_BY_STATUS)
+        self._counts = Counter({row[0]: row[1] for row in cursor.fetchall()})
+
+    def _migrate(self):
+        conn = self._conn
+        existing = {row[1] for row in conn.execute("PRAGMA table_info(tasks)")}
+        for name, definition in QUEUE_COLUMNS:
+            if name not in existing:
+                conn.execute(f"ALTER TABLE tasks ADD COLUMN {name} {definition}")
+                logger.info(f"任务表已添加列: {name}")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_queue ON tasks(task_type, status, available_at)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_lease_owner ON tasks(lease_owner)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_output_ref ON tasks(output_ref)")
+
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS batches (
+                batch_id TEXT PRIMARY KEY,
+                task_type TEXT,
+                total INTEGER DEFAULT 0,
+                pending INTEGER DEFAULT 0,
+                processing INTEGER DEFAULT 0,
+                completed INTEGER DEFAULT 0,
+                failed INTEGER DEFAULT 0,
+                callback_url TEXT,
+                created_at REAL,
+                updated_at REAL
+            )
+        """)
+        if "callback_url" not in {row[1] for row in conn.execute("PRAGMA table_info(batches)")}:
+            conn.execute("ALTER TABLE batches ADD COLUMN callback_url TEXT")
+        if "batch_id" not in existing:
+            conn.execute("ALTER TABLE tasks ADD COLUMN batch_id TEXT")
+            backfilled = conn.execute(SQL_BACKFILL_BATCH_ID).rowcount
+            conn.execute(SQL_BACKFILL_BATCHES)
+            logger.info(f"任务表已添加列: batch_id (回填 {backfilled} 个批次任务)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_batch ON tasks(batch_id)")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS batch_events (
+                event_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                batch_id TEXT NOT NULL,
+                task_id TEXT NOT NULL,
+                event TEXT NOT NULL,
+                created_at REAL
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_batch_events ON batch_events(batch_id, event_id)")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS webhook_outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                batch_id TEXT NOT NULL,
+                task_id TEXT,
+                event TEXT NOT NULL,
+                url TEXT NOT NULL,
+                status TEXT DEFAULT 'pending',
+                attempts INTEGER DEFAULT 0,
+                next_attempt_at REAL DEFAULT 0,
+                last_error TEXT,
+                created_at REAL,
+                delivered_at REAL
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_webhook_due ON webhook_outbox(status, next_attempt_at)")
+        for trigger in BATCH_TRIGGERS:
+            conn.execute(trigger)
+
+    # ============ 写线程 ============
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+            batch = [item]
+            stop = False
+            while len(batch) < self.max_batch:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stop = True
+                    break
+                batch.append(item)
+            try:
+                self._execute_batch(batch)
+            except Exception as e:
+                # 写线程退出后所有数据库调用都会挂起，这里只记录错误
+                logger.error(f"任务状态写线程异常: {e}")
+            if stop:
+                break
+        self._conn.close()
+
+    def _execute_batch(self, batch: list):
+        conn = self._conn
+        delta: Counter = Counter()
+        results = []
+        try:
+            # 批次中有领取类操作时立即获取写锁，其他进程的领取在busy_timeout内排队
+            if not conn.in_transaction:
+                conn.execute("BEGIN IMMEDIATE" if any(immediate for _, _, immediate in batch) else "BEGIN")
+            for func, future, _ in batch:
+                # 调用方已被取消（wrap_future会同时取消该Future）时不再执行；
+                # 标记为running后Future不能再被取消，结果一定能投递
+                if not future.set_running_or_notify_cancel():
+                    continue
+                # 每个操作一个保存点：失败的操作只回滚自己的写入，不影响同批其他操作提交
+                op_delta: Counter = Counter()
+                conn.execute("SAVEPOINT op")
+                try:
+                    result = func(conn, op_delta)
+                except Exception as e:
+                    conn.execute("ROLLBACK TO op")
+                    conn.execute("RELEASE op")
+                    results.append((future, None, e))
+                    continue
+                conn.execute("RELEASE op")
+                delta.update(op_delta)
+                results.append((future, result, None))
+            conn.commit()
+        except Exception as e:
+            logger.error(f"任务状态提交失败: {e}")
+            conn.rollback()
+            for _, future, _ in batch:
+                if future.running():
+                    self._resolve(future, None, e)
+            return
+
+        if delta:
+            with self._counts_lock:
+                self._counts.update(delta)
+        for future, result, error in results:
+            self._resolve(future, result, error)
+
+    @staticmethod
+    def _resolve(future: Future, result: Any, error: Optional[BaseException]):
+        if future.done():
+            return
+        try:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+        except InvalidStateError:
+            pass
+
+    def _submit(self, func: Callable, immediate: bool = False) -> Future:
+        future: Future = Future()
+        self._queue.put((func, future, immediate))
+        return future
+
+    async def _call(self, func: Callable, immediate: bool = False):
+        """在写线程执行 func(conn, delta)；immediate=True 时所在批次以 BEGIN IMMEDIATE 开始事务"""
+        return await asyncio.wrap_future(self._submit(func, immediate))
+
+    def close(self):
+        """提交剩余操作并关闭连接"""
+        if self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join()
+
+    # ============ 任务操作 ============
+    async def create_task(self, task_id: str, task_type: str, input_data: str) -> bool:
+        def op(conn: sqlite3.Connection, delta: Counter) -> bool:
+            try:
+                conn.execute(SQL_INSERT_TASK, (task_id, task_type, input_data))
+            except sqlite3.IntegrityError:
+                return False
+            delta["pending"] += 1
+            return True
+        return await self._call(op)
+
+    async def get_task(self, task_id: str) -> Optional[dict]:
+        def op(conn: sqlite3.Connection, delta: Counter) -> Optional[dict]:
+            row = conn.execute(SQL_SELECT_TASK, (task_id,)).fetchone()
+            return dict(row) if row else None
+        return await self._call(op)
+
+    async def update_task(self, task_id: str, status: str, output_data: str = None, error: str = None):
+        def op(conn: sqlite3.Connection, delta: Counter):
+            row = conn.execute(SQL_SELECT_STATUS, (task_id,)).fetchone()
+            if not row:
+                return
+            if status == "completed":
+                conn.execute(SQL_UPDATE_COMPLETED, (status, output_data, task_id))
+            elif status == "failed":
+                conn.execute(SQL_UPDATE_FAILED, (status, error, task_id))
+            else:
+                conn.execute(SQL_UPDATE_STATUS, (status, task_id))
+            delta[row["status"]] -= 1
+            delta[status] += 1
+        await self._call(op)
+
+    async def get_pending_tasks(self, task_type: str = None, limit: int = 100) -> List[dict]:
+        def op(conn: sqlite3.Connection, delta: Counter) -> List[dict]:
+            if task_type:
+                cursor = conn.execute(SQL_SELECT_PENDING_BY_TYPE, (task_type, limit))
+            else:
+                cursor = conn.execute(SQL_SELECT_PENDING, (limit,))
+            return [dict(row) for row in cursor.fetchall()]
+        return await self._call(op)
+
+    async def cleanup_old_tasks(self, days: int = 7) -> Tuple[int, List[str]]:
+        """删除过期的已完成任务，返回(删除数, 不再被任何任务引用的blob引用)"""
+        def op(conn: sqlite3.Connection, delta: Counter) -> Tuple[int, List[str]]:
+            age = f'-{days} days'
+            refs = [row[0] for row in conn.execute(SQL_SELECT_EXPIRED_REFS, (age,))]
+            deleted = conn.execute(SQL_CLEANUP, (age,)).rowcount
+            conn.execute(SQL_CLEANUP_BATCHES)
+            conn.execute(SQL_CLEANUP_BATCH_EVENTS)
+            conn.execute(SQL_CLEANUP_WEBHOOKS, (time.time() - days * 86400,))
+            delta["completed"] -= deleted
+            # 相同内容的blob可能被多个任务引用（去重），只返回已无引用的
+            return deleted, [ref for ref in refs if not conn.execute(SQL_REF_IN_USE, (ref,)).fetchone()]
+        return await self._call(op)
+
+    async def referenced_blob_hashes(self) -> Set[str]:
+        """仍被任务引用的blob哈希（孤立blob清扫用）"""
+        def op(conn: sqlite3.Connection, delta: Counter) -> Set[str]:
+            return {row[0] for row in conn.execute(SQL_SELECT_BLOB_HASHES)}
+        return await self._call(op)
+
+    # ============ 批次 ============
+    async def create_batch(self, batch_id: str, task_type: str, inputs: Sequence[str],
+                           callback_url: Optional[str] = None) -> List[str]:
+        """在一个事务里创建批次及其全部任务，返回任务ID列表；callback_url不为空时任务结束后投递webhook"""
+        def op(conn: sqlite3.Connection, delta: Counter) -> List[str]:
+            now = time.time()
+            task_ids = [f"{batch_id}_task_{i}" for i in range(len(inputs))]
+            conn.execute(SQL_INSERT_BATCH, (batch_id, task_type, callback_url, now, now))
+            conn.executemany(
+                SQL_INSERT_BATCH_TASK,
+                [(task_id, task_type, input_data, batch_id) for task_id, input_data in zip(task_ids, inputs)],
+            )
+            delta["pending"] += len(task_ids)
+            return task_ids
+        return await self._call(op)
+
+    async def get_batch(self, batch_id: str) -> Optional[dict]:
+        """批次聚合计数（O(1)，不扫描任务）"""
+        def op(conn: sqlite3.Connection, delta: Counter) -> Optional[dict]:
+            row = conn.execute(SQL_SELECT_BATCH_INFO, (batch_id,)).fetchone()
+            return dict(row) if row else None
+        return await self._call(op)
+
+    async def get_batch_events(self, batch_id: str, after: int = 0,
+                               limit: int = 100) -> Tuple[Optional[dict], List[dict]]:
+        """读取event_id > after的事件，同时返回批次计数（同一次读取，判断批次结束时不会漏事件）"""
+        def op(conn: sqlite3.Connection, delta: Counter) -> Tuple[Optional[dict], List[dict]]:
+            batch = conn.execute(SQL_SELECT_BATCH_INFO, (batch_id,)).fetchone()
+            if not batch:
+                return None, []
+            rows = conn.execute(SQL_SELECT_BATCH_EVENTS, (batch_id, after, limit)).fetchall()
+            return dict(batch), [dict(row) for row in rows]
+        return await self._call(op)
+
+    async def get_batch_tasks(self, batch_id: str, cursor: int = 0, limit: int = 100) -> List[dict]:
+        """按rowid分页读取批次任务；下一页的cursor为本页最后一条的seq"""
+        def op(conn: sqlite3.Connection, delta: Counter) -> List[dict]:
+            rows = conn.execute(SQL_SELECT_BATCH_PAGE, (batch_id, cursor, limit)).fetchall()
+            return [dict(row) for row in rows]
+        return await self._call(op)
+
+    # ============ 任务队列 (租约) ============
+    async def claim_tasks(self, owner: str, task_type: str, limit: int, lease_seconds: float) -> List[dict]:
+        """领取最多limit个可执行任务并加租约；多个进程共享数据库时也不会重复领取
+
+        调用方在领取已开始执行后被取消时，结果会丢失但租约已写入：worker停止时由release_owner归还
+        (写线程按提交顺序执行，归还一定在领取之后)，其他情况由租约过期后的重新领取兜底。
+        """
+        def op(conn: sqlite3.Connection, delta: Counter) -> List[dict]:
+            now = time.time()
+            rows = conn.execute(SQL_SELECT_CLAIMABLE, (task_type, now, now, limit)).fetchall()
+            claimed = []
+            for row in rows:
+                cursor = conn.execute(SQL_CLAIM, (owner, now + lease_seconds, now, row["task_id"], now, now))
+                if cursor.rowcount == 0:
+                    continue
+                if row["status"] != "processing":
+                    delta[row["status"]] -= 1
+                    delta["processing"] += 1
+                claimed.append(dict(conn.execute(SQL_SELECT_TASK, (row["task_id"],)).fetchone()))
+            return claimed
+        return await self._call(op, immediate=True)
+
+    async def heartbeat(self, owner: str, task_ids: Sequence[str], lease_seconds: float) -> List[str]:
+        """续租，返回租约已丢失的任务ID"""
+        def op(conn: sqlite3.Connection, delta: Counter) -> List[str]:
+            now = time.time()
+            return [
+                task_id for task_id in task_ids
+                if conn.execute(SQL_HEARTBEAT, (now + lease_seconds, now, task_id, owner)).rowcount == 0
+            ]
+        return await self._call(op)
+
+    async def complete_leased(self, task_id: str, owner: str, output_data: Optional[str],
+                              blob: Optional[BlobRef] = None) -> bool:
+        """完成任务；blob不为空时只保存其引用。租约已被其他worker接管时返回False"""
+        def op(conn: sqlite3.Connection, delta: Counter) -> bool:
+            params = (blob.ref, blob.size, blob.hash, blob.mime) if blob else (None, None, None, None)
+            if conn.execute(SQL_COMPLETE_LEASED, (output_data, *params, task_id, owner)).rowcount == 0:
+                return False
+            delta["processing"] -= 1
+            delta["completed"] += 1
+            return True
+        return await self._call(op)
+
+    async def fail_leased(self, task_id: str, owner: str, error: str, retry_at: Optional[float] = None) -> bool:
+        """任务失败：retry_at不为空时放回队列延迟重试，否则标记为failed"""
+        def op(conn: sqlite3.Connection, delta: Counter) -> bool:
+            if retry_at is not None:
+                updated = conn.execute(SQL_RETRY_LEASED, (error, retry_at, task_id, owner)).rowcount
+                status = "pending"
+            else:
+                updated = conn.execute(SQL_FAIL_LEASED, (error, task_id, owner)).rowcount
+                status = "failed"
+            if not updated:
+                return False
+            delta["processing"] -= 1
+            delta[status] += 1
+            return True
+        return await self._call(op)
+
+    async def release_owner(self, owner: str) -> int:
+        """归还某个worker持有的全部租约"""
+        def op(conn: sqlite3.Connection, delta: Counter) -> int:
+            released = conn.execute(SQL_RELEASE_OWNER, (owner,)).rowcount
+            delta["processing"] -= released
+            delta["pending"] += released
+            return released
+        return await self._call(op)
+
+    async def requeue_orphans(self, task_type: str) -> int:
+        """把无租约或租约已过期的processing任务放回pending（启动时恢复中断的任务）"""
+        def op(conn: sqlite3.Connection, delta: Counter) -> int:
+            requeued = conn.execute(SQL_REQUEUE_ORPHANS, (task_type, time.time())).rowcount
+            delta["processing"] -= requeued
+            delta["pending"] += requeued
+            return requeued
+        return await self._call(op)
+
+    # ============ Webhook发件箱 ============
+    async def claim_webhooks(self, limit: int, lease_seconds: float) -> List[dict]:
+        """领取到期的待投递webhook；lease_seconds内其他投递者不会再领取"""
+        def op(conn: sqlite3.Connection, delta: Counter) -> List[dict]:
+            now = time.time()
+            claimed = []
+            for row in conn.execute(SQL_CLAIM_WEBHOOKS, (now, limit)).fetchall():
+                if conn.execute(SQL_LEASE_WEBHOOK, (now + lease_seconds, row["id"], now)).rowcount:
+                    item = dict(row)
+                    item["attempts"] += 1
+                    claimed.append(item)
+            return claimed
+        return await self._call(op, immediate=True)
+
+    async def webhook_delivered(self, webhook_id: int):
+        def op(conn: sqlite3.Connection, delta: Counter):
+            conn.execute(SQL_DELIVERED_WEBHOOK, (time.time(), webhook_id))
+        await self._call(op)
+
+    async def webhook_failed(self, webhook_id: int, error: str, retry_at: Optional[float] = None):
+        """投递失败：retry_at不为空时延迟重试，否则标记为dead"""
+        def op(conn: sqlite3.Connection, delta: Counter):
+            if retry_at is not None:
+                conn.execute(SQL_RETRY_WEBHOOK, (error, retry_at, webhook_id))
+            else:
+                conn.execute(SQL_DEAD_WEBHOOK, (error, webhook_id))
+        await self._call(op)
+
+    async def webhook_counts(self) -> Dict[str, int]:
+        def op(conn: sqlite3.Connection, delta: Counter) -> Dict[str, int]:
+            return {row[0]: row[1] for row in conn.execute(SQL_COUNT_WEBHOOKS).fetchall()}
+        return await self._call(op)
+
+    # ============ Worker状态 ============
+    async def report_worker(self, info: dict):
+        def op(conn: sqlite3.Connection, delta: Counter):
+            conn.execute(SQL_UPSERT_WORKER, info)
+        await self._call(op)
+
+    async def list_workers(self, active_within: float = 300.0) -> List[dict]:
+        """最近active_within秒内有心跳的worker"""
+        def op(conn: sqlite3.Connection, delta: Counter) -> List[dict]:
+            cursor = conn.execute(SQL_SELECT_WORKERS, (time.time() - active_within,))
+            return [dict(row) for row in cursor.fetchall()]
+        return await self._call(op)
+
+    async def resync_counts(self):
+        """重新统计状态计数（其他进程也在修改任务表时定期调用）"""
+        def op(conn: sqlite3.Connection, delta: Counter):
+            # 以修正量的形式写入delta，与同一批次中其他操作的计数变化保持一致
+            actual = Counter({row[0]: row[1] for row in conn.execute(SQL_COUNT_BY_STATUS).fetchall()})
+            with self._counts_lock:
+                expected = Counter(self._counts)
+            expected.update(delta)
+            for status in set(actual) | set(expected):
+                delta[status] += actual.get(status, 0) - expected.get(status, 0)
+        await self._call(op)
+
+    def get_stats(self) -> dict:
+        """O(1)：读取内存状态计数，不访问数据库"""
+        with self._counts_lock:
+            stats: Dict[str, int] = {status: self._counts.get(status, 0) for status in TASK_STATUSES}
+            total = sum(self._counts.values())
+        stats["total"] = total
+        return stats
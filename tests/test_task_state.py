@@ -0,0 +1,74 @@
+"""
+TaskStateManager 写线程测试：调用方取消不影响写线程；同批合并提交时失败操作的部分写入不被提交
+
+用法:
+    python -m pytest -q tests/test_task_state.py
+"""
+import asyncio
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from task_state import TaskStateManager  # noqa: E402
+
+
+@pytest.fixture
+def manager():
+    with tempfile.TemporaryDirectory() as tmp:
+        manager = TaskStateManager(str(Path(tmp) / "tasks.db"))
+        yield manager
+        manager.close()
+
+
+def test_cancelled_callers_keep_writer_alive(manager):
+    def slow(conn, delta):
+        time.sleep(0.2)
+        return "slow"
+
+    async def scenario():
+        # 1) 操作正在执行时取消；2) 操作排队等待时取消
+        running = asyncio.create_task(manager._call(slow))
+        queued = asyncio.create_task(manager._call(slow))
+        await asyncio.sleep(0.05)
+        running.cancel()
+        queued.cancel()
+        await asyncio.gather(running, queued, return_exceptions=True)
+
+        await asyncio.wait_for(manager.create_task("cancel_check", "check", "{}"), timeout=5)
+        return await asyncio.wait_for(manager.get_task("cancel_check"), timeout=5)
+
+    assert asyncio.run(scenario()) is not None
+    assert manager._thread.is_alive()
+
+
+def test_failed_op_rolls_back_only_its_own_writes(manager):
+    def partial_then_fail(conn, delta):
+        conn.execute("INSERT INTO tasks (task_id, task_type, input_data) VALUES ('partial', 'check', '{}')")
+        delta["pending"] += 1
+        raise RuntimeError("boom")
+
+    def slow(conn, delta):
+        time.sleep(0.2)
+
+    async def scenario():
+        # 先占住写线程，让后面三个操作进入同一批提交
+        blocker = asyncio.create_task(manager._call(slow))
+        await asyncio.sleep(0.05)
+        before = asyncio.create_task(manager.create_task("before", "check", "{}"))
+        failing = asyncio.create_task(manager._call(partial_then_fail))
+        after = asyncio.create_task(manager.create_task("after", "check", "{}"))
+        await blocker
+        assert await before and await after
+        with pytest.raises(RuntimeError):
+            await failing
+        return [await manager.get_task(task_id) for task_id in ("before", "partial", "after")]
+
+    before, partial, after = asyncio.run(scenario())
+    assert before is not None and after is not None
+    assert partial is None
+    assert manager.get_stats()["pending"] == 2
@@ -0,0 +1,164 @@
+"""
+Webhook投递测试：本地HTTP接收方收取签名后的任务/批次结束事件，验证重试与回调地址校验
+
+用法:
+    python -m pytest -q tests/test_webhook_dispatcher.py
+"""
+import asyncio
+import json
+import sys
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from task_state import TaskStateManager  # noqa: E402
+from webhook_dispatcher import (  # noqa: E402
+    SIGNATURE_HEADER,
+    TIMESTAMP_HEADER,
+    CallbackURLError,
+    WebhookDispatcher,
+    check_callback_url,
+    verify_signature,
+)
+
+SECRET = "test-secret"
+
+
+class Receiver:
+    """本地接收方：记录收到的请求，前fail_first次返回500"""
+
+    def __init__(self, fail_first: int = 0):
+        self.requests = []
+        self.fail_first = fail_first
+        receiver = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                failing = receiver.fail_first > 0
+                if failing:
+                    receiver.fail_first -= 1
+                else:
+                    receiver.requests.append((dict(self.headers), body))
+                self.send_response(500 if failing else 204)
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/hook"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+async def build_payload(row: dict) -> dict:
+    return {"batch_id": row["batch_id"], "task_id": row["task_id"]}
+
+
+async def finish_batch(manager: TaskStateManager, url: str):
+    """创建两个任务的批次，一个完成一个失败 -> task.completed / task.failed / batch.completed"""
+    await manager.create_batch("batch_t", "batch_image", ["{}", "{}"], callback_url=url)
+    claimed = await manager.claim_tasks("worker", "batch_image", 2, 60)
+    await manager.complete_leased(claimed[0]["task_id"], "worker", "{}")
+    await manager.fail_leased(claimed[1]["task_id"], "worker", "boom")
+
+
+async def wait_for(predicate, timeout: float = 5.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not predicate():
+        assert asyncio.get_running_loop().time() < deadline, "等待超时"
+        await asyncio.sleep(0.02)
+
+
+def test_delivers_signed_events_with_retry():
+    receiver = Receiver(fail_first=1)
+
+    async def scenario():
+        with tempfile.TemporaryDirectory() as tmp:
+            manager = TaskStateManager(str(Path(tmp) / "tasks.db"))
+            dispatcher = WebhookDispatcher(
+                manager, build_payload, secret=SECRET, retry_base_delay=0.05,
+                poll_interval=0.05, allow_private=True,
+            )
+            await dispatcher.start()
+            try:
+                await finish_batch(manager, receiver.url)
+                dispatcher.wake()
+                await wait_for(lambda: len(receiver.requests) == 3)
+                await wait_for(lambda: dispatcher.delivered == 3)
+                assert dispatcher.retried == 1
+                assert await manager.webhook_counts() == {"delivered": 3}
+            finally:
+                await dispatcher.stop()
+                manager.close()
+
+    try:
+        asyncio.run(scenario())
+    finally:
+        receiver.close()
+
+    events = set()
+    for headers, body in receiver.requests:
+        assert verify_signature(SECRET, headers[TIMESTAMP_HEADER], body, headers[SIGNATURE_HEADER])
+        payload = json.loads(body)
+        assert payload["event"] == headers["X-Webhook-Event"]
+        assert payload["batch_id"] == "batch_t"
+        events.add(payload["event"])
+    assert events == {"task.completed", "task.failed", "batch.completed"}
+
+
+def test_blocks_private_callback_at_delivery():
+    receiver = Receiver()
+
+    async def scenario():
+        with tempfile.TemporaryDirectory() as tmp:
+            manager = TaskStateManager(str(Path(tmp) / "tasks.db"))
+            dispatcher = WebhookDispatcher(manager, build_payload, poll_interval=0.05)
+            await dispatcher.start()
+            try:
+                await finish_batch(manager, receiver.url)
+                dispatcher.wake()
+                await wait_for(lambda: dispatcher.blocked == 3)
+                assert await manager.webhook_counts() == {"dead": 3}
+            finally:
+                await dispatcher.stop()
+                manager.close()
+
+    try:
+        asyncio.run(scenario())
+    finally:
+        receiver.close()
+    assert receiver.requests == []
+
+
+@pytest.mark.parametrize("url", [
+    "ftp://example.com/hook",
+    "http:///hook",
+    "http://127.0.0.1:8000/hook",
+    "http://localhost/hook",
+    "http://10.0.0.5/hook",
+    "http://192.168.1.10/hook",
+    "http://169.254.169.254/latest/meta-data/",
+    "http://[::1]/hook",
+    "http://[::ffff:127.0.0.1]/hook",
+])
+def test_rejects_non_public_callback(url):
+    with pytest.raises(CallbackURLError):
+        asyncio.run(check_callback_url(url))
+
+
+def test_allowlist_and_public_address():
+    asyncio.run(check_callback_url("https://93.184.216.34/hook"))
+    asyncio.run(check_callback_url("http://hooks.internal/hook", allowed_hosts=["hooks.internal"]))
+    with pytest.raises(CallbackURLError):
+        asyncio.run(check_callback_url("https://93.184.216.34/hook", allowed_hosts=["hooks.internal"]))
+    asyncio.run(check_callback_url("http://127.0.0.1/hook", allow_private=True))
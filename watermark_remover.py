@@ -4,29 +4,53 @@ Gemini Watermark Remover - Python Implementation
 关键词: gemini, watermark, removal, alpha, reverse-blending
 """
 import numpy as np
-from PIL import Image
-from typing import Tuple, Dict, Optional
+from PIL import Image, features
+from typing import Tuple, Dict, List, Optional
 from pathlib import Path
 import io
+import zlib
 
 # 常量定义
 ALPHA_THRESHOLD = 0.002  # 忽略极小Alpha值（噪声）
 MAX_ALPHA = 0.99         # 避免除零
 LOGO_VALUE = 255         # 白色水印颜色值
 
+# 输出编码
+FORMAT_MIME = {"PNG": "image/png", "JPEG": "image/jpeg", "WEBP": "image/webp", "AVIF": "image/avif"}
+# 配合压缩级别1，照片类内容编码速度约为默认设置的3~4倍；体积不保证不增:
+# PNG源图约小5%，JPEG源图(解码后含压缩噪声)约大0.5%~2.5%（见 benchmarks/bench_watermark_encode.py）
+PNG_STRATEGY = zlib.Z_RLE
+AVIF_AVAILABLE = features.check("avif")
+AVIF_QUALITY = 60          # AVIF质量刻度与JPEG不同，60已接近JPEG 90的观感
+# 偏向速度的编码参数: JPEG优化哈夫曼表(更小且几乎不增加耗时)；WebP method=2、AVIF speed=8
+# 耗时约为默认值的1/3，体积差异在5%以内
+ENCODER_SETTINGS = {
+    "JPEG": {"optimize": True},
+    "WEBP": {"method": 2},
+    "AVIF": {"speed": 8},
+}
+
 
 class WatermarkRemover:
     """Gemini水印去除器"""
 
-    def __init__(self, asset_dir: Path = None):
+    def __init__(self, asset_dir: Path = None, png_compress_level: int = 1,
+                 keep_source_format: bool = False, quality: int = 95):
         """
         初始化水印去除器
 
         Args:
             asset_dir: 资产文件目录，包含bg_48.png和bg_96.png
+            png_compress_level: PNG压缩级别(0-9)，默认1（配合Z_RLE，速度约为默认级别的3~4倍，体积可能略增）
+            keep_source_format: 源图为JPEG/WebP时按原格式输出，否则统一输出PNG
+            quality: 按JPEG/WebP输出且未指定compression时的质量
         """
         self.asset_dir = asset_dir or Path(__file__).parent
+        self.png_compress_level = png_compress_level
+        self.keep_source_format = keep_source_format
+        self.quality = quality
         self._alpha_maps = {}
+        self._blend_params = {}
 
     def detect_watermark_config(self, image_width: int, image_height: int) -> Dict[str, int]:
         """
@@ -82,17 +106,68 @@ class WatermarkRemover:
         bg_img = Image.open(bg_path).convert("RGBA")
         bg_array = np.array(bg_img)
 
-        alpha_map = np.zeros((size, size), dtype=np.float32)
-
-        for i in range(size):
-            for j in range(size):
-                r, g, b, _ = bg_array[i, j]
-                max_channel = max(r, g, b)
-                alpha_map[i, j] = max_channel / 255.0
+        # Alpha = max(R, G, B) / 255
+        alpha_map = (bg_array[..., :3].max(axis=2) / 255.0).astype(np.float32)
 
         self._alpha_maps[size] = alpha_map
         return alpha_map
 
+    def _load_blend_params(self, size: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        预计算反向混合参数（按水印尺寸缓存）
+
+        Returns:
+            (active, clamped, offset, denominator)
+            active: 需要处理的像素掩码（Alpha >= ALPHA_THRESHOLD）
+            clamped: Alpha超过MAX_ALPHA、需要截断的像素掩码
+            offset: α × logo (float32)
+            denominator: 1 - α (float32)
+        """
+        if size in self._blend_params:
+            return self._blend_params[size]
+
+        alpha_map = self.load_alpha_map(size)
+        active = alpha_map >= ALPHA_THRESHOLD
+        clamped = active & (alpha_map > MAX_ALPHA)
+        offset = alpha_map * np.float32(LOGO_VALUE)
+        # 截断像素单独按MAX_ALPHA计算，这里置1避免除零
+        denominator = np.where(clamped, np.float32(1.0), np.float32(1.0) - alpha_map)
+
+        params = (active, clamped, offset, denominator)
+        self._blend_params[size] = params
+        return params
+
+    def preload(self, sizes: Tuple[int, ...] = (48, 96)) -> List[int]:
+        """预加载Alpha映射与混合参数（图片worker进程启动时调用），返回成功加载的尺寸"""
+        loaded = []
+        for size in sizes:
+            try:
+                self._load_blend_params(size)
+                loaded.append(size)
+            except FileNotFoundError:
+                pass
+        return loaded
+
+    @property
+    def encoder_options(self) -> Dict:
+        """编码相关的构造参数（图片worker进程按同样的设置创建去除器）"""
+        return {
+            "png_compress_level": self.png_compress_level,
+            "keep_source_format": self.keep_source_format,
+            "quality": self.quality,
+        }
+
+    def watermark_box(self, image_width: int, image_height: int) -> Optional[Tuple[int, int, int, int]]:
+        """水印区域裁剪到图片范围内后的(x0, y0, x1, y1)，与图片不相交时返回None"""
+        config = self.detect_watermark_config(image_width, image_height)
+        position = self.calculate_watermark_position(image_width, image_height, config)
+        x, y = position["x"], position["y"]
+        x0, y0 = max(x, 0), max(y, 0)
+        x1, y1 = min(x + position["width"], image_width), min(y + position["height"], image_height)
+        if x0 >= x1 or y0 >= y1:
+            return None
+        return x0, y0, x1, y1
+
     def remove_watermark(self, image_array: np.ndarray) -> np.ndarray:
         """
         从图片中去除水印（原地修改）
@@ -108,63 +183,145 @@ class WatermarkRemover:
             处理后的图片数组
         """
         height, width = image_array.shape[:2]
+        box = self.watermark_box(width, height)
+        if box is None:
+            return image_array
 
-        # 检测水印配置
-        config = self.detect_watermark_config(width, height)
-        position = self.calculate_watermark_position(width, height, config)
-
-        # 获取Alpha映射
-        alpha_map = self.load_alpha_map(config["logoSize"])
+        x0, y0, x1, y1 = box
+        self.restore_region(image_array[y0:y1, x0:x1], width, height)
+        return image_array
 
-        # 处理水印区域的每个像素
-        x, y, wm_width, wm_height = position["x"], position["y"], position["width"], position["height"]
+    def restore_region(self, region: np.ndarray, image_width: int, image_height: int) -> np.ndarray:
+        """
+        对水印区域(watermark_box裁出的部分)做反向混合（原地修改）
 
-        for row in range(wm_height):
-            for col in range(wm_width):
-                img_y, img_x = y + row, x + col
+        Args:
+            region: 水印区域的像素数组，形状与watermark_box一致
+            image_width / image_height: 整张图片的尺寸（决定水印配置）
+        """
+        config = self.detect_watermark_config(image_width, image_height)
+        position = self.calculate_watermark_position(image_width, image_height, config)
+        x0, y0, x1, y1 = self.watermark_box(image_width, image_height)
+        x, y = position["x"], position["y"]
+
+        active, clamped, offset, denominator = self._load_blend_params(config["logoSize"])
+
+        # Alpha映射中与ROI对应的部分
+        alpha_slice = (slice(y0 - y, y1 - y), slice(x0 - x, x1 - x))
+        active = active[alpha_slice]
+        clamped = clamped[alpha_slice]
+
+        # ROI视图（RGB三通道），修改会直接写回原数组
+        roi = region[..., :3]
+
+        # 反向Alpha混合，Alpha映射广播到RGB三个通道
+        restored = (roi - offset[alpha_slice][..., None]) / denominator[alpha_slice][..., None]
+        restored = np.clip(np.round(restored), 0, 255)
+
+        # 限制Alpha值避免除零（与逐像素实现一致，按float64计算）
+        if clamped.any():
+            original = (roi[clamped] - MAX_ALPHA * LOGO_VALUE) / (1.0 - MAX_ALPHA)
+            restored[clamped] = np.clip(np.round(original), 0, 255)
+
+        # 跳过极小Alpha值
+        roi[...] = np.where(active[..., None], restored, roi)
+
+        return region
+
+    # ============ 编解码 ============
+    def open_image(self, image_bytes: bytes) -> Image.Image:
+        """解码图片并统一为RGB/RGBA"""
+        img = Image.open(io.BytesIO(image_bytes))
+        img.load()
+        if img.mode not in ("RGB", "RGBA"):
+            source_format = img.format
+            img = img.convert("RGBA" if img.mode in ("P", "PA", "LA") else "RGB")
+            img.format = source_format
+        return img
+
+    def remove_watermark_image(self, img: Image.Image) -> Image.Image:
+        """只取出水印区域去水印后贴回（原地修改），不把整张图转为数组"""
+        box = self.watermark_box(img.width, img.height)
+        if box is None:
+            return img
+        region = np.array(img.crop(box))
+        self.restore_region(region, img.width, img.height)
+        img.paste(Image.fromarray(region), box[:2])
+        return img
+
+    def output_format(self, source_mime: Optional[str] = None, requested: Optional[str] = None) -> str:
+        """
+        输出格式: 指定了requested时按指定格式(AVIF不可用时回退WebP)；
+        否则保持源格式时JPEG/WebP按原格式，其余PNG
+        """
+        if requested:
+            requested = requested.upper()
+            if requested == "AVIF" and not AVIF_AVAILABLE:
+                return "WEBP"
+            return requested if requested in FORMAT_MIME else "PNG"
+        if self.keep_source_format and source_mime:
+            for fmt, mime in FORMAT_MIME.items():
+                if mime == source_mime:
+                    return fmt
+        return "PNG"
+
+    def save_image(self, img: Image.Image, fmt: str = "PNG", compression: Optional[int] = None) -> bytes:
+        """
+        按格式编码
 
-                # 边界检查
-                if img_y >= height or img_x >= width:
-                    continue
+        Args:
+            fmt: PNG / JPEG / WEBP / AVIF
+            compression: PNG为压缩级别(0-9)，其余格式为质量(1-100)；None时使用去除器的默认设置
+        """
+        output = io.BytesIO()
+        if fmt == "PNG":
+            level = self.png_compress_level if compression is None else compression
+            img.save(output, format="PNG", compress_level=level, compress_type=PNG_STRATEGY)
+            return output.getvalue()
 
-                alpha = alpha_map[row, col]
+        if compression is None:
+            compression = AVIF_QUALITY if fmt == "AVIF" else self.quality
+        if fmt == "JPEG" and img.mode != "RGB":
+            img = img.convert("RGB")
+        img.save(output, format=fmt, quality=compression, **ENCODER_SETTINGS.get(fmt, {}))
+        return output.getvalue()
 
-                # 跳过极小Alpha值
-                if alpha < ALPHA_THRESHOLD:
-                    continue
+    def decode(self, image_bytes: bytes) -> np.ndarray:
+        """解码图片字节流为数组（进程池模式的decode阶段，数组放入共享内存）"""
+        return np.array(self.open_image(image_bytes))
 
-                # 限制Alpha值避免除零
-                alpha = min(alpha, MAX_ALPHA)
-                one_minus_alpha = 1.0 - alpha
+    def encode(self, image_array: np.ndarray, fmt: str = "PNG", compression: Optional[int] = None) -> bytes:
+        """把数组编码为字节流（进程池模式的encode阶段）"""
+        return self.save_image(Image.fromarray(image_array), fmt, compression)
 
-                # 对RGB三个通道应用反向Alpha混合
-                for c in range(3):
-                    watermarked = image_array[img_y, img_x, c]
-                    original = (watermarked - alpha * LOGO_VALUE) / one_minus_alpha
-                    image_array[img_y, img_x, c] = np.clip(np.round(original), 0, 255)
+    def process_bytes(self, image_bytes: bytes, output_format: Optional[str] = None,
+                      compression: Optional[int] = None) -> Tuple[bytes, str]:
+        """
+        去水印并重新编码，返回(字节流, MIME)
 
-        return image_array
+        PNG/JPEG无法只解码局部，整图解码不可避免；去水印只处理水印区域，
+        编码按output_format/compression，未指定时使用快速PNG设置或在keep_source_format时按源格式输出。
+        """
+        img = self.open_image(image_bytes)
+        fmt = self.output_format(FORMAT_MIME.get(img.format), output_format)
+        self.remove_watermark_image(img)
+        return self.save_image(img, fmt, compression), FORMAT_MIME[fmt]
 
-    def remove_from_bytes(self, image_bytes: bytes) -> bytes:
+    def remove_from_bytes(self, image_bytes: bytes, output_format: Optional[str] = None,
+                          compression: Optional[int] = None) -> bytes:
         """
         从字节流中去除水印
 
         Args:
             image_bytes: 图片字节流
+            output_format: 输出格式 PNG/JPEG/WEBP/AVIF，None时按默认设置
+            compression: PNG压缩级别(0-9)或有损格式的质量(1-100)
 
         Returns:
-            处理后的图片字节流（PNG格式）
+            处理后的图片字节流（默认PNG；keep_source_format时JPEG/WebP保持原格式）
         """
         try:
-            img = Image.open(io.BytesIO(image_bytes))
-            image_array = np.array(img)
-
-            processed_array = self.remove_watermark(image_array)
-            processed_img = Image.fromarray(processed_array)
-
-            output = io.BytesIO()
-            processed_img.save(output, format="PNG")
-            return output.getvalue()
+            return self.process_bytes(image_bytes, output_format, compression)[0]
 
         except Exception as e:
             print(f"Watermark removal failed: {e}")
@@ -178,7 +335,7 @@ class WatermarkRemover:
             base64_data: Base64编码的图片数据
 
         Returns:
-            处理后的Base64数据（PNG格式）
+            处理后的Base64数据（data URI，MIME与输出格式一致）
         """
         import base64 as b64
 
@@ -187,8 +344,12 @@ class WatermarkRemover:
             base64_data = base64_data.split(",", 1)[1]
 
         image_bytes = b64.b64decode(base64_data)
-        processed_bytes = self.remove_from_bytes(image_bytes)
-        return f"data:image/png;base64,{b64.b64encode(processed_bytes).decode()}"
+        try:
+            processed_bytes, mime = self.process_bytes(image_bytes)
+        except Exception as e:
+            print(f"Watermark removal failed: {e}")
+            processed_bytes, mime = image_bytes, "image/png"
+        return f"data:{mime};base64,{b64.b64encode(processed_bytes).decode()}"
 
     def get_watermark_info(self, image_width: int, image_height: int) -> Dict:
         """获取水印信息（用于显示）"""
@@ -0,0 +1,259 @@
+"""
+Webhook投递器
+功能: 从任务库的webhook发件箱领取待投递记录，HMAC-SHA256签名后POST到回调地址；有界并发、指数退避重试，记录持久化，重启后继续投递；
+      回调地址需在允许列表中或解析为公网地址（入队与每次投递前各校验一次），防止SSRF访问内网/元数据服务
+关键词: webhook, outbox, hmac, signature, retry, backoff, at-least-once, ssrf
+"""
+import asyncio
+import hashlib
+import hmac
+import ipaddress
+import json
+import logging
+import socket
+import time
+from typing import Awaitable, Callable, Dict, Iterable, Optional
+from urllib.parse import urlsplit
+
+from http_pool import PooledHTTPClient
+from task_state import TaskStateManager
+
+logger = logging.getLogger(__name__)
+
+SIGNATURE_HEADER = "X-Webhook-Signature"
+TIMESTAMP_HEADER = "X-Webhook-Timestamp"
+
+
+def sign_payload(secret: str, timestamp: str, body: bytes) -> str:
+    """签名 = HMAC-SHA256(secret, "{timestamp}.{body}")；接收方用同样方式校验并检查时间戳防重放"""
+    message = timestamp.encode() + b"." + body
+    return "sha256=" + hmac.new(secret.encode(), message, hashlib.sha256).hexdigest()
+
+
+class CallbackURLError(ValueError):
+    """回调地址不允许投递"""
+    pass
+
+
+def _is_public_address(address: str) -> bool:
+    ip = ipaddress.ip_address(address.split("%", 1)[0])
+    if isinstance(ip, ipaddress.IPv6Address) and ip.ipv4_mapped:
+        ip = ip.ipv4_mapped
+    # is_global 排除回环、链路本地(含169.254.169.254元数据)、私有、共享(CGNAT)、保留等地址段
+    return ip.is_global and not ip.is_multicast
+
+
+async def check_callback_url(url: str, allowed_hosts: Iterable[str] = (), allow_private: bool = False):
+    """
+    校验回调地址，不允许时抛出 CallbackURLError
+
+    Args:
+        url: 回调地址，必须是 http(s)
+        allowed_hosts: 主机名允许列表（非空时只允许列表中的主机，不再检查解析结果）
+        allow_private: 允许解析到内网/回环地址（仅用于本地调试）
+    """
+    try:
+        parts = urlsplit(url)
+        port = parts.port
+    except ValueError:
+        raise CallbackURLError("callback_url 格式错误")
+    if parts.scheme not in ("http", "https") or not parts.hostname:
+        raise CallbackURLError("callback_url 必须是 http(s) 地址")
+    host = parts.hostname.lower()
+
+    allowed = {h.strip().lower() for h in allowed_hosts if h.strip()}
+    if allowed:
+        if host not in allowed:
+            raise CallbackURLError(f"callback_url 主机 {host} 不在允许列表中")
+        return
+    if allow_private:
+        return
+
+    try:
+        infos = await asyncio.get_running_loop().getaddrinfo(
+            host, port or (443 if parts.scheme == "https" else 80), type=socket.SOCK_STREAM
+        )
+    except socket.gaierror:
+        raise CallbackURLError(f"callback_url 主机 {host} 无法解析")
+    for info in infos:
+        if not _is_public_address(info[4][0]):
+            raise CallbackURLError(f"callback_url 主机 {host} 解析到非公网地址 {info[4][0]}")
+
+
+def verify_signature(secret: str, timestamp: str, body: bytes, signature: str, tolerance: float = 300.0) -> bool:
+    try:
+        if abs(time.time() - int(timestamp)) > tolerance:
+            return False
+    except ValueError:
+        return False
+    return hmac.compare_digest(sign_payload(secret, timestamp, body), signature)
+
+
+class WebhookDispatcher:
+    """发件箱消费者（至少一次投递，接收方按 X-Webhook-Id 去重）"""
+
+    def __init__(
+        self,
+        task_manager: TaskStateManager,
+        payload_builder: Callable[[dict], Awaitable[Optional[dict]]],
+        secret: str = "",
+        concurrency: int = 8,
+        timeout: float = 10.0,
+        max_attempts: int = 8,
+        retry_base_delay: float = 5.0,
+        retry_max_delay: float = 600.0,
+        poll_interval: float = 2.0,
+        lease_seconds: float = 60.0,
+        allowed_hosts: Iterable[str] = (),
+        allow_private: bool = False,
+    ):
+        """
+        Args:
+            task_manager: 任务状态管理器（发件箱表在同一数据库）
+            payload_builder: 根据发件箱记录生成请求体，返回None表示记录已失效(跳过)
+            secret: 签名密钥，为空时不签名
+            concurrency: 同时进行的投递数
+            timeout: 单次投递超时(秒)
+            max_attempts: 最大投递次数，超过后标记为dead
+            retry_base_delay / retry_max_delay: 指数退避(秒)
+            poll_interval: 发件箱为空时的轮询间隔(秒)
+            lease_seconds: 领取后的可见性超时，需大于timeout
+            allowed_hosts: 回调主机允许列表，为空时要求回调地址解析为公网地址
+            allow_private: 允许回调到内网/回环地址（仅用于本地调试）
+        """
+        self.task_manager = task_manager
+        self.payload_builder = payload_builder
+        self.secret = secret
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self.poll_interval = poll_interval
+        self.lease_seconds = max(lease_seconds, timeout * 2)
+        self.allowed_hosts = tuple(allowed_hosts)
+        self.allow_private = allow_private
+        self.http = PooledHTTPClient(
+            "webhook",
+            timeout=timeout,
+            max_connections=concurrency,
+            max_keepalive_connections=concurrency,
+            headers={"Content-Type": "application/json", "User-Agent": "gemini-reverse-api-webhook"},
+        )
+
+        self._in_flight: Dict[int, asyncio.Task] = {}
+        self._wakeup = asyncio.Event()
+        self._loop_task: Optional[asyncio.Task] = None
+
+        self.delivered = 0
+        self.retried = 0
+        self.dead = 0
+        self.blocked = 0
+
+    # ============ 生命周期 ============
+    async def start(self):
+        await self.http.start()
+        self._loop_task = asyncio.create_task(self._dispatch_loop())
+
+    async def stop(self):
+        """停止投递；进行中的记录在租约过期后重新投递"""
+        if self._loop_task:
+            self._loop_task.cancel()
+        tasks = list(self._in_flight.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*([self._loop_task] if self._loop_task else []), *tasks, return_exceptions=True)
+        self._loop_task = None
+        await self.http.close()
+
+    def wake(self):
+        self._wakeup.set()
+
+    async def check_url(self, url: str):
+        """按本投递器的配置校验回调地址，不允许时抛出 CallbackURLError"""
+        await check_callback_url(url, self.allowed_hosts, self.allow_private)
+
+    # ============ 投递 ============
+    async def _dispatch_loop(self):
+        while True:
+            free = self.concurrency - len(self._in_flight)
+            claimed = []
+            if free > 0:
+                try:
+                    claimed = await self.task_manager.claim_webhooks(free, self.lease_seconds)
+                except Exception as e:
+                    logger.error(f"[Webhook] 领取发件箱失败: {e}")
+
+            for row in claimed:
+                task = asyncio.create_task(self._deliver(row))
+                self._in_flight[row["id"]] = task
+                task.add_done_callback(lambda _, webhook_id=row["id"]: self._on_done(webhook_id))
+
+            if claimed and len(claimed) == free:
+                continue
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def _on_done(self, webhook_id: int):
+        self._in_flight.pop(webhook_id, None)
+        self._wakeup.set()
+
+    def retry_delay(self, attempts: int) -> float:
+        return min(self.retry_max_delay, self.retry_base_delay * 2 ** max(0, attempts - 1))
+
+    async def _deliver(self, row: dict):
+        webhook_id = row["id"]
+        try:
+            payload = await self.payload_builder(row)
+            if payload is None:
+                await self.task_manager.webhook_failed(webhook_id, "记录已失效")
+                return
+            body = json.dumps({"id": webhook_id, "event": row["event"], **payload}, ensure_ascii=False).encode()
+            timestamp = str(int(time.time()))
+            headers = {"X-Webhook-Id": str(webhook_id), "X-Webhook-Event": row["event"], TIMESTAMP_HEADER: timestamp}
+            if self.secret:
+                headers[SIGNATURE_HEADER] = sign_payload(self.secret, timestamp, body)
+
+            # 投递前重新校验：入队后DNS记录可能已被改为内网地址
+            try:
+                await self.check_url(row["url"])
+            except CallbackURLError as e:
+                await self.task_manager.webhook_failed(webhook_id, str(e))
+                self.blocked += 1
+                logger.error(f"[Webhook] #{webhook_id} {row['event']} 回调地址被拒绝，不再投递: {e}")
+                return
+
+            response = await self.http.post(row["url"], content=body, headers=headers)
+            if 200 <= response.status_code < 300:
+                await self.task_manager.webhook_delivered(webhook_id)
+                self.delivered += 1
+                return
+            error = f"HTTP {response.status_code}"
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+
+        if row["attempts"] < self.max_attempts:
+            delay = self.retry_delay(row["attempts"])
+            await self.task_manager.webhook_failed(webhook_id, error, retry_at=time.time() + delay)
+            self.retried += 1
+            logger.warning(f"[Webhook] #{webhook_id} {row['event']} 第{row['attempts']}次投递失败，{delay:.0f}s后重试: {error}")
+        else:
+            await self.task_manager.webhook_failed(webhook_id, error)
+            self.dead += 1
+            logger.error(f"[Webhook] #{webhook_id} {row['event']} 投递失败({row['attempts']}次)，已放弃: {error}")
+
+    def get_stats(self) -> dict:
+        return {
+            "running": self._loop_task is not None,
+            "signed": bool(self.secret),
+            "concurrency": self.concurrency,
+            "in_flight": len(self._in_flight),
+            "delivered": self.delivered,
+            "retried": self.retried,
+            "dead": self.dead,
+            "blocked": self.blocked,
+        }